@@ -9,20 +9,11 @@ from subprocess import Popen, PIPE
 import sys
 import shlex
 import h5py
-import numpy as np
 from tqdm.autonotebook import tqdm
-
-try:
-    from pysingfel.detector import Detector
-    from pysingfel.beam import Beam
-    from pysingfel.radiationDamage import setEnergyFromFile
-
-    PYSINGFEL_AVAILABLE = True
-except ModuleNotFoundError:
-    PYSINGFEL_AVAILABLE = False
 from libpyvinyl.BaseCalculator import BaseCalculator, CalculatorParameters
 from libpyvinyl.BaseData import DataCollection
 from SimExLite.DiffractionData import DiffractionData, SingFELFormat
+from SimExLite.DiffractionData.PixelMaps import get_q_map, get_solid_angle_map
 from SimExLite.PMIData import XMDYNFormat
 import shutil
 from SimExLite.utils.Logger import setLogger
@@ -329,53 +320,33 @@ def saveH5(path_to_files):
                     )
 
 
-def get_solid_angle(geom_fn: str):
+def get_solid_angle(geom_fn: str, cache: bool = None):
     """Get the solid angle array from a pysingfel geom file.
 
     Args:
         geom_fn (str): The geometry file in pysingfel format.
+        cache (bool): Whether to use the on-disk cache of the pixel maps, see
+            :func:`get_solid_angle_map`.
 
     Returns:
         ndarray: A 2D array of solid angles.
     """
-    if not PYSINGFEL_AVAILABLE:
-        err_info = (
-            "Cannot find the 'pysingfel' module, which is required to run"
-            + "SingFELDiffractionCalculator.backengine(). Did you install it following the instruction: https://simex-lite.readthedocs.io/en/latest/backengines/pysingfel.html"
-        )
-        raise ModuleNotFoundError(err_info)
-    det = Detector(geom_fn)
-    solidAngle = np.zeros((det.py, det.px))
-    for ind_x in range(det.px):
-        for ind_y in range(det.py):
-            rx = (ind_x - det.cx) * det.pix_width
-            ry = (ind_y - det.cy) * det.pix_height
-            r = np.sqrt(rx**2 + ry**2)
-            pixDist = np.sqrt(r**2 + det.d**2)
-            ss = det.pix_width**2 / (4 * pixDist**2 + det.pix_width**2)
-            solidAngle[ind_y, ind_x] = 4 * np.arcsin(ss)
-    return solidAngle
-
-
-def get_qmap(geom_fn: str, PMI_file: str):
+    return get_solid_angle_map(geom_fn, cache=cache)
+
+
+def get_qmap(geom_fn: str, PMI_file: str, cache: bool = None):
     """Get the reciprocal space magnitude map from pysingfel geom and PMI file. q=2sin(theta)/lambda
 
     Args:
         geom_fn (str): The geometry file in pysingfel format.
         PMI_file (str): The PMI file in XMDYN format.
+        cache (bool): Whether to use the on-disk cache of the pixel maps, see
+            :func:`get_solid_angle_map`.
 
     Returns:
         ndarray: A 2D array of qmap.
     """
-    if not PYSINGFEL_AVAILABLE:
-        err_info = (
-            "Cannot find the 'pysingfel' module, which is required to run"
-            + "SingFELDiffractionCalculator.backengine(). Did you install it following the instruction: https://simex-lite.readthedocs.io/en/latest/backengines/pysingfel.html"
-        )
-        raise ModuleNotFoundError(err_info)
-    det = Detector(geom_fn)
-    beam = Beam(None)
-    setEnergyFromFile(PMI_file, beam)
-    print("Beam energy =", beam.photon_energy)
-    det.init_dp(beam)
-    return det.q_mod / 1e10
+    with h5py.File(PMI_file, "r") as h5:
+        photon_energy = h5["history/parent/detail/params/photonEnergy"][()]
+    print("Beam energy =", photon_energy)
+    return get_q_map(geom_fn, photon_energy, cache=cache)
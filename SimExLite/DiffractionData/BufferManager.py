@@ -0,0 +1,164 @@
+# Copyright (C) 2023 Juncheng E
+# Contact: Juncheng E <juncheng.e@xfel.eu>
+# This file is part of SimEx-Lite which is released under GNU General Public License v3.
+# See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
+"""Out-of-core buffers for diffraction pattern arrays"""
+
+import os
+import tempfile
+import threading
+import weakref
+import numpy as np
+from SimExLite.utils.cache import get_cache_dir
+
+
+class BufferManager:
+    """Allocate diffraction pattern arrays in memory or, when they are too large, in
+    memory-mapped temporary files.
+
+    Each out-of-core buffer is backed by its own unique file in `scratch_dir`, which is
+    removed when the array is garbage collected, when :meth:`release` or :meth:`close` is
+    called, or at the latest when the interpreter exits. The dtype of the array is always
+    preserved. It is safe to share one manager between several readers and threads.
+
+    The scratch directory should be on a disk: the system temporary directory is often
+    a tmpfs, which is kept in RAM.
+
+    Args:
+        scratch_dir (str): The directory of the temporary files, defaults to
+            $SIMEXLITE_SCRATCH_DIR, or the scratch subdirectory of the SimExLite cache
+            directory (default ~/.cache/SimExLite/scratch).
+        memory_fraction (float): The fraction of the available RAM an array may take
+            before it is moved out of core.
+        max_bytes (int): A fixed threshold in bytes, it overrides `memory_fraction`.
+    """
+
+    def __init__(self, scratch_dir=None, memory_fraction: float = 0.5, max_bytes=None):
+        self.scratch_dir = scratch_dir
+        self.memory_fraction = memory_fraction
+        self.max_bytes = max_bytes
+        self._finalizers = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, val, traceback):
+        self.close()
+
+    @property
+    def threshold(self) -> int:
+        """The array size in bytes above which the array is allocated out of core"""
+        if self.max_bytes is not None:
+            return int(self.max_bytes)
+        return int(self.memory_fraction * get_available_memory())
+
+    @property
+    def filenames(self) -> list:
+        """The temporary files currently in use"""
+        with self._lock:
+            return [fn for fn, fin in self._finalizers.items() if fin.alive]
+
+    def allocate(self, shape, dtype="f8", scratch_dir=None) -> np.ndarray:
+        """Allocate a zero-filled array, in memory if it is smaller than
+        :attr:`threshold`, otherwise as a :class:`numpy.memmap`.
+
+        Args:
+            shape (tuple): The shape of the array.
+            dtype (numpy.dtype): The dtype of the array.
+            scratch_dir (str): The directory of the temporary file of this array, e.g.
+                next to the output file, defaults to the `scratch_dir` of the manager.
+
+        Returns:
+            ndarray: The array.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        if nbytes < self.threshold:
+            return np.zeros(shape, dtype=dtype)
+        if scratch_dir is None:
+            scratch_dir = self.scratch_dir or get_scratch_dir()
+        return self._allocate_memmap(shape, dtype, scratch_dir)
+
+    def _allocate_memmap(self, shape, dtype, scratch_dir):
+        os.makedirs(scratch_dir, exist_ok=True)
+        fd, filename = tempfile.mkstemp(
+            prefix="SimExLite_", suffix=".dat", dir=scratch_dir
+        )
+        os.close(fd)
+        print(f"Allocating out-of-core buffer in {filename}", flush=True)
+        arr = np.memmap(filename, dtype=dtype, mode="w+", shape=shape)
+        with self._lock:
+            self._finalizers[filename] = weakref.finalize(arr, _remove_file, filename)
+        return arr
+
+    def release(self, arr) -> None:
+        """Remove the temporary file of an out-of-core buffer. The array must not be
+        used afterwards."""
+        filename = getattr(arr, "filename", None)
+        with self._lock:
+            finalizer = self._finalizers.pop(filename, None)
+        if finalizer is not None:
+            arr.flush()
+            finalizer()
+
+    def close(self) -> None:
+        """Remove all the temporary files of this manager."""
+        with self._lock:
+            finalizers = list(self._finalizers.values())
+            self._finalizers.clear()
+        for finalizer in finalizers:
+            finalizer()
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def get_scratch_dir() -> str:
+    """Get the default directory of the out-of-core buffers, `$SIMEXLITE_SCRATCH_DIR`
+    or the scratch subdirectory of the cache directory (see
+    :func:`SimExLite.utils.cache.get_cache_dir`)."""
+    scratch_dir = os.environ.get("SIMEXLITE_SCRATCH_DIR")
+    if not scratch_dir:
+        scratch_dir = get_cache_dir() / "scratch"
+    return str(scratch_dir)
+
+
+def get_available_memory() -> int:
+    """Get the available RAM in bytes"""
+    try:
+        with open("/proc/meminfo", "r") as fptr:
+            for line in fptr:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        # Conservative guess if the platform does not tell
+        return 4 * 1024**3
+
+
+_buffer_manager = BufferManager()
+
+
+def get_buffer_manager() -> BufferManager:
+    """Get the buffer manager shared by the DiffractionData readers"""
+    return _buffer_manager
+
+
+def set_buffer_manager(manager: BufferManager) -> None:
+    """Set the buffer manager shared by the DiffractionData readers, e.g. to use
+    another scratch directory:
+
+    .. code-block:: python
+
+       set_buffer_manager(BufferManager(scratch_dir="/scratch/my_job"))
+    """
+    global _buffer_manager
+    _buffer_manager = manager
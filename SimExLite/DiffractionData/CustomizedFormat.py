@@ -4,6 +4,7 @@
 # See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
 
 
+from functools import partial
 import h5py
 import numpy as np
 from libpyvinyl.BaseFormat import BaseFormat
@@ -11,7 +12,10 @@ from extra_geom import GenericGeometry
 from extra_geom.base import DetectorGeometryBase
 from SimExLite.utils.io import parseIndex
 from SimExLite.PhotonBeamData import SimpleBeam
+from .BufferManager import get_buffer_manager
 from .EMCFormat import writeEMCGeom
+from .SingFELFormat import readStacked
+from .LazyPatternArray import LazyPatternArray
 
 
 class CustomizedFormat(BaseFormat):
@@ -23,7 +27,7 @@ class CustomizedFormat(BaseFormat):
         key = "customized"
         description = "A customized .h5 format for Diffraction Data"
         file_extension = ".h5"
-        read_kwargs = ["index"]
+        read_kwargs = ["index", "dtype", "lazy"]
         write_kwargs = [""]
         return self._create_format_register(
             key, description, file_extension, read_kwargs, write_kwargs
@@ -37,26 +41,34 @@ class CustomizedFormat(BaseFormat):
         return []
 
     @classmethod
-    def read(cls, filename: str, index=None) -> dict:
-        """Read the data from the file with the `filename` to a dictionary."""
+    def read(cls, filename: str, index=None, dtype=None, lazy=False) -> dict:
+        """Read the data from the file with the `filename` to a dictionary. The patterns
+        are read in `dtype`, which defaults to the dtype in the file. If lazy=True,
+        `img_array` is a :class:`LazyPatternArray` reading the patterns on demand."""
         data_dict = {}
 
         index = parseIndex(index)
 
-        arr_size = len(range(getPatternTotal(filename))[index])
+        indices = np.arange(getPatternTotal(filename))[index]
+        arr_size = len(indices)
         pattern_shape = getPatternShape(filename)
-        if arr_size < 1e9:
-            arr = np.zeros((arr_size, pattern_shape[0], pattern_shape[1]))
+        if dtype is None:
+            dtype = getPatternDtype(filename)
+        if lazy:
+            arr = LazyPatternArray(
+                partial(readFrames, filename, dtype=dtype),
+                indices,
+                pattern_shape,
+                dtype,
+            )
         else:
-            arr = np.memmap(
-                "memmap.dat",
-                dtype="float16",
-                mode="w+",
-                shape=(arr_size, pattern_shape[0], pattern_shape[1]),
+            arr = get_buffer_manager().allocate(
+                (arr_size, pattern_shape[0], pattern_shape[1]), dtype
             )
         # quaternions = np.zeros((arr_size, 4))
         with h5py.File(filename, "r") as h5:
-            arr[:] = h5["patterns"][index]
+            if not lazy:
+                readStacked(h5["patterns"], index, arr)
             distance = h5["detectorDistance"][()]
 
         params = getParameters(filename)
@@ -94,6 +106,16 @@ class CustomizedFormat(BaseFormat):
             key = original_key + "_to_CondorFormat"
         return object.from_file(filename, cls, key)
 
+    @classmethod
+    def open_stream_writer(
+        cls, filename: str, data_dict: dict, n_patterns: int, pattern_shape, dtype
+    ):
+        """Open a :class:`CondorStreamWriter` to write patterns with the metadata of
+        `data_dict` chunk by chunk."""
+        geom = extra_geom2params(data_dict["geom"], data_dict["distance"])
+        beam = BeamData2params(data_dict["beam"])
+        return CondorStreamWriter(filename, n_patterns, pattern_shape, dtype, geom, beam)
+
     @staticmethod
     def to_emc_geom(in_fn: str, out_fn: str, stoprad: float):
         """Write the Condor geom in EMC geom H5 format
@@ -114,6 +136,22 @@ def getPatternShape(filename):
         return h5["patterns"][0].shape
 
 
+def readFrames(filename, indices, dtype=None):
+    """Read the diffraction patterns of `indices` into a new array."""
+    with h5py.File(filename, "r") as h5:
+        dset = h5["patterns"]
+        if dtype is None:
+            dtype = dset.dtype
+        out = np.empty((len(indices),) + dset.shape[1:], dtype=dtype)
+        return readStacked(dset, indices, out)
+
+
+def getPatternDtype(filename):
+    """Get the dtype of diffraction patterns in the hdf5 file"""
+    with h5py.File(filename, "r") as h5:
+        return h5["patterns"].dtype
+
+
 def getPatternTotal(filename):
     """Get the total number of diffraction patterns in the hdf5 file"""
     with h5py.File(filename, "r") as h5:
@@ -218,25 +256,71 @@ def write_condor(
     """
     # Method Description
     with h5py.File(filename, "a") as f:
-        f["binning"] = 1
-        f["detectorDistance"] = geom["distance"]
-        f["pixelSize"] = geom["pixelSize"]
-        f["pixelSize"].attrs[
-            "Pixel Size"
-        ] = "Physical pixel size in m. Effective pixle size= (Physical pixel size)*binning"
-        f["photonEnergy"] = beam["photonEnergy"]  # eV
-        f["photonEnergy"].attrs["Photon Energy"] = "Photon Energy in eV"
-        # No pulse energy in standard DiffractionData defined.
-        # f["fluence"] = (beam["pulseEnergy"] * 1e3) / (
-        #     beam["focusArea"] * 1e12
-        # )  # mJ/um^2
-        # f["fluence"].attrs["Fluence"] = "Incident fluence in mJ/um^2"
-        # TODO: angle and direction convert
-        # f["angle"] = None
-        # f["direction"] = None
+        writeParams(f, geom, beam)
         f["patterns"] = arr
 
 
+def writeParams(f, geom, beam):
+    """Write the geometry and beam parameters into an opened condor file."""
+    f["binning"] = 1
+    f["detectorDistance"] = geom["distance"]
+    f["pixelSize"] = geom["pixelSize"]
+    f["pixelSize"].attrs[
+        "Pixel Size"
+    ] = "Physical pixel size in m. Effective pixle size= (Physical pixel size)*binning"
+    f["photonEnergy"] = beam["photonEnergy"]  # eV
+    f["photonEnergy"].attrs["Photon Energy"] = "Photon Energy in eV"
+    # No pulse energy in standard DiffractionData defined.
+    # f["fluence"] = (beam["pulseEnergy"] * 1e3) / (
+    #     beam["focusArea"] * 1e12
+    # )  # mJ/um^2
+    # f["fluence"].attrs["Fluence"] = "Incident fluence in mJ/um^2"
+    # TODO: angle and direction convert
+    # f["angle"] = None
+    # f["direction"] = None
+
+
+class CondorStreamWriter:
+    """Write diffraction patterns chunk by chunk in the customized format.
+
+    Args:
+        filename (str): Output filename.
+        n_patterns (int): The total number of patterns to write.
+        pattern_shape (tuple): The shape of one pattern.
+        dtype (numpy.dtype): The dtype of the patterns.
+        geom (dict): The dictionary of detector parameters.
+        beam (dict): The dictionary of beam parameters.
+    """
+
+    def __init__(self, filename, n_patterns, pattern_shape, dtype, geom, beam):
+        self._h5 = h5py.File(filename, "w")
+        writeParams(self._h5, geom, beam)
+        pattern_shape = tuple(pattern_shape)
+        self._dset = self._h5.create_dataset(
+            "patterns",
+            shape=(n_patterns,) + pattern_shape,
+            dtype=dtype,
+            chunks=(1,) + pattern_shape,
+        )
+        self.n_written = 0
+        # The keywords to read the file back
+        self.read_kwargs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, val, traceback):
+        self.close()
+
+    def write(self, arr):
+        """Append the patterns in `arr`"""
+        self._dset[self.n_written : self.n_written + len(arr)] = arr
+        self.n_written += len(arr)
+
+    def close(self):
+        self._h5.close()
+
+
 def to_emc_geom(in_fn: str, out_fn: str, stoprad: float):
     """Write the Condor geom in EMC geom H5 format
 
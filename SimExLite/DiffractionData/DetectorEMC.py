@@ -6,7 +6,12 @@ import sys
 import os
 import numpy as np
 from numpy import ma
-import pandas
+from SimExLite.utils.cache import (
+    get_cache_path,
+    get_file_hash,
+    use_cache,
+    write_cache_file,
+)
 
 try:
     import h5py
@@ -15,6 +20,13 @@ try:
 except ImportError:
     HDF5_MODE = False
 
+try:
+    import pandas
+
+    PANDAS_MODE = True
+except ImportError:
+    PANDAS_MODE = False
+
 
 class Detector(object):
     """Dragonfly detector
@@ -30,9 +42,10 @@ class Detector(object):
     For the new ASCII format, detd_pix and ewald_rad numbers are read from the file \
     but for the old file, they must be provided.
     Methods:
-        parse(fname, mask_flag=False, keep_mask_1=True)
+        parse(fname, mask_flag=False, keep_mask_1=True, cache=None)
         write(fname)
         assemble_frame(data, zoomed=False, sym=False)
+        assemble_frames(data, zoomed=False, sym=False)
         calc_from_coords()
     On parsing, it produces the following numpy arrays (each of length num_pix)
     Attributes:
@@ -56,12 +69,16 @@ class Detector(object):
         self.ewald_rad = ewald_rad
         self.background = None
         self._sym_shape = None
+        self._assem_index = {}
         if det_fname is not None:
             self.parse(det_fname, mask_flag, keep_mask_1)
 
-    def parse(self, fname, mask_flag=False, keep_mask_1=True):
+    def parse(self, fname, mask_flag=False, keep_mask_1=True, cache=None):
         """Parse Dragonfly detector from file
         File can either be in the HDF5 or ASCII format
+        If cache=True (or cache=None and $SIMEXLITE_CACHE=1), the columns of ASCII files
+        are cached in a compressed .npz file keyed on the hash of the file, under
+        $SIMEXLITE_CACHE_DIR/detector (default ~/.cache/SimExLite/detector)
         """
         self.det_fname = fname
         if HDF5_MODE and h5py.is_hdf5(self.det_fname):
@@ -74,9 +91,9 @@ class Detector(object):
                 else:
                     self._parse_h5det(mask_flag, keep_mask_1)
             else:
-                self._parse_asciidet(mask_flag, keep_mask_1)
+                self._parse_asciidet(mask_flag, keep_mask_1, cache)
         else:
-            self._parse_asciidet(mask_flag, keep_mask_1)
+            self._parse_asciidet(mask_flag, keep_mask_1, cache)
 
     def write(self, fname):
         """Write Dragonfly detector to file
@@ -110,26 +127,66 @@ class Detector(object):
         Returns:
             Numpy masked array representing assembled image
         """
+        return self.assemble_frames(np.asarray(data)[np.newaxis], zoomed, sym)[0]
+
+    def assemble_frames(self, data, zoomed=False, sym=False):
+        """Assemble a batch of raw images at once
+        The linear indices of the assembled pixels are computed once per detector,
+        and the frames are assembled in chunks with np.bincount
+        Arguments:
+            data - array of (num_frames, num_pix) values
+            zoomed (bool) - Restrict assembled images to non-masked pixels
+            sym (bool) - Centro-symmetrize images
+        Returns:
+            Numpy masked array of (num_frames,) + assembled image shape, which is
+            empty for an empty batch
+        """
+        data = np.asarray(data).reshape(len(data), self.unassembled_mask.size)
+        passes = self._get_assem_index(sym)
+        if sym:
+            shape, mask, bounds = self._sym_shape, self._sym_mask, self._sym_zoom_bounds
+        else:
+            shape, mask, bounds = self.frame_shape, self.mask, self.zoom_bounds
+        num_assem = shape[0] * shape[1]
+
+        imgs = np.zeros((len(data), num_assem), dtype="f8")
+        chunk_size = max(1, ASSEM_CHUNK // data.shape[1])
+        offsets = np.arange(min(chunk_size, len(data)))[:, np.newaxis] * num_assem
+        for targets, weights in passes:
+            # The linear indices into a chunk of assembled images
+            indices = (offsets + targets).ravel()
+            for start in range(0, len(data), chunk_size):
+                chunk = data[start : start + chunk_size]
+                imgs[start : start + len(chunk)] += np.bincount(
+                    indices[: chunk.size],
+                    weights=(chunk * weights).ravel(),
+                    minlength=len(chunk) * num_assem,
+                ).reshape(len(chunk), num_assem)
+        imgs = imgs.reshape((len(data),) + tuple(shape))
+        imgs = ma.masked_array(imgs, mask=np.broadcast_to(1 - mask, imgs.shape))
+        if zoomed:
+            return imgs[:, bounds[0] : bounds[1], bounds[2] : bounds[3]]
+        return imgs
+
+    def _get_assem_index(self, sym):
+        """(Internal) The (linear assembled pixel indices, weights) of each pass of
+        the assembly over the raw pixels. The weights include the mask and, for
+        sym=True, the averaging of the pixels which are both good"""
+        if sym in self._assem_index:
+            return self._assem_index[sym]
+        weights = self.unassembled_mask.astype("f8")
         if sym:
             self._init_sym()
-            img = ma.masked_array(
-                np.zeros(self._sym_shape, dtype="f8"), mask=1 - self._sym_mask
-            )
-            np.add.at(img, (self._sym_x, self._sym_y), data * self.unassembled_mask)
-            np.add.at(img, (self._sym_fx, self._sym_fy), data * self.unassembled_mask)
-            img.data[self._sym_bothgood] /= 2.0
-            if zoomed:
-                b = self._sym_zoom_bounds
-                return img[b[0] : b[1], b[2] : b[3]]
+            width = self._sym_shape[1]
+            passes = []
+            for x, y in [(self._sym_x, self._sym_y), (self._sym_fx, self._sym_fy)]:
+                targets = x.astype("i8") * width + y
+                both = self._sym_bothgood.ravel()[targets]
+                passes.append((targets, weights / np.where(both, 2.0, 1.0)))
         else:
-            img = ma.masked_array(
-                np.zeros(self.frame_shape, dtype="f8"), mask=1 - self.mask
-            )
-            np.add.at(img, (self.x, self.y), data * self.unassembled_mask)
-            if zoomed:
-                b = self.zoom_bounds
-                return img[b[0] : b[1], b[2] : b[3]]
-        return img
+            passes = [(self.x.astype("i8") * self.frame_shape[1] + self.y, weights)]
+        self._assem_index[sym] = passes
+        return passes
 
     def calc_from_coords(self):
         """Calculate essential detector attributes from pixel coordinates
@@ -153,33 +210,45 @@ class Detector(object):
         self.qz = self.ewald_rad * (self.detd / fac - 1.0)
         self.corr = self.detd / fac**3 * (1.0 - self.cx**2 / fac**2)
 
-    def _parse_asciidet(self, mask_flag, keep_mask_1):
+    def _parse_asciidet(self, mask_flag, keep_mask_1, cache=None):
         """(Internal) Detector file parser
         Arguments:
             mask_flag (bool, optional) - Whether to read the mask column
             keep_mask_1 (bool, optional) - Whether to keep mask=1 within the boolean mask
+            cache (bool, optional) - Whether to use the .npz cache of the columns,
+                see parse()
         """
         print("Parsing ASCII detector file")
         self._check_header()
         sys.stderr.write("Reading %s..." % self.det_fname)
         if mask_flag:
             sys.stderr.write("with mask...")
-        dframe = pandas.read_csv(
-            self.det_fname,
-            delim_whitespace=True,
-            skiprows=1,
-            engine="c",
-            header=None,
-            names=["qx", "qy", "qz", "corr", "mask"],
-            dtype={"qx": "f8", "qy": "f8", "qz": "f8", "corr": "f8", "mask": "u1"},
-        )
-        self.qx, self.qy, self.qz, self.corr = tuple(
-            [
-                np.array(dframe[key])  # pylint: disable=C0103
-                for key in ["qx", "qy", "qz", "corr"]
-            ]
-        )
-        self.raw_mask = np.array(dframe["mask"]).astype("u1")
+        cache_path = None
+        if use_cache(cache):
+            key = get_file_hash(self.det_fname)
+            cache_path = get_cache_path("detector", key, ".npz")
+        if cache_path is not None and cache_path.is_file():
+            sys.stderr.write("from cache...")
+            with np.load(cache_path) as columns:
+                self.qx, self.qy, self.qz, self.corr, self.raw_mask = (
+                    columns[key] for key in ["qx", "qy", "qz", "corr", "mask"]
+                )
+        else:
+            self.qx, self.qy, self.qz, self.corr, self.raw_mask = _read_ascii_columns(
+                self.det_fname
+            )
+            if cache_path is not None:
+                write_cache_file(
+                    cache_path,
+                    lambda fname: np.savez_compressed(
+                        fname,
+                        qx=self.qx,
+                        qy=self.qy,
+                        qz=self.qz,
+                        corr=self.corr,
+                        mask=self.raw_mask,
+                    ),
+                )
         sys.stderr.write("done\n")
         self._process_det(mask_flag, keep_mask_1)
 
@@ -209,17 +278,15 @@ class Detector(object):
         corr = self.corr.ravel()
         mask = self.raw_mask.ravel().astype("u1")
 
-        with open(fname, "w") as fptr:
-            fptr.write("%d %.6f %.6f\n" % (qx.size, self.detd, self.ewald_rad))
-            for par0, par1, par2, par3, par4 in zip(qx, qy, qz, corr, mask):
-                txt = "%21.15e %21.15e %21.15e %21.15e %d\n" % (
-                    par0,
-                    par1,
-                    par2,
-                    par3,
-                    par4,
-                )
-                fptr.write(txt)
+        with open(fname, "wb") as fptr:
+            header = "%d %.6f %.6f\n" % (qx.size, self.detd, self.ewald_rad)
+            fptr.write(header.encode())
+            # Format the lines in chunks and write each chunk at once
+            for start in range(0, qx.size, ASCII_CHUNK):
+                sl = slice(start, start + ASCII_CHUNK)
+                columns = [col[sl].tolist() for col in (qx, qy, qz, corr, mask)]
+                lines = "".join(ASCII_LINE_FMT % row for row in zip(*columns))
+                fptr.write(lines.encode())
 
     def _write_h5det(self, fname):
         print("Writing HDF5 detector file")
@@ -280,6 +347,7 @@ class Detector(object):
 
     def _init_assem(self):
         # Calculate attributes given self.x and self.y
+        self._assem_index = {}
         mask = self.unassembled_mask
         self.frame_shape = (self.x.max() + 1, self.y.max() + 1)
 
@@ -287,13 +355,14 @@ class Detector(object):
         self.mask[self.x, self.y] = mask
         self.mask = np.sign(self.mask)
 
-        xsel = self.x[mask.astype(np.bool)]
-        ysel = self.y[mask.astype(np.bool)]
+        xsel = self.x[mask.astype(bool)]
+        ysel = self.y[mask.astype(bool)]
         self.zoom_bounds = (xsel.min(), xsel.max() + 1, ysel.min(), ysel.max() + 1)
 
     def _init_sym(self, force=False):
         if self._sym_shape is not None and not force:
             return
+        self._assem_index.pop(True, None)
         self._sym_shape = (
             2 * int(np.ceil(np.abs(self.cx).max())) + 1,
             2 * int(np.ceil(np.abs(self.cy).max())) + 1,
@@ -334,3 +403,40 @@ class Detector(object):
         """Return 2D integer coordinates (for assembly)
         Corner of the detector at (0,0)"""
         return self.x, self.y
+
+
+# The number of pixels assembled at once by assemble_frames
+ASSEM_CHUNK = 1 << 22
+# The number of pixels formatted at once by the ASCII writer
+ASCII_CHUNK = 1 << 18
+# Line format of the ASCII detector file
+ASCII_LINE_FMT = "%21.15e %21.15e %21.15e %21.15e %d\n"
+
+
+def _read_ascii_columns(fname):
+    """Read the (qx, qy, qz, corr, mask) columns of an ASCII detector file, with the
+    C parser of pandas if it's available (1M pixels: 1.8 s), otherwise with
+    np.loadtxt (2.3 s)"""
+    with open(fname, "r") as fptr:
+        num_pix = int(fptr.readline().split()[0])
+    names = ["qx", "qy", "qz", "corr", "mask"]
+    if PANDAS_MODE:
+        dframe = pandas.read_csv(
+            fname,
+            sep=r"\s+",
+            skiprows=1,
+            engine="c",
+            header=None,
+            names=names,
+            dtype={"qx": "f8", "qy": "f8", "qz": "f8", "corr": "f8", "mask": "u1"},
+        )
+        columns = [dframe[key].to_numpy() for key in names]
+    else:
+        values = np.loadtxt(fname, skiprows=1, ndmin=2)
+        if values.shape[1] != 5:
+            raise ValueError(f"{fname} has {values.shape[1]} columns, expected 5.")
+        columns = [np.ascontiguousarray(values[:, i]) for i in range(5)]
+        columns[4] = columns[4].astype("u1")
+    if len(columns[0]) != num_pix:
+        raise ValueError(f"{fname} has {len(columns[0])} pixels, expected {num_pix}.")
+    return tuple(columns)
@@ -4,15 +4,19 @@
 # See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
 """Diffraction Data APIs"""
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 from tqdm.autonotebook import tqdm
 from pathlib import Path
 import h5py
 import numpy as np
 from libpyvinyl import BaseData
 from SimExLite.utils.analysis import linear
-from SimExLite.utils import rebin_sum
+from SimExLite.utils import rebin
+from SimExLite.utils.geometry import get_geom_fingerprint
 from .SingFELFormat import SingFELFormat
-from .EMCFormat import EMCFormat
+from .EMCFormat import EMCFormat, PatternsSOne, dense_to_PatternsSOne
 from .CustomizedFormat import CustomizedFormat
 from . import writeemc
 
@@ -86,7 +90,10 @@ class DiffractionData(BaseData):
             chunk (int): The chunk size to conduct the operation
         """
         self.__operation_check()
-        array = self.data_dict["img_array"]
+        if np.asarray(val).dtype.kind in "fc":
+            array = self.__float_array()
+        else:
+            array = self.data_dict["img_array"]
         if isinstance(val, np.ndarray):
             array[:] = array * val
         else:
@@ -98,37 +105,73 @@ class DiffractionData(BaseData):
             ):
                 arr[:] = arr * val
 
-    def add_beam_stop(self, stop_rad: float):
-        """Add a beamstop in pixel radius (float) to the diffraction patterns.
+    def add_beam_stop(
+        self,
+        stop_rad: float,
+        center=None,
+        geom_center: bool = False,
+        chunk_size: int = 10000,
+    ):
+        """Add a beamstop in pixel radius (float) to the diffraction patterns. The mask
+        of the beamstop is computed once and the pixels inside it are set to 0 in chunks.
 
         Args:
             stop_rad (float): The radius of the beamstop in pixel unit
+            center (tuple): The (row, col) pixel of the beam center, defaults to the
+                center of the pattern.
+            geom_center (bool): Whether to take the beam center from the geometry of the
+                data. It overrides `center`.
+            chunk_size (int): The chunk size to conduct the operation
         """
         self.__operation_check()
         array = self.data_dict["img_array"]
+        if geom_center:
+            center = get_beam_center(self.data_dict["geom"], array.shape[1:])
+        stop_mask = get_beam_stop_mask(array.shape[1:], stop_rad, center)
+        n_chunks = int(np.ceil(float(len(array)) / chunk_size))
         print("Adding beam stop...", flush=True)
-        for i, img in enumerate(tqdm(array)):
-            array[i] = addBeamStop(img, stop_rad)
+        for arr in tqdm(spliterate(array, chunk_size), total=n_chunks):
+            arr[:, stop_mask] = 0
         self.stop_rad = stop_rad
 
-    def add_Gaussian_noise(self, mu, sigs_popt):
-        """Add Gaussian noise to one diffraction pattern
+    def add_Gaussian_noise(
+        self, mu, sigs_popt, seed=None, n_workers=None, chunk_size: int = 1000
+    ):
+        """Add Gaussian noise to the diffraction patterns, see :func:`map_chunks` for
+        the parallel chunked random generation.
 
         Args:
             mu (float): The averange ADU for one photon
             sigs_popt (list): [slop, intercept]
+            seed (int): The seed of the random numbers.
+            n_workers (int): The number of threads.
+            chunk_size (int): The chunk size to conduct the operation
         """
         self.__operation_check()
-        array = self.data_dict["img_array"]
+        array = self.__float_array()
         print("Adding Gaussian Noise...", flush=True)
-        for i, diffr_data in enumerate(tqdm(array)):
-            array[i] = addGaussianNoise(diffr_data, mu, sigs_popt)
+        map_chunks(
+            array,
+            lambda chunk, rng: addGaussianNoise(chunk, mu, sigs_popt, rng),
+            chunk_size,
+            n_workers,
+            seed,
+        )
 
-    def poissonize(self):
-        """Poissonize the data array in this data class"""
+    def poissonize(self, seed=None, n_workers=None, chunk_size: int = 1000):
+        """Poissonize the data array in this data class, see :func:`map_chunks` for
+        the parallel chunked random generation.
+
+        Args:
+            seed (int): The seed of the random numbers.
+            n_workers (int): The number of threads.
+            chunk_size (int): The chunk size to conduct the operation
+        """
         self.__operation_check()
         array = self.data_dict["img_array"]
-        array[:] = np.random.poisson(array)
+        map_chunks(
+            array, lambda chunk, rng: rng.poisson(chunk), chunk_size, n_workers, seed
+        )
 
     def set_array_data_type(self, data_type):
         """The the data numpy array dtype
@@ -140,19 +183,49 @@ class DiffractionData(BaseData):
         array = self.data_dict["img_array"]
         self.data_dict["img_array"] = array.astype(data_type)
 
-    def apply_geom_mask(self, geom):
+    def apply_geom_mask(self, geom, mask_file: str = None, chunk_size: int = 10000):
         """Apply the mask from a detector geom to the data, detector gaps will be filled with -1.
 
         Args:
             geom (ExtraGeomDetectorGeometry): extra_geom instance
+            mask_file (str): An HDF5 file to persist the mask in, e.g. the data file, so
+                that later runs do not need to position the detector modules again.
+            chunk_size (int): The chunk size to conduct the operation
         """
         self.__operation_check()
         array = self.data_dict["img_array"]
-        mask = get_geom_mask(geom, self.data_dict["img_array"][0].shape)
+        gaps = get_geom_gaps(geom, array.shape[1:], mask_file)
+        n_chunks = int(np.ceil(float(len(array)) / chunk_size))
         print("Applying the mask...", flush=True)
-        for diffr_data in tqdm(array):
-            diffr_data[np.isnan(mask)] = -1
-        return mask
+        for arr in tqdm(spliterate(array, chunk_size), total=n_chunks):
+            arr[:, gaps] = -1
+        return get_geom_mask(geom, array.shape[1:])
+
+    def pipeline(self):
+        """Create a :class:`DiffractionPipeline` to apply a chain of operations in one
+        chunked pass. Unlike the in-place operations, it also works on file mapping
+        data and can stream the output into a file, e.g.:
+
+        .. code-block:: python
+
+           dd.pipeline().scale(1e3).poissonize(seed=0).run(
+               filename="photons.h5", format_class=EMCFormat
+           )
+        """
+        from .DiffractionPipeline import DiffractionPipeline
+
+        return DiffractionPipeline(self)
+
+    def __float_array(self):
+        """Get the patterns for an in-place operation with float results. Integer
+        patterns, e.g. photons read from EMC files, are upcast to float64 first, so
+        that the results are not truncated when they are written back."""
+        array = self.data_dict["img_array"]
+        if array.dtype.kind in "biu":
+            print(f"Converting the {array.dtype} patterns to float64.")
+            array = array.astype(np.float64)
+            self.data_dict["img_array"] = array
+        return array
 
     def __operation_check(self):
         """To check if the data operation is allowed."""
@@ -164,28 +237,127 @@ class DiffractionData(BaseData):
             err_str += "dd_in_dict = DiffractionData.from_dict(my_dict, 'YOUR_KEY')"
 
             raise TypeError(err_str)
+        if not isinstance(self.data_dict["img_array"], np.ndarray):
+            err_str = "This operation needs the patterns in memory, but img_array is a "
+            err_str += f"{type(self.data_dict['img_array']).__name__}. To load it:\n"
+            err_str += "my_dict['img_array'] = np.asarray(my_dict['img_array'])"
+
+            raise TypeError(err_str)
 
 
-def addBeamStop(img, stop_rad):
+def get_chunk_generator(seed_sequence, i_chunk):
+    """Get the random generator of the `i_chunk`-th chunk. It's identical to the generator
+    of the `i_chunk`-th child of `seed_sequence.spawn()`, without spawning the preceding
+    children.
+    """
+    child = np.random.SeedSequence(
+        seed_sequence.entropy,
+        spawn_key=seed_sequence.spawn_key + (i_chunk,),
+        pool_size=seed_sequence.pool_size,
+    )
+    return np.random.default_rng(child)
+
+
+def map_chunks(array, func, chunk_size: int = 1000, n_workers=None, seed=None):
+    """Apply `func` to the chunks of `array` in parallel threads and write the results
+    back in place. The chunk `i` gets the random generator
+    ``get_chunk_generator(SeedSequence(seed), i)``, so the results only depend on `seed`
+    and `chunk_size`, not on `n_workers`.
+
+    Args:
+        array (ndarray): The array of the diffraction patterns. A `TypeError` is raised
+            if it's an integer array and `func` returns floats.
+        func (callable): A function ``func(chunk, rng)`` returning the new chunk.
+        chunk_size (int): The number of patterns in a chunk.
+        n_workers (int): The number of threads, defaults to the one of
+            :class:`concurrent.futures.ThreadPoolExecutor`.
+        seed (int or numpy.random.SeedSequence): The seed of the random numbers.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        seed_sequence = seed
+    else:
+        seed_sequence = np.random.SeedSequence(seed)
+    n_chunks = int(np.ceil(float(len(array)) / chunk_size))
+
+    def work(i_chunk):
+        chunk = array[i_chunk * chunk_size : (i_chunk + 1) * chunk_size]
+        result = np.asarray(func(chunk, get_chunk_generator(seed_sequence, i_chunk)))
+        if chunk.dtype.kind in "biu" and result.dtype.kind in "fc":
+            raise TypeError(
+                f"Can't write {result.dtype} results into the {chunk.dtype} array "
+                "in place without truncating them, please convert it to float first."
+            )
+        chunk[:] = result
+
+    print(f"Operation in {n_chunks} chunks", flush=True)
+    with ThreadPoolExecutor(n_workers) as executor:
+        for _ in tqdm(executor.map(work, range(n_chunks)), total=n_chunks):
+            pass
+
+
+def addBeamStop(img, stop_rad, center=None):
     """Add the beamstop in pixel radius to diffraction pattern.
 
     Args:
         img (ndarray): Diffraction pattern
         stop_rad (float): The radius of the beamstop in pixel unit (float)
+        center (tuple): The (row, col) pixel of the beam center, defaults to the center
+            of the pattern.
 
     Returns:
         ndarray: Beamstop masked 2D array
     """
-    stop_mask = np.ones_like(img)
-    center = np.array(img.shape) // 2
-    y = np.indices(img.shape)[0] - center[0]
-    x = np.indices(img.shape)[1] - center[1]
-    r = np.sqrt((x * x + y * y))
-    stop_mask[r <= stop_rad] = 0
-    masked = img * stop_mask
+    masked = np.array(img)
+    masked[get_beam_stop_mask(masked.shape, stop_rad, center)] = 0
     return masked
 
 
+def get_beam_stop_mask(shape, stop_rad, center=None):
+    """Get the beamstop mask of a diffraction pattern, which is `True` inside the
+    beamstop. The mask is cached per (shape, radius, center), hence read-only.
+
+    Args:
+        shape (tuple): The shape of the diffraction pattern.
+        stop_rad (float): The radius of the beamstop in pixel unit.
+        center (tuple): The (row, col) pixel of the beam center, defaults to the center
+            of the pattern.
+
+    Returns:
+        ndarray: The 2D boolean mask.
+    """
+    shape = tuple(int(n) for n in shape)
+    if center is None:
+        center = tuple(n // 2 for n in shape)
+    return _get_beam_stop_mask(shape, float(stop_rad), tuple(float(c) for c in center))
+
+
+@lru_cache(maxsize=16)
+def _get_beam_stop_mask(shape, stop_rad, center):
+    y, x = np.ogrid[: shape[0], : shape[1]]
+    y = y - center[0]
+    x = x - center[1]
+    stop_mask = np.sqrt(x * x + y * y) <= stop_rad
+    stop_mask.setflags(write=False)
+    return stop_mask
+
+
+def get_beam_center(geom, img_size):
+    """Get the beam center of the diffraction patterns assembled from a detector geom
+
+    Args:
+        geom (ExtraGeomDetectorGeometry): extra_geom instance.
+        img_size ([nrow, ncol]): The array size of the diffraction patterns.
+
+    Returns:
+        tuple: The (row, col) pixel of the beam center.
+    """
+    data = np.ones(geom.expected_data_shape)
+    assembled, centre = geom.position_modules(data)
+    # The same binning as in get_geom_mask
+    bin_factor = np.array(assembled.shape) // np.array(img_size)
+    return tuple(float(c) for c in np.asarray(centre, dtype=float) / bin_factor)
+
+
 def write_multiple_file_to_emc(
     in_file_list,
     in_file_format_class,
@@ -196,51 +368,149 @@ def write_multiple_file_to_emc(
     fluct_sample_interval=None,
     background=None,
     geom=None,
+    n_workers: int = 1,
+    seed=None,
     **kwargs,
 ):
-    """Write multiple diffraction files to a single EMC h5 file"""
-    # Normally fluct_sample_interval is set to 3.
-    emcwriter = None
+    """Write multiple diffraction files to a single EMC h5 file
+
+    Each input file is read, preprocessed and sparsified by :func:`preprocess_file_to_emc`.
+    With `n_workers` > 1, this is done by a pool of processes, while this process
+    appends the sparse patterns to the output in the order of `in_file_list`. The
+    output only depends on `seed`, not on `n_workers`.
+
+    Args:
+        in_file_list (list): The input filenames.
+        in_file_format_class: The format class of the input files.
+        filename (str): The output filename.
+        poissonize (bool): Whether to poissonize the patterns.
+        stop_rad (float): The radius of the beamstop in pixel unit.
+        multiply (float): The value to be multiplied to the patterns.
+        fluct_sample_interval (float): The sampling interval of the fluence
+            fluctuation, see :func:`get_I`. Normally it is set to 3.
+        background (float or ndarray): The background to be added to the patterns.
+        geom (ExtraGeomDetectorGeometry): extra_geom instance to mask the detector gaps.
+        n_workers (int): The number of processes reading and preprocessing the files.
+        seed (int): The seed of the random numbers.
+        kwargs: The keywords to read the input files.
+    """
     list_len = len(in_file_list)
-    if fluct_sample_interval is not None:
-        fluct_I = []
-    for idx, in_fn in enumerate(in_file_list):
-        print(f"{idx + 1}/{list_len}: {in_fn}\n")
-        data_dict = in_file_format_class.read(in_fn, **kwargs)
-        dd_in_dict = DiffractionData.from_dict(data_dict, "tmp")
-        # Scaling before Poissionization
-        arr = data_dict["img_array"]
-        if fluct_sample_interval is not None:
-            I, _ = get_I(len(arr), fluct_sample_interval)
-            arr[:] = arr * I[:, None, None]
-            fluct_I.append(I)
-        if multiply is not None:
-            dd_in_dict.multiply(multiply)
-        if background is not None:
-            arr[:] += background
-        if poissonize:
-            dd_in_dict.poissonize()
-        if stop_rad is not None:
-            dd_in_dict.add_beam_stop(stop_rad)
-        if geom is not None:
-            dd_in_dict.apply_geom_mask(geom)
-
-        if emcwriter is None:
-            arr_sample = arr[0]
-            emcwriter = writeemc.EMCWriter(
-                filename, arr_sample.shape[0] * arr_sample.shape[1]
+    file_seeds = np.random.SeedSequence(seed).spawn(list_len)
+    # The detector gaps are computed once here, not in each worker
+    gaps = None
+    fluct_I = []
+    emcwriter = None
+    preprocess = partial(
+        preprocess_file_to_emc,
+        in_file_format_class=in_file_format_class,
+        poissonize=poissonize,
+        stop_rad=stop_rad,
+        multiply=multiply,
+        fluct_sample_interval=fluct_sample_interval,
+        background=background,
+        **kwargs,
+    )
+    if geom is not None:
+        first = in_file_format_class.read(in_file_list[0], **dict(kwargs, lazy=True))
+        pattern_shape = first["img_array"].shape[1:]
+        gaps = get_geom_gaps(geom, pattern_shape)
+        preprocess = partial(preprocess, gaps=gaps)
+
+    try:
+        if n_workers > 1:
+            executor = ProcessPoolExecutor(n_workers)
+            results = _ordered_map(
+                executor, preprocess, in_file_list, file_seeds, n_ahead=n_workers
+            )
+        else:
+            executor = None
+            results = map(preprocess, in_file_list, file_seeds)
+        for idx, (patterns, intensity_scale) in enumerate(results):
+            print(f"{idx + 1}/{list_len}: {in_file_list[idx]}\n")
+            if emcwriter is None:
+                emcwriter = writeemc.EMCWriter(filename, patterns.num_pix)
+            emcwriter.write_sparse_frames(
+                *[patterns.attrs(g) for g in PatternsSOne.ATTRS]
             )
-        for photons in tqdm(arr):
-            emcwriter.write_frame(photons.astype(np.int32).ravel())
+            if intensity_scale is not None:
+                fluct_I.append(intensity_scale)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if emcwriter is not None:
+            emcwriter.finish_write()
     if fluct_sample_interval is not None:
         # fluct_fn = str(Path(filename).with_suffix(".fluct.h5"))
         # with h5py.File(fluct_fn, "w") as h5:
         with h5py.File(filename, "a") as h5:
-            h5["fluct_I"] = np.array(fluct_I).ravel()
+            h5["fluct_I"] = np.concatenate(fluct_I)
+
+
+def preprocess_file_to_emc(
+    in_fn,
+    seed_sequence,
+    in_file_format_class,
+    poissonize=False,
+    stop_rad=None,
+    multiply=None,
+    fluct_sample_interval=None,
+    background=None,
+    gaps=None,
+    **kwargs,
+):
+    """Read and preprocess one diffraction file for :func:`write_multiple_file_to_emc`.
 
+    Args:
+        in_fn (str): The input filename.
+        seed_sequence (numpy.random.SeedSequence): The seed sequence of this file.
+        gaps (ndarray): The detector gaps, see :func:`get_geom_gaps`.
 
-def get_I(n_patterns, sampling_interval):
-    rng = np.random.default_rng()
+    Returns:
+        (PatternsSOne, ndarray): The sparse photon patterns and the fluence fluctuation
+        factors (`None` without `fluct_sample_interval`).
+    """
+    noise_seed, fluct_seed = seed_sequence.spawn(2)
+    data_dict = in_file_format_class.read(in_fn, **kwargs)
+    dd_in_dict = DiffractionData.from_dict(data_dict, "tmp")
+    # Scaling before Poissionization
+    arr = data_dict["img_array"]
+    if arr.dtype.kind in "biu" and (fluct_sample_interval or multiply is not None):
+        # Scale in float, the photons are rounded to integers at the end
+        arr = data_dict["img_array"] = arr.astype(np.float64)
+    intensity_scale = None
+    if fluct_sample_interval is not None:
+        rng = np.random.default_rng(fluct_seed)
+        intensity_scale, _ = get_I(len(arr), fluct_sample_interval, rng)
+        arr[:] = arr * intensity_scale[:, None, None]
+    if multiply is not None:
+        dd_in_dict.multiply(multiply)
+    if background is not None:
+        arr[:] += background
+    if poissonize:
+        dd_in_dict.poissonize(seed=noise_seed)
+    if stop_rad is not None:
+        dd_in_dict.add_beam_stop(stop_rad)
+    if gaps is not None:
+        arr[:, gaps] = -1
+    arr = arr.astype(np.int32).reshape(len(arr), -1)
+    return dense_to_PatternsSOne(arr), intensity_scale
+
+
+def _ordered_map(executor, func, *iterables, n_ahead=1):
+    """Like `executor.map`, but only keeps `n_ahead` tasks ahead of the consumer, so
+    that the results do not pile up in memory."""
+    futures = deque()
+    for args in zip(*iterables):
+        futures.append(executor.submit(func, *args))
+        if len(futures) > n_ahead:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def get_I(n_patterns, sampling_interval, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
     R = sampling_interval * np.sqrt(
         rng.random(
             n_patterns,
@@ -250,35 +520,103 @@ def get_I(n_patterns, sampling_interval):
     return I, R
 
 
-def addGaussianNoise(diffr_data, mu, sigs_popt):
+def addGaussianNoise(diffr_data, mu, sigs_popt, rng=None):
     """Add Gaussian noise to one diffraction pattern
 
     Args:
         diffr_data (ndarray): A diffraction pattern.
         mu (float): The average ADU for one photon.
         sigs_popt (list): [slop, intercept].
+        rng (numpy.random.Generator): The random generator, defaults to the global
+            `numpy.random` state.
     """
+    if rng is None:
+        rng = np.random
     sig_arr = linear(diffr_data, *sigs_popt)
-    diffr_noise = np.random.normal(diffr_data * mu, sig_arr)
+    diffr_noise = rng.normal(diffr_data * mu, sig_arr)
     return diffr_noise
 
 
-def get_geom_mask(geom, img_size):
+def get_geom_mask(geom, img_size, mask_file: str = None):
     """Get a 2D mask from a detector geom
 
     Args:
         geom (ExtraGeomDetectorGeometry): extra_geom instance.
         img_size ([nrow, ncol]): The array size of the output mask.
+        mask_file (str): An HDF5 file to persist the mask in, see :func:`get_geom_gaps`.
+
+    Returns:
+        ndarray: The mask, 1 for the detector pixels and NaN for the gaps.
     """
-    data = np.ones(geom.expected_data_shape)
-    mask, centre = geom.position_modules(data)
-    # Get the mask looking from beam upstream
-    mask = mask[::-1][::-1]
-    new_mask = rebin_sum(mask, img_size)
-    new_mask[~np.isnan(new_mask)] = 1
+    new_mask = np.ones(tuple(img_size))
+    new_mask[get_geom_gaps(geom, img_size, mask_file)] = np.nan
     return new_mask
 
 
+# The cached detector gaps, {(geom_fingerprint, img_size): gaps}
+_geom_gaps = {}
+_GEOM_GAPS_CACHE_SIZE = 8
+
+
+def get_geom_gaps(geom, img_size, mask_file: str = None):
+    """Get the detector gaps of a detector geom. The gaps are cached per geometry
+    fingerprint and `img_size`, hence read-only. If `mask_file` is given, they are also
+    persisted in it (under `geom_mask/`) and read back from it in later runs.
+
+    Args:
+        geom (ExtraGeomDetectorGeometry): extra_geom instance.
+        img_size ([nrow, ncol]): The array size of the output mask.
+        mask_file (str): An HDF5 file to persist the mask in.
+
+    Returns:
+        ndarray: The 2D boolean array, `True` for the gaps.
+    """
+    img_size = tuple(int(n) for n in img_size)
+    key = (get_geom_fingerprint(geom), img_size)
+    gaps = _geom_gaps.get(key)
+    if gaps is None and mask_file is not None:
+        gaps = readGeomGaps(mask_file, *key)
+    if gaps is None:
+        data = np.ones(geom.expected_data_shape, dtype=np.float32)
+        mask, centre = geom.position_modules(data)
+        # A binned pixel is a gap if any of its pixels is
+        gaps = rebin(np.isnan(mask), img_size, reducer="max")
+    if mask_file is not None:
+        writeGeomGaps(mask_file, *key, gaps)
+    if key not in _geom_gaps:
+        gaps.setflags(write=False)
+        if len(_geom_gaps) >= _GEOM_GAPS_CACHE_SIZE:
+            _geom_gaps.pop(next(iter(_geom_gaps)))
+        _geom_gaps[key] = gaps
+    return gaps
+
+
+def _geom_gaps_name(fingerprint, img_size):
+    return f"geom_mask/{fingerprint}_{img_size[0]}x{img_size[1]}"
+
+
+def readGeomGaps(filename, fingerprint, img_size):
+    """Read the detector gaps persisted by :func:`writeGeomGaps`, `None` if they are
+    not in the file."""
+    try:
+        with h5py.File(filename, "r") as h5:
+            name = _geom_gaps_name(fingerprint, img_size)
+            if name in h5:
+                return h5[name][()].astype(bool)
+    except OSError:
+        pass
+    return None
+
+
+def writeGeomGaps(filename, fingerprint, img_size, gaps):
+    """Persist the detector gaps of a geometry in an HDF5 file, if they are not yet there."""
+    with h5py.File(filename, "a") as h5:
+        name = _geom_gaps_name(fingerprint, img_size)
+        if name not in h5:
+            h5[name] = gaps
+            h5[name].attrs["Description"] = "Detector gaps (True) of the geometry"
+
+
 def get_radial_map(arr):
     """Get the radial map of a 2D array"""
     pmap = np.indices(arr.shape)
@@ -289,6 +627,16 @@ def get_radial_map(arr):
     return pixel_map
 
 
+def get_lazy_data_dict(diffraction_data):
+    """Get the data dict of a :class:`DiffractionData`. File mappings are read with
+    lazy=True, so `img_array` reads the patterns on demand."""
+    if diffraction_data.mapping_type == dict:
+        return diffraction_data.get_data()
+    kwargs = dict(diffraction_data.file_format_kwargs)
+    kwargs["lazy"] = True
+    return diffraction_data.file_format_class.read(diffraction_data.filename, **kwargs)
+
+
 def get_q(Rs, distance, wavelength):
     """Rs is a collection of the radial distance of pixels.
     distance is the sample to detector distance in pixel unit (distance = real_distance/pixel_size).
@@ -339,10 +687,22 @@ def R_d(pix_range, img, img_ref, sa_array):
 
 
 def get_rfactor(
-    img, img_ref, sa_array, pixel_map=None, bin_range=None, bin_size: float = 1.0
+    img,
+    img_ref,
+    sa_array,
+    pixel_map=None,
+    bin_range=None,
+    bin_size: float = 1.0,
+    chunk_size: int = None,
 ):
     """Get the residual factor between two reciprocal space volumes.
 
+    The R factor of each bin is :func:`R_d` of the pixels within the bin radius. The
+    pixels are sorted by radius once, so the pixels of each bin are a prefix of the
+    sorted pixels and all the bins of a chunk of frames are reduced in one pass with
+    cumulative sums, see :func:`_get_prefix_rfactors`. The frames are processed in
+    chunks to bound the memory usage.
+
     Args:
         img (ndarray): A 3D array (num_snapshot, ny, nx).
         img_ref (ndarray): A 3D reference array (num_snapshot, ny, nx).
@@ -350,6 +710,8 @@ def get_rfactor(
         pixel_map (ndarray): A 2D array defines the map the pixels, defaults to the array's indices.
         bin_range (float): The range of bins in the unit of the pixel map, defaults to cover the whole 2D pattern.
         bin_size (float): The pixel interval between two bins, defaults to 1.0.
+        chunk_size (int): The number of snapshots processed at once, defaults to about
+            4M pixels per chunk.
 
     Returns:
         (bins, R_factors): A tuple of the r factors and their corresponding radial pixel indices.
@@ -374,8 +736,94 @@ def get_rfactor(
         pass
 
     bins = np.arange(bin_range[0], bin_range[1] + bin_size, bin_size)
-    R_factors = []
-    for i in tqdm(bins):
-        pixel_range = np.ravel(pixel_map <= i)
-        R_factors.append(R_d(pixel_range, img, img_ref, sa_array))
-    return bins, np.array(R_factors)
+
+    # Sort the pixels by radius: the pixels of a bin are the first n_pix[i] ones
+    radii = np.ravel(pixel_map)
+    order = np.argsort(radii, kind="stable")
+    n_pix = np.searchsorted(radii[order], bins, side="right")
+    # Bins with the same pixels share the result
+    prefixes, bin_prefix = np.unique(n_pix, return_inverse=True)
+    order = order[: prefixes[-1]]
+    sa_sorted = np.ravel(sa_array)[order]
+    # The index of the first prefix including each pixel
+    pix_prefix = np.searchsorted(prefixes, np.arange(len(order)), side="right")
+
+    num_snapshot = len(img)
+    if chunk_size is None:
+        chunk_size = (1 << 22) // max(len(order), len(prefixes) * (len(prefixes) + 1))
+        chunk_size = max(1, chunk_size)
+    R_prefixes = np.zeros((len(prefixes), num_snapshot))
+    for start in tqdm(range(0, num_snapshot, chunk_size)):
+        sl = slice(start, start + chunk_size)
+        sqrt_N_real, sqrt_N_ideal = (
+            np.sqrt(_sort_pixels(arr[sl], order) / sa_sorted) for arr in [img, img_ref]
+        )
+        R_prefixes[:, sl] = _get_prefix_rfactors(
+            sqrt_N_real, sqrt_N_ideal, sa_sorted, prefixes, pix_prefix
+        ).T
+    return bins, R_prefixes[bin_prefix]
+
+
+def _get_prefix_rfactors(sqrt_N_real, sqrt_N_ideal, sa_sorted, prefixes, pix_prefix):
+    """Get the :func:`R_d` of each prefix of the sorted pixels in one pass.
+
+    With a = sqrt_N_real / N_d and b = sqrt_N_ideal / N_ideal_d in a prefix, both
+    sum(a * sa) and sum(b * sa) are 1, so R_d = sum(|a - b| * sa) = 2 * (Pa - Pb),
+    where Pa and Pb sum a * sa and b * sa over the pixels with a > b. A pixel has
+    a > b in the prefix k if u = sqrt_N_real / (sqrt_N_real + sqrt_N_ideal) of the
+    pixel is larger than v_k = N_d / (N_d + N_ideal_d) of the prefix, so the pixels
+    are histogrammed by (first prefix, rank of u among v_k) and Pa and Pb are
+    cumulative sums of the histograms.
+
+    Args:
+        sqrt_N_real (ndarray): (num_snapshot, num_pixels) sorted by radius.
+        sqrt_N_ideal (ndarray): (num_snapshot, num_pixels) sorted by radius.
+        sa_sorted (ndarray): The solid angles of the sorted pixels.
+        prefixes (ndarray): The increasing numbers of pixels of the prefixes.
+        pix_prefix (ndarray): The index of the first prefix including each pixel.
+
+    Returns:
+        ndarray: The (num_snapshot, num_prefixes) R factors.
+    """
+    num_snapshot, num_pixels = sqrt_N_real.shape
+    num_prefixes = len(prefixes)
+    weighted = [sqrt_N_real * sa_sorted, sqrt_N_ideal * sa_sorted]
+    ends = np.maximum(prefixes - 1, 0)
+    N_d, N_ideal_d = (np.cumsum(arr, axis=1)[:, ends] for arr in weighted)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        u = np.nan_to_num(sqrt_N_real / (sqrt_N_real + sqrt_N_ideal))
+        v = np.nan_to_num(N_d / (N_d + N_ideal_d))
+
+    # u and v are within [0, 1], the snapshots are offset by 2 to rank them at once
+    snapshots = np.arange(num_snapshot)[:, np.newaxis]
+    v_order = np.argsort(v, axis=1)
+    v_sorted = np.take_along_axis(v, v_order, axis=1) + 2.0 * snapshots
+    u_rank = np.searchsorted(v_sorted.ravel(), u + 2.0 * snapshots)
+    u_rank -= snapshots * num_prefixes
+    v_rank = np.empty_like(v_order)
+    np.put_along_axis(v_rank, v_order, np.arange(num_prefixes), axis=1)
+
+    num_ranks = num_prefixes + 1
+    index = (snapshots * num_prefixes + pix_prefix) * num_ranks + u_rank
+    P_ab = []
+    for arr in weighted:
+        hist = np.bincount(
+            index.ravel(),
+            weights=arr.ravel(),
+            minlength=num_snapshot * num_prefixes * num_ranks,
+        ).reshape(num_snapshot, num_prefixes, num_ranks)
+        # Sum up the pixels of the prefix k with a rank of u above the rank of v_k
+        hist = np.cumsum(hist, axis=1)
+        hist = np.cumsum(hist[:, :, ::-1], axis=2)[:, :, ::-1]
+        P_ab.append(hist[snapshots, np.arange(num_prefixes), v_rank + 1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        R_factors = 2 * (P_ab[0] / N_d - P_ab[1] / N_ideal_d)
+    R_factors[:, prefixes == 0] = 0
+    return R_factors
+
+
+def _sort_pixels(arr, order):
+    """Flatten the pixels of the (num_snapshot, ny, nx) array `arr`, sorted by `order`,
+    to a (num_snapshot, num_pixels) array"""
+    arr = np.asarray(arr, dtype=np.float64)
+    return arr.reshape(len(arr), -1)[:, order]
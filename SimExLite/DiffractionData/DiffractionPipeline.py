@@ -0,0 +1,273 @@
+# Copyright (C) 2023 Juncheng E
+# Contact: Juncheng E <juncheng.e@xfel.eu>
+# This file is part of SimEx-Lite which is released under GNU General Public License v3.
+# See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
+"""Chunked transform pipeline for DiffractionData"""
+
+import numpy as np
+from tqdm.autonotebook import tqdm
+from SimExLite.utils import rebin
+from .BufferManager import get_buffer_manager
+from .DiffractionData import (
+    addGaussianNoise,
+    get_beam_center,
+    get_beam_stop_mask,
+    get_chunk_generator,
+    get_geom_gaps,
+    get_lazy_data_dict,
+)
+
+
+class DiffractionPipeline:
+    """A chain of transforms applied to the diffraction patterns of a
+    :class:`DiffractionData` in one chunked pass. The patterns are read chunk by chunk
+    (lazily if the data maps a file), all the transforms are applied to the chunk, and
+    the chunk is written to the output before the next one is read, so the peak memory
+    is bounded by one chunk.
+
+    The transforms are computed in float64, use :meth:`astype` to set the output dtype.
+    It is usually created by :meth:`DiffractionData.pipeline`:
+
+    .. code-block:: python
+
+       dd.pipeline().scale(1e3).poissonize(seed=0).beam_stop(10).mask(geom).run(
+           chunk_size=1000, filename="photons.h5", format_class=EMCFormat
+       )
+
+    Args:
+        diffraction_data (DiffractionData): The input data.
+    """
+
+    def __init__(self, diffraction_data):
+        self._data = diffraction_data
+        self._steps = []
+
+    def __len__(self):
+        return len(self._steps)
+
+    def _add_step(self, func):
+        self._steps.append(func)
+        return self
+
+    def scale(self, val):
+        """Multiply the patterns by `val`.
+
+        Args:
+            val (float or ndarray): A number, a 1D array of one value per pattern or a
+                2D array of one value per pixel.
+        """
+        val = np.asarray(val)
+
+        def step(chunk, sl, i_chunk):
+            chunk *= _per_pattern(val, sl)
+            return chunk
+
+        return self._add_step(step)
+
+    def add(self, val):
+        """Add `val`, e.g. a background, to the patterns.
+
+        Args:
+            val (float or ndarray): A number, a 1D array of one value per pattern or a
+                2D array of one value per pixel.
+        """
+        val = np.asarray(val)
+
+        def step(chunk, sl, i_chunk):
+            chunk += _per_pattern(val, sl)
+            return chunk
+
+        return self._add_step(step)
+
+    def poissonize(self, seed=None):
+        """Replace the pattern intensities by Poisson samples.
+
+        Args:
+            seed (int): The seed of the random numbers.
+        """
+        seed_sequence = np.random.SeedSequence(seed)
+
+        def step(chunk, sl, i_chunk):
+            rng = get_chunk_generator(seed_sequence, i_chunk)
+            return rng.poisson(chunk).astype(chunk.dtype, copy=False)
+
+        return self._add_step(step)
+
+    def gaussian_noise(self, mu, sigs_popt, seed=None):
+        """Add Gaussian noise, see :func:`addGaussianNoise`.
+
+        Args:
+            mu (float): The average ADU for one photon.
+            sigs_popt (list): [slop, intercept].
+            seed (int): The seed of the random numbers.
+        """
+        seed_sequence = np.random.SeedSequence(seed)
+
+        def step(chunk, sl, i_chunk):
+            rng = get_chunk_generator(seed_sequence, i_chunk)
+            return addGaussianNoise(chunk, mu, sigs_popt, rng)
+
+        return self._add_step(step)
+
+    def beam_stop(self, stop_rad: float, center=None, geom_center: bool = False):
+        """Set the pixels inside the beam stop to 0, see
+        :meth:`DiffractionData.add_beam_stop`.
+
+        Args:
+            stop_rad (float): The radius of the beamstop in pixel unit.
+            center (tuple): The (row, col) pixel of the beam center, defaults to the
+                center of the pattern.
+            geom_center (bool): Whether to take the beam center from the geometry of the
+                data. It overrides `center`.
+        """
+        centers = {}
+
+        def step(chunk, sl, i_chunk):
+            shape = chunk.shape[1:]
+            if shape not in centers:
+                centers[shape] = center
+                if geom_center:
+                    centers[shape] = get_beam_center(self._geom, shape)
+            chunk[:, get_beam_stop_mask(shape, stop_rad, centers[shape])] = 0
+            return chunk
+
+        return self._add_step(step)
+
+    def mask(self, geom=None, mask_file: str = None):
+        """Fill the detector gaps of an extra_geom geometry with -1, see
+        :meth:`DiffractionData.apply_geom_mask`.
+
+        Args:
+            geom (ExtraGeomDetectorGeometry): extra_geom instance, defaults to the
+                geometry of the data.
+            mask_file (str): An HDF5 file to persist the mask in.
+        """
+        gaps = {}
+
+        def step(chunk, sl, i_chunk):
+            shape = chunk.shape[1:]
+            if shape not in gaps:
+                gaps[shape] = get_geom_gaps(geom or self._geom, shape, mask_file)
+            chunk[:, gaps[shape]] = -1
+            return chunk
+
+        return self._add_step(step)
+
+    def rebin(
+        self,
+        new_shape=None,
+        factor=None,
+        reducer: str = "sum",
+        remainder: str = "crop",
+        nan_aware: bool = False,
+    ):
+        """Downsample the patterns, e.g. for previews or EMC input, see
+        :func:`SimExLite.utils.rebin`.
+
+        Args:
+            new_shape ([nrow, ncol]): The binned pattern shape.
+            factor (int or tuple): The bin size, instead of `new_shape`.
+            reducer (str): How to reduce a bin, 'sum', 'mean' or 'max'.
+            remainder (str): 'crop', 'merge' or 'pad' the remainder pixels.
+            nan_aware (bool): Whether to ignore NaN.
+        """
+
+        def step(chunk, sl, i_chunk):
+            return rebin(chunk, new_shape, factor, reducer, remainder, nan_aware)
+
+        return self._add_step(step)
+
+    def astype(self, dtype):
+        """Cast the patterns to `dtype`."""
+
+        def step(chunk, sl, i_chunk):
+            return chunk.astype(dtype)
+
+        return self._add_step(step)
+
+    def apply(self, func):
+        """Apply a custom function to each chunk.
+
+        Args:
+            func (callable): A function taking a chunk of patterns (n, py, px) and
+                returning the transformed chunk.
+        """
+
+        def step(chunk, sl, i_chunk):
+            return func(chunk)
+
+        return self._add_step(step)
+
+    def run(
+        self,
+        chunk_size: int = 1000,
+        filename: str = None,
+        format_class=None,
+        key: str = None,
+        **kwargs,
+    ):
+        """Run the pipeline.
+
+        Args:
+            chunk_size (int): The number of patterns processed at once.
+            filename (str): The output filename. If it's `None`, the output is kept in
+                an array allocated by the shared :class:`BufferManager`.
+            format_class: The output format class, it has to provide `open_stream_writer`.
+            key (str): The key of the output data.
+            kwargs: Extra keywords passed to `format_class.open_stream_writer`.
+
+        Returns:
+            DiffractionData: The output data, mapping either a dict or the output file.
+        """
+        data_dict = get_lazy_data_dict(self._data)
+        source = data_dict["img_array"]
+        self._geom = data_dict["geom"]
+        n_patterns = len(source)
+        n_chunks = int(np.ceil(float(n_patterns) / chunk_size))
+        if filename is not None and not hasattr(format_class, "open_stream_writer"):
+            raise TypeError(f"{format_class} does not support stream writing.")
+        if key is None:
+            key = self._data.key + "_pipeline"
+
+        print(f"Operation in {n_chunks} chunks", flush=True)
+        out = None
+        writer = None
+        try:
+            for i_chunk in tqdm(range(n_chunks)):
+                sl = slice(i_chunk * chunk_size, (i_chunk + 1) * chunk_size)
+                chunk = np.array(source[sl], dtype=np.float64)
+                for step in self._steps:
+                    chunk = step(chunk, sl, i_chunk)
+                if filename is None:
+                    if out is None:
+                        out = get_buffer_manager().allocate(
+                            (n_patterns,) + chunk.shape[1:], chunk.dtype
+                        )
+                    out[sl] = chunk
+                else:
+                    if writer is None:
+                        writer = format_class.open_stream_writer(
+                            filename,
+                            data_dict,
+                            n_patterns,
+                            chunk.shape[1:],
+                            chunk.dtype,
+                            **kwargs,
+                        )
+                    writer.write(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if filename is None:
+            out_dict = dict(data_dict)
+            out_dict["img_array"] = out
+            return self._data.from_dict(out_dict, key)
+        return self._data.from_file(filename, format_class, key, **writer.read_kwargs)
+
+
+def _per_pattern(val, sl):
+    """Get the operand of a chunk: per-pattern 1D arrays are sliced and broadcast."""
+    if val.ndim == 1:
+        return val[sl][:, np.newaxis, np.newaxis]
+    return val
@@ -1,13 +1,24 @@
+from functools import partial
 import h5py
 import numpy as np
 import os
+import shutil
+import time
 from pathlib import Path
 from tqdm.autonotebook import tqdm
 from scipy.sparse import csr_matrix
 from libpyvinyl.BaseFormat import BaseFormat
 from . import writeemc, DetectorEMC
+from .BufferManager import get_buffer_manager
+from .LazyPatternArray import LazyPatternArray
 from SimExLite.utils.io import parseIndex
 from SimExLite.utils.io import UnknownFileTypeError
+from SimExLite.utils.cache import (
+    get_cache_path,
+    get_params_hash,
+    use_cache,
+    write_cache_file,
+)
 
 
 class EMCFormat(BaseFormat):
@@ -21,8 +32,8 @@ class EMCFormat(BaseFormat):
         key = "EMC"
         description = "EMC photon format for DiffractionData"
         file_extension = [".h5", ".emc"]
-        read_kwargs = ["index", "pattern_shape"]
-        write_kwargs = [""]
+        read_kwargs = ["index", "pattern_shape", "dtype", "lazy", "sparse"]
+        write_kwargs = ["flat"]
         return self._create_format_register(
             key, description, file_extension, read_kwargs, write_kwargs
         )
@@ -32,11 +43,42 @@ class EMCFormat(BaseFormat):
         # Assume the format can be converted directly to the formats supported by these classes:
         # AFormat, BFormat
         # Redefine this `direct_convert_formats` for a concrete format class
-        return []
+        return [EMCFormat]
 
     @classmethod
-    def read(cls, filename: str, index=None, pattern_shape=None) -> dict:
-        """Read diffraction patterns into an array from a file."""
+    def convert(
+        cls, obj, output: str, output_format_class, key: str = None, flat=False, **kwargs
+    ):
+        """Direct convert method between the EMC binary and HDF5 layouts, see
+        :func:`convertEMC`. The layout is chosen by the extension of `output`."""
+        if output_format_class is not EMCFormat:
+            raise TypeError(
+                "Direct converting to format {} is not supported".format(
+                    output_format_class
+                )
+            )
+        read_kwargs = dict(obj.file_format_kwargs)
+        convertEMC(obj.filename, output, index=read_kwargs.pop("index", None), flat=flat)
+        if key is None:
+            original_key = obj.key
+            key = original_key + "_to_EMCFormat"
+        return obj.from_file(output, output_format_class, key, **read_kwargs)
+
+    @classmethod
+    def read(
+        cls,
+        filename: str,
+        index=None,
+        pattern_shape=None,
+        dtype=None,
+        lazy=False,
+        sparse=False,
+    ) -> dict:
+        """Read diffraction patterns into an array from a file. The patterns are read in
+        `dtype`, which defaults to the photon count dtype in the file (int32). If
+        lazy=True, `img_array` is a :class:`LazyPatternArray` reading the patterns on
+        demand. If sparse=True, `img_array` is a :class:`SparsePatternArray` keeping the
+        patterns in the sparse form."""
         data_dict = {}
 
         if pattern_shape is None:
@@ -46,26 +88,31 @@ class EMCFormat(BaseFormat):
             )
 
         index = parseIndex(index)
-        arr_size = len(np.arange(getPatternTotal(filename))[index])
-        if isEMCH5(filename):
-            ireadPattern = ireadPattern_h5
-            # Flush to print it before tqdm
-            print("Reading EMC h5 data...", flush=True)
-        elif isEMCBinary(filename):
-            ireadPattern = ireadPattern_binary
-            # Flush to print it before tqdm
-            print("Reading EMC binary data...", flush=True)
-        else:
-            raise UnknownFileTypeError(
-                "This is not an EMC file, please provide the correct file type."
-            )
-
-        arr = np.zeros((arr_size, pattern_shape[0], pattern_shape[1]))
-        # if isinstance(index, (slice, str)):
-        with tqdm(total=arr_size) as progress_bar:
-            for i, pattern in enumerate(ireadPattern(filename, index, pattern_shape)):
-                arr[i] = pattern
-                progress_bar.update(1)  # update progress
+        with openEMCReader(filename) as reader:
+            indices = np.arange(len(reader))[index]
+            if dtype is None:
+                dtype = reader.dtype
+            if sparse:
+                from .SparsePatternArray import SparsePatternArray
+
+                arr = SparsePatternArray(reader[indices], pattern_shape, dtype)
+            elif lazy:
+                arr = LazyPatternArray(
+                    partial(
+                        readFrames, filename, pattern_shape=pattern_shape, dtype=dtype
+                    ),
+                    indices,
+                    pattern_shape,
+                    dtype,
+                )
+            else:
+                # Flush to print it before tqdm
+                file_type = "h5" if isinstance(reader, EMCH5Reader) else "binary"
+                print(f"Reading EMC {file_type} data...", flush=True)
+                arr = get_buffer_manager().allocate(
+                    (len(indices), pattern_shape[0], pattern_shape[1]), dtype
+                )
+                reader.read_into(indices, arr)
 
         data_dict["img_array"] = arr
         # There is no quaternion in EMC pattern (?)
@@ -85,20 +132,257 @@ class EMCFormat(BaseFormat):
         return data_dict
 
     @classmethod
-    def write(cls, object, filename: str, key: str = None):
-        """Save the data with the `filename`."""
+    def write(cls, object, filename: str, key: str = None, flat: bool = False):
+        """Save the data with the `filename`. With flat=True, the HDF5 file is written
+        in the flat layout, see :class:`writeemc.EMCWriter`."""
         data_dict = object.get_data()
         arr = data_dict["img_array"]
         img_shape = arr[0].shape
-        emcwriter = writeemc.EMCWriter(filename, arr[0].shape[0] * arr[0].shape[1])
-        for photons in tqdm(arr):
-            emcwriter.write_frame(photons.astype(np.int32).ravel())
+        emcwriter = writeemc.EMCWriter(
+            filename, arr[0].shape[0] * arr[0].shape[1], flat=flat
+        )
+        chunk_size = emcwriter.buffer_size
+        for start in tqdm(range(0, len(arr), chunk_size)):
+            chunk = np.asarray(arr[start : start + chunk_size], dtype=np.int32)
+            emcwriter.write_frames(chunk)
         emcwriter.finish_write()
         if key is None:
             original_key = object.key
             key = original_key + "_to_EMCFormat"
         return object.from_file(filename, cls, key, pattern_shape=img_shape)
 
+    @classmethod
+    def open_stream_writer(
+        cls,
+        filename: str,
+        data_dict: dict,
+        n_patterns: int,
+        pattern_shape,
+        dtype=None,
+        flat: bool = False,
+    ):
+        """Open an :class:`EMCStreamWriter` to write patterns chunk by chunk."""
+        return EMCStreamWriter(filename, pattern_shape, flat)
+
+
+class EMCStreamWriter:
+    """Write dense photon count patterns chunk by chunk in the EMC photon format.
+
+    Args:
+        filename (str): Output filename.
+        pattern_shape (tuple): The shape of one pattern.
+        flat (bool): Whether to write the HDF5 file in the flat layout.
+    """
+
+    def __init__(self, filename, pattern_shape, flat=False):
+        self.pattern_shape = tuple(pattern_shape)
+        self._emcwriter = writeemc.EMCWriter(
+            filename, int(np.prod(pattern_shape)), flat=flat
+        )
+        # The keywords to read the file back
+        self.read_kwargs = {"pattern_shape": self.pattern_shape}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, val, traceback):
+        self.close()
+
+    def write(self, arr):
+        """Append the patterns in `arr`"""
+        self._emcwriter.write_frames(np.asarray(arr).astype(np.int32))
+
+    def close(self):
+        self._emcwriter.finish_write()
+
+
+def convertEMC(
+    in_fn: str,
+    out_fn: str,
+    index=None,
+    hdf5: bool = None,
+    flat: bool = False,
+    chunk_size: int = 10000,
+):
+    """Convert an EMC photon file between the binary and the HDF5 (vlen or flat)
+    layouts without densifying the patterns. The sparse entries are streamed chunk by
+    chunk, so the memory usage is bounded by `chunk_size` patterns and files larger
+    than the memory can be converted.
+
+    Args:
+        in_fn (str): The input EMC HDF5 or binary filename.
+        out_fn (str): The output filename.
+        index: The patterns to convert, defaults to all the patterns.
+        hdf5 (bool): Whether to write an HDF5 file, defaults to False for a `.emc`
+            output and True otherwise.
+        flat (bool): Whether to write the HDF5 file in the flat layout.
+        chunk_size (int): The number of patterns converted at once.
+
+    Returns:
+        dict: The number of converted patterns (`num_data`), the elapsed `time` in
+        seconds, and the throughput in patterns/s (`patterns_per_s`) and in MB/s of
+        the sparse entries (`MB_per_s`).
+    """
+    _checkOutput([in_fn], out_fn)
+    with openEMCReader(in_fn) as reader:
+        indices = np.arange(len(reader))[parseIndex(index)]
+        return _writeEMCChunks(
+            out_fn,
+            reader.num_pix,
+            _iterChunks(reader, indices, chunk_size),
+            hdf5,
+            flat,
+            chunk_size,
+        )
+
+
+def subsetEMC(in_fn: str, out_fn: str, indices, **kwargs):
+    """Extract the patterns of `indices`, in their order, from an EMC photon file into
+    a new one. Only the entries of the selected patterns are read, so the cost is
+    proportional to their photons. It replaces selecting patterns with
+    :func:`write_emc_balcklist` when a smaller file is wanted.
+
+    Args:
+        in_fn (str): The input EMC HDF5 or binary filename.
+        out_fn (str): The output filename.
+        indices: The indices, slice or boolean mask of the patterns to extract.
+        kwargs: `hdf5`, `flat` and `chunk_size`, see :func:`convertEMC`.
+
+    Returns:
+        dict: The statistics, see :func:`convertEMC`.
+    """
+    return convertEMC(in_fn, out_fn, index=indices, **kwargs)
+
+
+def splitEMC(
+    in_fn: str,
+    out_fns: list,
+    ranges: list = None,
+    hdf5: bool = None,
+    flat: bool = False,
+    chunk_size: int = 10000,
+):
+    """Split an EMC photon file into several files by pattern ranges.
+
+    Args:
+        in_fn (str): The input EMC HDF5 or binary filename.
+        out_fns (list): The output filenames, one for each range.
+        ranges (list): The (start, stop) pattern range of each output file. Defaults
+            to consecutive ranges of (nearly) equal sizes covering all the patterns.
+        hdf5 (bool): Whether to write HDF5 files, see :func:`convertEMC`.
+        flat (bool): Whether to write the HDF5 files in the flat layout.
+        chunk_size (int): The number of patterns copied at once.
+
+    Returns:
+        list: The statistics of each output file, see :func:`convertEMC`.
+    """
+    _checkOutput([in_fn], *out_fns)
+    if ranges is not None and len(ranges) != len(out_fns):
+        raise ValueError("ranges and out_fns should have equal lengths.")
+    stats = []
+    with openEMCReader(in_fn) as reader:
+        if ranges is None:
+            bounds = np.linspace(0, len(reader), len(out_fns) + 1).astype(int)
+            ranges = zip(bounds[:-1], bounds[1:])
+        for out_fn, (start, stop) in zip(out_fns, ranges):
+            indices = np.arange(len(reader))[start:stop]
+            stats.append(
+                _writeEMCChunks(
+                    out_fn,
+                    reader.num_pix,
+                    _iterChunks(reader, indices, chunk_size),
+                    hdf5,
+                    flat,
+                    chunk_size,
+                )
+            )
+    return stats
+
+
+def concatenateEMC(
+    in_fns: list,
+    out_fn: str,
+    hdf5: bool = None,
+    flat: bool = False,
+    chunk_size: int = 10000,
+):
+    """Concatenate EMC photon files of the same detector, binary or HDF5 in any mix,
+    into one file.
+
+    Args:
+        in_fns (list): The input EMC HDF5 or binary filenames.
+        out_fn (str): The output filename.
+        hdf5 (bool): Whether to write an HDF5 file, see :func:`convertEMC`.
+        flat (bool): Whether to write the HDF5 file in the flat layout.
+        chunk_size (int): The number of patterns copied at once.
+
+    Returns:
+        dict: The statistics, see :func:`convertEMC`.
+    """
+    _checkOutput(in_fns, out_fn)
+    readers = [openEMCReader(fn) for fn in in_fns]
+    try:
+        num_pix = {reader.num_pix for reader in readers}
+        if len(num_pix) != 1:
+            raise ValueError(f"The files have different numbers of pixels: {num_pix}")
+
+        def iter_all():
+            for reader in readers:
+                for patterns in _iterChunks(reader, np.arange(len(reader)), chunk_size):
+                    yield patterns
+
+        return _writeEMCChunks(out_fn, num_pix.pop(), iter_all(), hdf5, flat, chunk_size)
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def _checkOutput(in_fns, *out_fns):
+    """Check that no output file overwrites an input file or another output file"""
+    in_paths = {os.path.abspath(fn) for fn in in_fns}
+    out_paths = [os.path.abspath(fn) for fn in out_fns]
+    if in_paths.intersection(out_paths):
+        raise ValueError("The input and output files must be different.")
+    if len(set(out_paths)) != len(out_paths):
+        raise ValueError("The output files must be different.")
+
+
+def _iterChunks(reader, indices, chunk_size):
+    """Iterate over the patterns of `indices` in :class:`PatternsSOne` chunks"""
+    for start in range(0, len(indices), chunk_size):
+        yield reader[indices[start : start + chunk_size]]
+
+
+def _writeEMCChunks(out_fn, num_pix, chunks, hdf5, flat, chunk_size):
+    """Write the :class:`PatternsSOne` chunks into `out_fn` and report the throughput"""
+    if hdf5 is None:
+        hdf5 = os.path.splitext(out_fn)[1] != ".emc"
+
+    t_start = time.perf_counter()
+    num_data = 0
+    nbytes = 0
+    with writeemc.EMCWriter(
+        out_fn, num_pix, hdf5=hdf5, buffer_size=chunk_size, flat=flat
+    ) as emcwriter:
+        for patterns in tqdm(chunks):
+            arrs = [patterns.attrs(g) for g in PatternsSOne.ATTRS]
+            num_data += patterns.num_data
+            nbytes += sum(4 * len(arr) for arr in arrs)
+            emcwriter.write_sparse_frames(*arrs)
+    elapsed = time.perf_counter() - t_start
+
+    stats = {
+        "num_data": num_data,
+        "time": elapsed,
+        "patterns_per_s": num_data / elapsed,
+        "MB_per_s": nbytes / 1e6 / elapsed,
+    }
+    print(
+        "Wrote {num_data} patterns in {time:.2f} s "
+        "({patterns_per_s:.0f} patterns/s, {MB_per_s:.1f} MB/s)".format(**stats)
+    )
+    return stats
+
 
 def isEMCH5(fn):
     """If the data is a EMC HDF5 file"""
@@ -117,26 +401,58 @@ def isEMCH5(fn):
 def ireadPattern_h5(filename, index=None, pattern_shape=None):
     """Iterator for reading diffraction patterns from a file."""
     index = parseIndex(index)
-    pattern_total = getPatternTotal(filename)
-    indices = np.arange(pattern_total)[index]
-    for i in indices:
-        yield getFrameArray(filename, i).reshape(pattern_shape)
+    with EMCH5Reader(filename) as reader:
+        indices = np.arange(len(reader))[index]
+        for i in indices:
+            yield reader.read_dense(int(i), pattern_shape)
 
 
 # Essential
 def ireadPattern_binary(filename, index=None, pattern_shape=None):
     """Iterator for reading diffraction patterns from a file."""
     index = parseIndex(index)
-    pattern_total = getPatternTotal(filename)
-    indices = np.arange(pattern_total)[index]
-    for i in indices:
-        yield getFrameArrayBinary(filename, i).reshape(pattern_shape)
+    with EMCBinaryReader(filename) as reader:
+        indices = np.arange(len(reader))[index]
+        for i in indices:
+            yield reader.read_dense(int(i), pattern_shape)
+
+
+def readPatterns(filename, indices, out, chunk_size: int = 1000, progress=True):
+    """Read the diffraction patterns of `indices` into the zero-filled array `out`."""
+    with openEMCReader(filename) as reader:
+        return reader.read_into(indices, out, chunk_size, progress)
+
+
+def readFrames(filename, indices, pattern_shape, dtype=None):
+    """Read the diffraction patterns of `indices` into a new array."""
+    if dtype is None:
+        dtype = getPatternDtype(filename)
+    out = np.zeros((len(indices),) + tuple(pattern_shape), dtype=dtype)
+    return readPatterns(filename, indices, out, progress=False)
+
+
+def isFlatH5(h5) -> bool:
+    """If an opened EMC HDF5 file is in the flat layout of :class:`writeemc.EMCWriter`"""
+    return "ones" in h5 and h5py.check_vlen_dtype(h5["place_ones"].dtype) is None
+
+
+def getPatternDtype(filename):
+    """The dtype of the photon counts in the EMC photon file"""
+    if isEMCH5(filename):
+        with h5py.File(filename, "r") as h5:
+            if isFlatH5(h5):
+                return h5["count_multi"].dtype
+            return h5py.check_vlen_dtype(h5["count_multi"].dtype)
+    else:
+        return np.dtype("i4")
 
 
 def getPatternTotal(filename):
     """The total number of diffraction patterns in the EMC photon file"""
     if isEMCH5(filename):
         with h5py.File(filename, "r") as h5:
+            if isFlatH5(h5):
+                return len(h5["ones"])
             npattern = len(h5["count_multi"])
         return npattern
     else:
@@ -271,11 +587,14 @@ def dense_to_PatternsSOne(arr: np.ndarray) -> PatternsSOne:
     )
 
 
-def parse_bin_PatternsSOne(fn: str):
-    """Parse a EMC sparse binary file
+def parse_bin_PatternsSOne(fn: str, start: int = None, end: int = None):
+    """Parse a EMC sparse binary file. Only the header and the entries of the patterns
+    [start, end) are read, the others are skipped.
 
     Args:
         fn (str): The name of the sparse binary file
+        start (int): The first pattern to read, defaults to the first pattern
+        end (int): The pattern to stop before, defaults to the end of the file
 
     Returns:
         PatternsSOne: EMC photon sparse data
@@ -283,11 +602,12 @@ def parse_bin_PatternsSOne(fn: str):
     path = Path(fn)
     with path.open("rb") as fin:
         num_data = np.fromfile(fin, dtype=np.int32, count=1)[0]
-        start, end = 0, num_data
+        start, end, _ = slice(start, end).indices(num_data)
+        end = max(start, end)
         num_pix = np.fromfile(fin, dtype=np.int32, count=1)[0]
         fin.seek(1024)
-        ones = np.fromfile(fin, dtype=np.int32, count=num_data)
-        multi = np.fromfile(fin, dtype=np.int32, count=num_data)
+        ones = np.fromfile(fin, dtype=np.int32, count=num_data).astype(np.int64)
+        multi = np.fromfile(fin, dtype=np.int32, count=num_data).astype(np.int64)
         fin.seek(4 * ones[:start].sum(), os.SEEK_CUR)
         place_ones = np.fromfile(fin, dtype=np.int32, count=ones[start:end].sum())
         fin.seek(4 * (ones[end:].sum() + multi[:start].sum()), os.SEEK_CUR)
@@ -296,10 +616,14 @@ def parse_bin_PatternsSOne(fn: str):
         fin.seek(4 * (multi[end:].sum() + multi[:start].sum()), os.SEEK_CUR)
         count_multi = np.fromfile(fin, dtype=np.int32, count=sum_multi)
         fin.seek(4 * multi[end:].sum(), os.SEEK_CUR)
-        if fin.read(1):
+        if (
+            len(place_ones) != ones[start:end].sum()
+            or len(count_multi) != sum_multi
+            or fin.read(1)
+        ):
             raise Exception(f"Error when parsing {fn}")
-    ones = ones[start:end]
-    multi = multi[start:end]
+    ones = ones[start:end].astype(np.int32)
+    multi = multi[start:end].astype(np.int32)
     return PatternsSOne(
         num_pix,
         ones,
@@ -310,9 +634,61 @@ def parse_bin_PatternsSOne(fn: str):
     )
 
 
+class PatternsSOneWriter:
+    """Write :class:`PatternsSOne` batches into an EMC sparse binary file without
+    keeping them in memory. The entries are appended to temporary section files next
+    to the output file, which are stitched after the header at :meth:`close`.
+
+    .. code-block:: python
+
+       with PatternsSOneWriter("photons.emc", num_pix) as writer:
+           for patterns in batches:
+               writer.write(patterns)
+
+    Args:
+        path (str): The name of the sparse binary file
+        num_pix (int): Number of pixels per pattern
+        buffer_size (int): Number of patterns buffered before they are appended to the
+            section files
+    """
+
+    def __init__(self, path, num_pix: int, buffer_size: int = 1000):
+        self.num_pix = int(num_pix)
+        self._emcwriter = writeemc.EMCWriter(
+            str(path), self.num_pix, hdf5=False, buffer_size=buffer_size
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, val, traceback):
+        self.close()
+
+    @property
+    def num_data(self) -> int:
+        """The number of patterns written so far"""
+        return self._emcwriter.num_data
+
+    def write(self, patterns: PatternsSOne) -> None:
+        """Append the patterns"""
+        if patterns.num_pix != self.num_pix:
+            raise ValueError(
+                f"The patterns have {patterns.num_pix} pixels, expected {self.num_pix}."
+            )
+        self._emcwriter.write_sparse_frames(
+            *[patterns.attrs(g) for g in PatternsSOne.ATTRS]
+        )
+
+    def close(self) -> None:
+        """Write the header and stitch the sections into the output file"""
+        self._emcwriter.finish_write()
+
+
 def readH5frame(fname, frame_num):
     with h5py.File(fname, "r") as fptr:
         num_pix = fptr["num_pix"][()][0]
+        if isFlatH5(fptr):
+            return (num_pix,) + _readFlatH5frame(fptr, frame_num)
         place_ones = fptr["place_ones"][frame_num]
         place_multi = fptr["place_multi"][frame_num]
         count_multi = fptr["count_multi"][frame_num]
@@ -321,6 +697,19 @@ def readH5frame(fname, frame_num):
     return num_pix, ones, multi, place_ones, place_multi, count_multi
 
 
+def _readFlatH5frame(fptr, frame_num):
+    ones = fptr["ones"][()]
+    multi = fptr["multi"][()]
+    one_start = ones[:frame_num].sum()
+    multi_start = multi[:frame_num].sum()
+    ones_slice = slice(one_start, one_start + ones[frame_num])
+    multi_slice = slice(multi_start, multi_start + multi[frame_num])
+    place_ones = fptr["place_ones"][ones_slice]
+    place_multi = fptr["place_multi"][multi_slice]
+    count_multi = fptr["count_multi"][multi_slice]
+    return ones[[frame_num]], multi[[frame_num]], place_ones, place_multi, count_multi
+
+
 def readBinaryframe(fname, frame_num):
     pdict = parse_binaryheader(fname)
     num_pix = pdict["num_pix"]
@@ -396,6 +785,244 @@ def parse_binaryheader(fname):
     return pdict
 
 
+class EMCReaderBase:
+    """Random access to the frames of an EMC photon file. The subclasses implement
+    `_read_range`, which reads a contiguous range of frames at once.
+
+    Indexing a reader returns the frames as :class:`PatternsSOne`, e.g. ``reader[10]``,
+    ``reader[100:200]`` or ``reader[[3, 1, 4]]``. :meth:`read_dense` scatters them
+    into a dense array.
+    """
+
+    def __init__(self, num_pix: int, num_data: int, dtype="i4"):
+        self.num_pix = int(num_pix)
+        self.num_data = int(num_data)
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return self.num_data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, val, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def __getitem__(self, index) -> PatternsSOne:
+        if isinstance(index, (int, np.integer)):
+            index = np.arange(self.num_data)[index]
+            return PatternsSOne(self.num_pix, *self._read_range(index, index + 1))
+        if isinstance(index, slice) and index.step in (None, 1):
+            start, stop, _ = index.indices(self.num_data)
+            return PatternsSOne(self.num_pix, *self._read_range(start, max(start, stop)))
+        indices = np.arange(self.num_data)[index]
+        if len(indices) == 0:
+            return PatternsSOne(self.num_pix, *self._read_range(0, 0))
+        return PatternsSOne(self.num_pix, *self._read_indices(indices))
+
+    def _read_indices(self, indices):
+        """Read (ones, multi, place_ones, place_multi, count_multi) of the frames of
+        the non-empty `indices`"""
+        # Read each run of consecutive frames at once
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        starts = indices[np.r_[0, breaks]]
+        stops = indices[np.r_[breaks - 1, len(indices) - 1]] + 1
+        runs = [self._read_range(start, stop) for start, stop in zip(starts, stops)]
+        return tuple(np.concatenate(arrs) for arrs in zip(*runs))
+
+    def _read_range(self, start, stop):
+        """Read (ones, multi, place_ones, place_multi, count_multi) of the frames
+        [start, stop)"""
+        raise NotImplementedError
+
+    def read_dense(self, index=None, pattern_shape=None, dtype=None, out=None):
+        """Read the frames of `index` as a dense array.
+
+        Args:
+            index: The frame index, slice or indices, defaults to all the frames.
+            pattern_shape (tuple): The shape of one pattern, defaults to (num_pix,).
+            dtype (numpy.dtype): The dtype of the output, defaults to :attr:`dtype`.
+            out (ndarray): The output array, it has to be zero-filled.
+
+        Returns:
+            ndarray: The dense frames.
+        """
+        single = isinstance(index, (int, np.integer))
+        if not single:
+            index = parseIndex(index)
+        patterns = self[index]
+        if pattern_shape is None:
+            pattern_shape = (self.num_pix,)
+        if dtype is None:
+            dtype = self.dtype
+        if out is None:
+            out = np.zeros((patterns.num_data,) + tuple(pattern_shape), dtype=dtype)
+        scatterPatternsSOne(patterns, out.reshape(patterns.num_data, self.num_pix))
+        if single:
+            return out[0]
+        return out
+
+    def read_into(self, indices, out, chunk_size: int = 1000, progress=True):
+        """Read the frames of `indices` chunk by chunk into the zero-filled array `out`."""
+        for start in tqdm(range(0, len(indices), chunk_size), disable=not progress):
+            sl = slice(start, start + chunk_size)
+            self.read_dense(indices[sl], out=out[sl])
+        return out
+
+
+class EMCBinaryReader(EMCReaderBase):
+    """Random access reader of EMC binary photon files. The header is parsed once and
+    the file is memory-mapped, so the frames of an integer or a slice index are
+    zero-copy views into the file. Fancy indices are gathered into new arrays.
+
+    Args:
+        filename (str): The EMC binary filename.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._mmap = np.memmap(filename, dtype="i4", mode="r")
+        num_data, num_pix = (int(n) for n in self._mmap[:2])
+        super().__init__(num_pix, num_data, "i4")
+        offset = 256
+        self._ones = self._mmap[offset : offset + num_data]
+        offset += num_data
+        self._multi = self._mmap[offset : offset + num_data]
+        offset += num_data
+        self._ones_idx = _get_offsets(self._ones)
+        self._multi_idx = _get_offsets(self._multi)
+        self._place_ones = self._mmap[offset : offset + self._ones_idx[-1]]
+        offset += self._ones_idx[-1]
+        self._place_multi = self._mmap[offset : offset + self._multi_idx[-1]]
+        offset += self._multi_idx[-1]
+        self._count_multi = self._mmap[offset : offset + self._multi_idx[-1]]
+
+    def _read_range(self, start, stop):
+        ones = slice(self._ones_idx[start], self._ones_idx[stop])
+        multi = slice(self._multi_idx[start], self._multi_idx[stop])
+        return (
+            self._ones[start:stop],
+            self._multi[start:stop],
+            self._place_ones[ones],
+            self._place_multi[multi],
+            self._count_multi[multi],
+        )
+
+    def _read_indices(self, indices):
+        # Gather the entries of all the frames at once through the offsets
+        ones = np.asarray(self._ones[indices])
+        multi = np.asarray(self._multi[indices])
+        ones_sel = _get_ranges(self._ones_idx[indices], ones)
+        multi_sel = _get_ranges(self._multi_idx[indices], multi)
+        return (
+            ones,
+            multi,
+            np.asarray(self._place_ones[ones_sel]),
+            np.asarray(self._place_multi[multi_sel]),
+            np.asarray(self._count_multi[multi_sel]),
+        )
+
+    def close(self):
+        self._mmap = None
+
+
+class EMCH5Reader(EMCReaderBase):
+    """Random access reader of EMC HDF5 photon files, in the vlen or in the flat
+    layout (see :class:`writeemc.EMCWriter`). The file is kept open until
+    :meth:`close`, and a contiguous range of frames is read with one call per dataset.
+
+    Args:
+        filename (str): The EMC HDF5 filename.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._h5 = h5py.File(filename, "r")
+        self.flat = isFlatH5(self._h5)
+        num_pix = self._h5["num_pix"][()][0]
+        count_dtype = self._h5["count_multi"].dtype
+        if self.flat:
+            self._ones = self._h5["ones"][()]
+            self._multi = self._h5["multi"][()]
+            self._ones_idx = _get_offsets(self._ones)
+            self._multi_idx = _get_offsets(self._multi)
+            num_data = len(self._ones)
+        else:
+            count_dtype = h5py.check_vlen_dtype(count_dtype)
+            num_data = len(self._h5["count_multi"])
+        super().__init__(num_pix, num_data, count_dtype)
+
+    def _read_range(self, start, stop):
+        if self.flat:
+            ones = slice(self._ones_idx[start], self._ones_idx[stop])
+            multi = slice(self._multi_idx[start], self._multi_idx[stop])
+            return (
+                self._ones[start:stop],
+                self._multi[start:stop],
+                self._h5["place_ones"][ones],
+                self._h5["place_multi"][multi],
+                self._h5["count_multi"][multi],
+            )
+        place_ones = self._h5["place_ones"][start:stop]
+        place_multi = self._h5["place_multi"][start:stop]
+        count_multi = self._h5["count_multi"][start:stop]
+        return (
+            np.fromiter(map(len, place_ones), dtype=np.int64, count=len(place_ones)),
+            np.fromiter(map(len, place_multi), dtype=np.int64, count=len(place_multi)),
+            _concatenate_rows(place_ones),
+            _concatenate_rows(place_multi),
+            _concatenate_rows(count_multi),
+        )
+
+    def close(self):
+        self._h5.close()
+
+
+def openEMCReader(filename: str) -> EMCReaderBase:
+    """Open the reader of an EMC HDF5 or binary photon file"""
+    if isEMCH5(filename):
+        return EMCH5Reader(filename)
+    if isEMCBinary(filename):
+        return EMCBinaryReader(filename)
+    raise UnknownFileTypeError(
+        "This is not an EMC file, please provide the correct file type."
+    )
+
+
+def _get_offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _get_ranges(starts, lengths):
+    """Concatenate the index ranges [start, start + length)"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    total = ends[-1] if len(ends) > 0 else 0
+    offsets = np.asarray(starts, dtype=np.int64) - (ends - lengths)
+    return np.repeat(offsets, lengths) + np.arange(total)
+
+
+def _concatenate_rows(rows):
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(rows)
+
+
+def scatterPatternsSOne(patterns: PatternsSOne, out: np.ndarray):
+    """Scatter sparse photon patterns into a zero-filled dense array of shape
+    (num_data, num_pix)"""
+    rows = np.repeat(np.arange(patterns.num_data), patterns.attrs("ones"))
+    out[rows, patterns.attrs("place_ones")] = 1
+    rows = np.repeat(np.arange(patterns.num_data), patterns.attrs("multi"))
+    out[rows, patterns.attrs("place_multi")] = patterns.attrs("count_multi")
+    return out
+
+
 def writeEMCGeom(
     out_fn: str,
     det_dist: float,
@@ -404,8 +1031,11 @@ def writeEMCGeom(
     pix_size: float,
     in_wavelength: float,
     stoprad: float,
+    cache: bool = None,
 ):
-    """Get EMC geometry from several parameters.
+    """Get EMC geometry from several parameters. With the cache, the detector files
+    are cached by their parameters under $SIMEXLITE_CACHE_DIR/emc_geom (default
+    ~/.cache/SimExLite/emc_geom), so repeated calls only copy the cached file.
 
     Args:
         out_fn (str): Output filename
@@ -415,7 +1045,18 @@ def writeEMCGeom(
         pix_size (float): Pixel size (mm)
         in_wavelength (float): X-ray wavelength (angstrom)
         stoprad (float): Beamstop radius in pixels
+        cache (bool): Whether to use the cache of the detector files, defaults to
+            $SIMEXLITE_CACHE=1 (off if it's not set)
     """
+    cache = use_cache(cache)
+    if cache:
+        params = (det_dist, dets_x, dets_y, pix_size, in_wavelength, stoprad)
+        suffix = ".h5" if os.path.splitext(out_fn)[1] == ".h5" else ".dat"
+        cache_path = get_cache_path("emc_geom", get_params_hash(*params), suffix)
+        if cache_path.is_file():
+            print("Copying cached detector file to", out_fn)
+            shutil.copyfile(cache_path, out_fn)
+            return
     # Reference: https://github.com/JunCEEE/Dragonfly/blob/8e9075818f00f5d2c45756d2b98803509be67cf0/utils/convert/geomtodet.py#L23
     # Sample to detector distance
     # width number of pixels
@@ -458,6 +1099,8 @@ def writeEMCGeom(
     det.ewald_rad = ewald_rad
     print("Writing detector file to", out_fn)
     det.write(out_fn)
+    if cache:
+        write_cache_file(cache_path, partial(shutil.copyfile, out_fn))
 
 
 def write_emc_balcklist(fn: str, sel: list, total: int):
@@ -0,0 +1,134 @@
+# Copyright (C) 2023 Juncheng E
+# Contact: Juncheng E <juncheng.e@xfel.eu>
+# This file is part of SimEx-Lite which is released under GNU General Public License v3.
+# See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
+"""Lazy, file-backed diffraction pattern array"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class LazyPatternArray:
+    """A read-only array-like view of diffraction patterns stored in a file. Patterns are
+    only read when they are indexed, and the most recently used ones are kept in a
+    bounded LRU cache.
+
+    It supports `len`, integer and slice indexing, fancy (list, integer array or
+    boolean) indexing along the pattern axis, iteration and :func:`numpy.asarray`.
+
+    Args:
+        read_frames (callable): A function taking a sorted array of unique pattern indices
+            in the file and returning the array of these patterns, shape=(n, py, px).
+        indices (ndarray): The pattern indices in the file mapped by this array.
+        frame_shape (tuple): The shape of one pattern.
+        dtype (numpy.dtype): The dtype of the patterns.
+        cache_size (int): The maximum number of patterns in the LRU cache.
+        block_size (int): The number of patterns read at once when iterating.
+    """
+
+    def __init__(
+        self,
+        read_frames,
+        indices,
+        frame_shape,
+        dtype,
+        cache_size: int = 128,
+        block_size: int = 64,
+    ):
+        self._read_frames = read_frames
+        self._indices = np.asarray(indices, dtype=np.int64)
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.cache_size = cache_size
+        self.block_size = block_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._indices)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.frame_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __repr__(self):
+        return f"LazyPatternArray(shape={self.shape}, dtype={self.dtype})"
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            if len(key) == 0:
+                return self[:]
+            frames = self[key[0]]
+            if isinstance(key[0], (int, np.integer)):
+                return frames[key[1:]]
+            return frames[(slice(None),) + key[1:]]
+        if key is Ellipsis:
+            key = slice(None)
+        if isinstance(key, (int, np.integer)):
+            local = np.arange(len(self))[key]
+            return self._get_frames(np.array([local]))[0]
+        local = np.arange(len(self))[key]
+        return self._get_frames(np.atleast_1d(local))
+
+    def __iter__(self):
+        for start in range(0, len(self), self.block_size):
+            frames = self[start : start + self.block_size]
+            for frame in frames:
+                yield frame
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+        return arr
+
+    def clear_cache(self):
+        """Drop all the cached patterns"""
+        with self._lock:
+            self._cache.clear()
+
+    def _get_frames(self, local):
+        """Get the patterns of the local indices, reading the uncached ones from file"""
+        file_indices = self._indices[local]
+        with self._lock:
+            cached = {i: self._cache[i] for i in file_indices if i in self._cache}
+            for i in cached:
+                self._cache.move_to_end(i)
+        hit = np.isin(file_indices, list(cached))
+        to_read = np.unique(file_indices[~hit])
+        frames = None
+        if len(to_read) > 0:
+            frames = np.asarray(self._read_frames(to_read), dtype=self.dtype)
+            self._update_cache(to_read, frames)
+            if len(to_read) == len(file_indices) and np.array_equal(
+                to_read, file_indices
+            ):
+                # Sorted selection without cache hits: no reordering needed
+                return frames
+        out = np.empty((len(file_indices),) + self.frame_shape, dtype=self.dtype)
+        if frames is not None:
+            out[~hit] = frames[np.searchsorted(to_read, file_indices[~hit])]
+        for n in np.flatnonzero(hit):
+            out[n] = cached[file_indices[n]]
+        return out
+
+    def _update_cache(self, indices, frames):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            # Only the last `cache_size` patterns of a large read can stay anyway
+            for i, frame in zip(indices[-self.cache_size :], frames[-self.cache_size :]):
+                # Copy, so that a cached view does not keep the whole block alive
+                self._cache[i] = np.array(frame)
+                self._cache.move_to_end(i)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
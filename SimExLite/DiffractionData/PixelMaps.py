@@ -0,0 +1,233 @@
+# Copyright (C) 2023 Juncheng E
+# Contact: Juncheng E <juncheng.e@xfel.eu>
+# This file is part of SimEx-Lite which is released under GNU General Public License v3.
+# See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
+"""Geometry derived pixel maps: the solid angle, q and polarization of the pixels"""
+
+from pathlib import Path
+import numpy as np
+from cfelpyutils.geometry import load_crystfel_geometry
+from SimExLite.PhotonBeamData import hcDivide
+from SimExLite.utils import rebin
+from SimExLite.utils.cache import (
+    get_cache_path,
+    get_file_hash,
+    get_params_hash,
+    use_cache,
+    write_cache_file,
+)
+from SimExLite.utils.geometry import get_geom_fingerprint
+from .DiffractionData import get_geom_gaps, get_q
+from .writeemc import compute_polarization
+
+# The keys of a pysingfel geometry file
+PYSINGFEL_GEOM_KEYS = ("px", "py", "pix_width", "d")
+
+
+def get_solid_angle_map(geom, distance: float = None, img_size=None, cache=None):
+    """Get the solid angle of the pixels of a detector geometry.
+
+    Args:
+        geom (str or ExtraGeomDetectorGeometry): extra_geom instance, or a pysingfel or
+            CrystFEL geometry file.
+        distance (float): The sample to detector distance in meter. It's required for
+            extra_geom geometries and overrides the distance of geometry files.
+        img_size ([nrow, ncol]): The binned array size of an extra_geom geometry, see
+            :func:`get_pixel_coordinates`.
+        cache (bool): Whether to cache the map on disk, under
+            $SIMEXLITE_CACHE_DIR/pixel_maps (default ~/.cache/SimExLite/pixel_maps).
+            Defaults to $SIMEXLITE_CACHE=1 (off if it's not set).
+
+    Returns:
+        ndarray: A 2D array of solid angles in sr.
+    """
+
+    def compute():
+        x, y, z, pixel_width = get_pixel_coordinates(geom, distance, img_size)
+        return get_solid_angle(pixel_width, np.sqrt(x * x + y * y + z * z))
+
+    return _get_cached_map("solid_angle", geom, (distance, img_size), compute, cache)
+
+
+def get_q_map(
+    geom, photon_energy: float, distance: float = None, img_size=None, cache=None
+):
+    """Get the reciprocal space magnitude of the pixels of a detector geometry,
+    q=2sin(theta)/lambda in 1/angstrom.
+
+    Args:
+        geom (str or ExtraGeomDetectorGeometry): See :func:`get_solid_angle_map`.
+        photon_energy (float): The photon energy in eV.
+        distance, img_size, cache: See :func:`get_solid_angle_map`.
+
+    Returns:
+        ndarray: A 2D array of q.
+    """
+
+    def compute():
+        x, y, z, _ = get_pixel_coordinates(geom, distance, img_size)
+        return get_q(np.sqrt(x * x + y * y), z, hcDivide(photon_energy / 1000))
+
+    params = (float(photon_energy), distance, img_size)
+    return _get_cached_map("q", geom, params, compute, cache)
+
+
+def get_polarization_map(
+    geom, polarization: str = "x", distance: float = None, img_size=None, cache=None
+):
+    """Get the polarization factor of the pixels of a detector geometry.
+
+    Args:
+        geom (str or ExtraGeomDetectorGeometry): See :func:`get_solid_angle_map`.
+        polarization (str): The polarization direction, 'x', 'y' or 'none'.
+        distance, img_size, cache: See :func:`get_solid_angle_map`.
+
+    Returns:
+        ndarray: A 2D array of polarization factors.
+    """
+
+    def compute():
+        x, y, z, _ = get_pixel_coordinates(geom, distance, img_size)
+        return compute_polarization(polarization, x, y, np.sqrt(x * x + y * y + z * z))
+
+    params = (polarization.lower(), distance, img_size)
+    return _get_cached_map("polarization", geom, params, compute, cache)
+
+
+def _get_cached_map(name, geom, params, compute, cache):
+    """Get a pixel map from the cache, keyed on the geometry hash and `params`, or
+    compute and cache it."""
+    if not use_cache(cache):
+        return compute()
+    if params[-1] is not None:
+        params = params[:-1] + (tuple(int(n) for n in params[-1]),)
+    key = get_params_hash(name, get_geom_hash(geom), *params)
+    cache_path = get_cache_path("pixel_maps", key, ".npy")
+    if cache_path.is_file():
+        try:
+            return np.load(cache_path)
+        except (OSError, ValueError) as err:
+            print(f"Could not read the cache file {cache_path}: {err}")
+    pixel_map = compute()
+    write_cache_file(cache_path, lambda fname: np.save(fname, pixel_map))
+    return pixel_map
+
+
+def get_geom_hash(geom) -> str:
+    """Get the hash of a geometry file, or the fingerprint of an extra_geom
+    geometry."""
+    if isinstance(geom, (str, Path)):
+        return get_file_hash(geom)
+    return get_geom_fingerprint(geom)
+
+
+def get_pixel_coordinates(geom, distance: float = None, img_size=None):
+    """Get the coordinates of the pixel centers of a detector geometry, with the beam
+    along z. The pixels are in the assembled layout of an extra_geom geometry, and in
+    the data layout of a geometry file.
+
+    Args:
+        geom (str or ExtraGeomDetectorGeometry): extra_geom instance, or a pysingfel or
+            CrystFEL geometry file.
+        distance (float): The sample to detector distance in meter. It's required for
+            extra_geom geometries and overrides the distance of geometry files.
+        img_size ([nrow, ncol]): The array size of the patterns of an extra_geom
+            geometry, binned from the assembled patterns as in :func:`get_geom_mask`.
+
+    Returns:
+        (x, y, z, pixel_width): The 2D coordinates in meter (NaN in the gaps) and the
+        pixel width in meter.
+    """
+    if isinstance(geom, (str, Path)):
+        params = readPysingfelGeom(geom)
+        if params is not None:
+            return _get_pysingfel_coordinates(params, distance)
+        return _get_crystfel_coordinates(geom, distance)
+    if distance is None:
+        raise ValueError("The distance is required for an extra_geom geometry.")
+    positions = geom.get_pixel_positions()
+    coords = [geom.position_modules(positions[..., i])[0] for i in range(3)]
+    assembled_size = np.array(coords[0].shape)
+    if img_size is None:
+        img_size = assembled_size
+    img_size = tuple(int(n) for n in img_size)
+    bin_factor = assembled_size // np.array(img_size)
+    if np.any(bin_factor == 0):
+        raise ValueError(f"img_size {img_size} is larger than the assembled size.")
+    if np.any(bin_factor > 1):
+        # The binned pixel is at the center of the pixels it sums up
+        coords = rebin(np.stack(coords), img_size, reducer="mean", nan_aware=True)
+        coords[:, get_geom_gaps(geom, img_size)] = np.nan
+    x, y, z = coords
+    z = z + distance
+    pixel_width = geom.pixel_size * np.sqrt(np.prod(bin_factor))
+    return x, y, z, pixel_width
+
+
+def readPysingfelGeom(geom_fn):
+    """Read the parameters of a pysingfel geometry file, `None` if it's not one.
+
+    Returns:
+        dict: {'px', 'py', 'pix_width', 'pix_height', 'd'}
+    """
+    params = {}
+    with open(geom_fn, "r") as fh:
+        for line in fh:
+            line = line.split(";")[0].split("#")[0]
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            params[key.strip().rsplit("/", 1)[-1]] = value.strip()
+    if not all(key in params for key in PYSINGFEL_GEOM_KEYS):
+        return None
+    return {
+        "px": int(params["px"]),
+        "py": int(params["py"]),
+        "pix_width": float(params["pix_width"]),
+        "pix_height": float(params.get("pix_height", params["pix_width"])),
+        "d": float(params["d"]),
+    }
+
+
+def _get_pysingfel_coordinates(params, distance):
+    """The pixel coordinates of a pysingfel detector, centered at the middle pixel"""
+    if distance is None:
+        distance = params["d"]
+    x = (np.arange(params["px"]) - (params["px"] - 1) / 2) * params["pix_width"]
+    y = (np.arange(params["py"]) - (params["py"] - 1) / 2) * params["pix_height"]
+    x, y = np.meshgrid(x, y)
+    z = np.full(x.shape, float(distance))
+    return x, y, z, params["pix_width"]
+
+
+def _get_crystfel_coordinates(geom_fn, distance):
+    """The pixel coordinates of the panels of a CrystFEL geometry file, in the data
+    layout"""
+    panels = load_crystfel_geometry(str(geom_fn)).detector["panels"]
+    nss = max(panel["orig_max_ss"] for panel in panels.values()) + 1
+    nfs = max(panel["orig_max_fs"] for panel in panels.values()) + 1
+    x, y, z, pixel_width = (np.full((nss, nfs), np.nan) for _ in range(4))
+    for panel in panels.values():
+        if distance is None and not panel["clen"] > 0:
+            raise ValueError(
+                f"The clen of {geom_fn} is not a number, please set the distance."
+            )
+        clen = panel["clen"] if distance is None else distance
+        region = (
+            slice(panel["orig_min_ss"], panel["orig_max_ss"] + 1),
+            slice(panel["orig_min_fs"], panel["orig_max_fs"] + 1),
+        )
+        ss, fs = np.indices(x[region].shape) + 0.5
+        x[region] = (ss * panel["ssx"] + fs * panel["fsx"] + panel["cnx"]) / panel["res"]
+        y[region] = (ss * panel["ssy"] + fs * panel["fsy"] + panel["cny"]) / panel["res"]
+        z[region] = (ss * panel["ssz"] + fs * panel["fsz"]) / panel["res"]
+        z[region] += clen + panel["coffset"]
+        pixel_width[region] = 1 / panel["res"]
+    return x, y, z, pixel_width
+
+
+def get_solid_angle(pixel_width, norm):
+    """Get the solid angle of square pixels of `pixel_width` at the distance `norm`
+    from the sample."""
+    ss = pixel_width**2 / (4 * norm**2 + pixel_width**2)
+    return 4 * np.arcsin(ss)
@@ -0,0 +1,166 @@
+# Copyright (C) 2023 Juncheng E
+# Contact: Juncheng E <juncheng.e@xfel.eu>
+# This file is part of SimEx-Lite which is released under GNU General Public License v3.
+# See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
+"""Azimuthal integration of diffraction patterns"""
+
+import numpy as np
+from tqdm.autonotebook import tqdm
+from .DiffractionData import get_lazy_data_dict, get_q
+from .PixelMaps import get_pixel_coordinates, get_solid_angle
+from .writeemc import compute_polarization
+
+
+class RadialIntegrator:
+    """Azimuthal integrator of the diffraction patterns of a detector geometry. The
+    q bin of each pixel and the solid angle and polarization corrections are computed
+    once, then stacks of patterns are integrated into 1D radial profiles with
+    `np.bincount`, chunk by chunk.
+
+    The patterns are the assembled images of an extra_geom geometry as in
+    :class:`DiffractionData`, optionally binned down to `img_size`. Multi-module
+    geometries are supported, the pixels in the gaps are excluded.
+
+    .. code-block:: python
+
+       integrator = RadialIntegrator.from_diffraction_data(dd, bins=200)
+       profiles = integrator.integrate_data(dd, chunk_size=1000)
+       plt.plot(integrator.q, profiles.mean(axis=0))
+
+    Args:
+        geom (ExtraGeomDetectorGeometry): extra_geom instance.
+        distance (float): The sample to detector distance in meter.
+        wavelength (float): The X-ray wavelength in angstrom. If it's `None`, the
+            profiles are binned by the radius in meter instead of q.
+        img_size ([nrow, ncol]): The array size of the patterns, defaults to the
+            assembled size of the geometry.
+        bins (int or ndarray): The number of bins, or the bin edges in 1/angstrom
+            (q=2sin(theta)/lambda) or in meter if `wavelength` is `None`.
+        polarization (str): The polarization direction, 'x', 'y', 'none', or `None`
+            for no polarization correction.
+        correct_solid_angle (bool): Whether to correct the solid angle of the pixels.
+        pixel_mask (ndarray): The 2D mask of the patterns, good pixels = 1, bad
+            pixels = 0.
+    """
+
+    def __init__(
+        self,
+        geom,
+        distance: float,
+        wavelength: float = None,
+        img_size=None,
+        bins=100,
+        polarization: str = "x",
+        correct_solid_angle: bool = True,
+        pixel_mask=None,
+    ):
+        x, y, z, pixel_width = get_pixel_coordinates(geom, distance, img_size)
+        self.img_size = x.shape
+        valid = np.isfinite(x)
+        if pixel_mask is not None:
+            valid &= np.asarray(pixel_mask, dtype=bool)
+
+        norm = np.sqrt(x * x + y * y + z * z)
+        self.solid_angle = get_solid_angle(pixel_width, norm)
+        radius = np.sqrt(x * x + y * y)
+        if wavelength is None:
+            self.radial_map = radius
+        else:
+            self.radial_map = get_q(radius, z, wavelength)
+
+        correction = np.ones(self.img_size)
+        if correct_solid_angle:
+            # Relative to the largest solid angle to keep the intensity scale
+            correction *= self.solid_angle / np.nanmax(self.solid_angle[valid])
+        if polarization is not None:
+            correction *= compute_polarization(polarization, x, y, norm)
+
+        radial = self.radial_map[valid]
+        if np.ndim(bins) == 0:
+            bins = np.linspace(radial.min(), radial.max(), int(bins) + 1)
+        self.bin_edges = np.asarray(bins, dtype=float)
+        self.n_bins = len(self.bin_edges) - 1
+        pixel_bin = np.digitize(self.radial_map, self.bin_edges) - 1
+        # Include the upper edge in the last bin
+        pixel_bin[self.radial_map == self.bin_edges[-1]] = self.n_bins - 1
+        valid &= (pixel_bin >= 0) & (pixel_bin < self.n_bins)
+
+        # The flat indices of the integrated pixels and their bins and weights
+        self._pixels = np.flatnonzero(valid)
+        self._pixel_bin = pixel_bin.ravel()[self._pixels]
+        self._weights = 1.0 / correction.ravel()[self._pixels]
+        self.counts = np.bincount(self._pixel_bin, minlength=self.n_bins)
+
+    @classmethod
+    def from_diffraction_data(cls, diffraction_data, **kwargs):
+        """Create the integrator from the geometry, the distance, the beam wavelength
+        and the pattern size of a :class:`DiffractionData`.
+
+        Args:
+            diffraction_data (DiffractionData): The diffraction data.
+            kwargs: The other arguments of :class:`RadialIntegrator`.
+        """
+        data_dict = get_lazy_data_dict(diffraction_data)
+        if data_dict.get("geom") is None or data_dict.get("distance") is None:
+            raise ValueError("The diffraction data has no geometry or distance.")
+        if "wavelength" not in kwargs and data_dict.get("beam") is not None:
+            wavelength = data_dict["beam"].get_wavelength("angstrom")
+            kwargs["wavelength"] = wavelength.magnitude
+        if "pixel_mask" not in kwargs and data_dict.get("pixel_mask") is not None:
+            pixel_mask = np.asarray(data_dict["pixel_mask"])
+            if pixel_mask.shape == data_dict["img_array"].shape[1:]:
+                kwargs["pixel_mask"] = pixel_mask
+        kwargs.setdefault("img_size", data_dict["img_array"].shape[1:])
+        return cls(data_dict["geom"], data_dict["distance"], **kwargs)
+
+    @property
+    def q(self) -> np.ndarray:
+        """The centers of the bins"""
+        return (self.bin_edges[1:] + self.bin_edges[:-1]) / 2
+
+    def integrate(self, patterns, chunk_size: int = 1000, progress: bool = True):
+        """Integrate patterns into radial profiles, the mean corrected intensity of the
+        pixels in each bin (NaN for the empty bins).
+
+        Args:
+            patterns (array-like): The (n, nrow, ncol) patterns, or a single pattern.
+                Any array-like supporting slicing, e.g. :class:`LazyPatternArray`, is
+                read chunk by chunk.
+            chunk_size (int): The number of patterns integrated at once.
+            progress (bool): Whether to show a progress bar.
+
+        Returns:
+            ndarray: The (n, n_bins) profiles, or (n_bins,) for a single pattern.
+        """
+        if len(np.shape(patterns)) == 2:
+            return self.integrate(np.asarray(patterns)[np.newaxis], chunk_size, False)[0]
+        if tuple(np.shape(patterns)[1:]) != self.img_size:
+            raise ValueError(
+                f"The pattern shape {np.shape(patterns)[1:]} does not match "
+                f"{self.img_size}."
+            )
+        profiles = np.empty((len(patterns), self.n_bins))
+        for start in tqdm(range(0, len(patterns), chunk_size), disable=not progress):
+            chunk = np.asarray(patterns[start : start + chunk_size], dtype=np.float64)
+            chunk = np.take(chunk.reshape(len(chunk), -1), self._pixels, axis=1)
+            chunk *= self._weights
+            offsets = np.arange(len(chunk))[:, np.newaxis] * self.n_bins
+            sums = np.bincount(
+                (offsets + self._pixel_bin).ravel(),
+                weights=chunk.ravel(),
+                minlength=len(chunk) * self.n_bins,
+            )
+            profiles[start : start + len(chunk)] = sums.reshape(len(chunk), -1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            profiles /= self.counts
+        return profiles
+
+    def integrate_data(self, diffraction_data, chunk_size: int = 1000):
+        """Integrate the patterns of a :class:`DiffractionData`. File mappings are read
+        lazily, chunk by chunk.
+
+        Returns:
+            ndarray: The (n, n_bins) profiles.
+        """
+        patterns = get_lazy_data_dict(diffraction_data)["img_array"]
+        return self.integrate(patterns, chunk_size)
@@ -19,6 +19,7 @@ from SimExLite.PhotonBeamData import SimpleBeam
 # This file is part of SimEx-Lite which is released under GNU General Public License v3.
 # See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
 
+from functools import partial
 import h5py
 import numpy as np
 from tqdm.autonotebook import tqdm
@@ -28,6 +29,8 @@ from extra_geom.base import DetectorGeometryBase
 import SimExLite
 from SimExLite.utils.io import parseIndex
 from SimExLite.PhotonBeamData import SimpleBeam
+from .BufferManager import get_buffer_manager
+from .LazyPatternArray import LazyPatternArray
 
 
 class SingFELFormat(BaseFormat):
@@ -41,8 +44,8 @@ class SingFELFormat(BaseFormat):
         key = "singfel"
         description = "Singfel format for DiffractionData"
         file_extension = ".h5"
-        read_kwargs = ["index", "poissonize"]
-        write_kwargs = ["ideal_arr"]
+        read_kwargs = ["index", "poissonize", "dtype", "lazy"]
+        write_kwargs = ["ideal_arr", "stacked", "compression"]
         return self._create_format_register(
             key, description, file_extension, read_kwargs, write_kwargs
         )
@@ -55,40 +58,44 @@ class SingFELFormat(BaseFormat):
         return []
 
     @classmethod
-    def read(cls, filename: str, index=None, poissonize=False) -> dict:
+    def read(
+        cls, filename: str, index=None, poissonize=False, dtype=None, lazy=False
+    ) -> dict:
         """Read the data from the file with the `filename` to a dictionary. If poissonize=True,
-        it will read the poissonized data, instead of the ideal one."""
+        it will read the poissonized data, instead of the ideal one. The patterns are read
+        in `dtype`, which defaults to the dtype in the file. If lazy=True, `img_array` is a
+        :class:`LazyPatternArray` reading the patterns on demand."""
         data_dict = {}
 
         index = parseIndex(index)
 
-        if isinstance(index, int):
-            arr_size = 1
-        else:
-            arr_size = len(range(getPatternTotal(filename))[index])
+        indices = np.arange(getPatternTotal(filename))[index]
+        arr_size = len(indices)
 
         pattern_shape = getPatternShape(filename)
-        if arr_size < 1e9:
-            arr = np.zeros((arr_size, pattern_shape[0], pattern_shape[1]))
-        else:
-            arr = np.memmap(
-                "memmap.dat",
-                dtype="float16",
-                mode="w+",
-                shape=(arr_size, pattern_shape[0], pattern_shape[1]),
+        if dtype is None:
+            dtype = getPatternDtype(filename, poissonize)
+        if lazy:
+            arr = LazyPatternArray(
+                partial(readFrames, filename, poissonize=poissonize, dtype=dtype),
+                indices,
+                pattern_shape,
+                dtype,
             )
-        quaternions = np.zeros((arr_size, 4))
-        if isinstance(index, (slice, str)):
-            with tqdm(total=arr_size) as progress_bar:
-                for i, (pattern, quaternion) in enumerate(
-                    ireadPattern(filename, index, poissonize)
-                ):
-                    arr[i] = pattern
-                    quaternions[i] = quaternion
-                    progress_bar.update(1)  # update progress
+            quaternions = readQuaternions(filename, index)
         else:
-            # If only reading one pattern
-            arr[0], quaternions[0] = next(ireadPattern(filename, index, poissonize))
+            arr = get_buffer_manager().allocate(
+                (arr_size, pattern_shape[0], pattern_shape[1]), dtype
+            )
+            quaternions = np.zeros((arr_size, 4))
+            if isStacked(filename):
+                pattern_type = getPatternType(poissonize)
+                with h5py.File(filename, "r") as h5:
+                    readStacked(h5["data"][pattern_type], index, arr)
+                    if "angle" in h5["data"]:
+                        readStacked(h5["data"]["angle"], index, quaternions)
+            else:
+                readPatterns(filename, index, poissonize, arr, quaternions)
 
         params = getParameters(filename)
         geom, distance, pixel_mask = params2extra_geom(params["geom"])
@@ -105,8 +112,18 @@ class SingFELFormat(BaseFormat):
         return data_dict
 
     @classmethod
-    def write(cls, object, filename: str, arr_poisson=None, key: str = None):
-        """Save the data with the `filename`."""
+    def write(
+        cls,
+        object,
+        filename: str,
+        arr_poisson=None,
+        key: str = None,
+        stacked: bool = False,
+        compression=None,
+    ):
+        """Save the data with the `filename`. If stacked=True, the patterns are written
+        in the stacked layout, i.e. one chunked dataset per data type instead of one
+        group per pattern. `compression` is passed to h5py (e.g. "gzip" or "lzf")."""
         data_dict = object.get_data()
         method_desciption = "Written by SimEx-Lite"
         geom = extra_geom2params(
@@ -123,6 +140,8 @@ class SingFELFormat(BaseFormat):
             quaternions=data_dict["quaternions"],
             method_desciption=method_desciption,
             arr_poisson=arr_poisson,
+            stacked=stacked,
+            compression=compression,
         )
 
         if key is None:
@@ -130,6 +149,34 @@ class SingFELFormat(BaseFormat):
             key = original_key + "_to_SingfelFormat"
         return object.from_file(filename, cls, key)
 
+    @classmethod
+    def open_stream_writer(
+        cls,
+        filename: str,
+        data_dict: dict,
+        n_patterns: int,
+        pattern_shape,
+        dtype,
+        compression=None,
+    ):
+        """Open a :class:`StackedWriter` to write patterns with the metadata of
+        `data_dict` chunk by chunk."""
+        geom = extra_geom2params(
+            data_dict["geom"], data_dict["distance"], data_dict["pixel_mask"]
+        )
+        beam = BeamData2params(data_dict["beam"])
+        return StackedWriter(
+            filename,
+            n_patterns,
+            pattern_shape,
+            dtype,
+            geom,
+            beam,
+            quaternions=data_dict["quaternions"],
+            method_desciption="Written by SimEx-Lite",
+            compression=compression,
+        )
+
 
 def ireadPattern(filename, index=None, poissonize=True):
     """Iterator for reading diffraction patterns from a singfel file."""
@@ -137,6 +184,11 @@ def ireadPattern(filename, index=None, poissonize=True):
     pattern_type = getPatternType(poissonize)
     with h5py.File(filename, "r") as h5:
         data_grp = h5["data"]
+        if _isStacked(h5):
+            indices = np.arange(len(data_grp[pattern_type]))[index]
+            for i in indices:
+                yield data_grp[pattern_type][i], data_grp["angle"][i]
+            return
         data_list = list(data_grp)
         data_list.sort()
         indices = data_list[index]
@@ -145,6 +197,77 @@ def ireadPattern(filename, index=None, poissonize=True):
             yield data_grp[i][pattern_type][...], data_grp[i]["angle"][...]
 
 
+def readFrames(filename, indices, poissonize=False, dtype=None):
+    """Read the diffraction patterns of `indices` in either layout into a new array."""
+    if dtype is None:
+        dtype = getPatternDtype(filename, poissonize)
+    out = np.empty((len(indices),) + tuple(getPatternShape(filename)), dtype=dtype)
+    if isStacked(filename):
+        with h5py.File(filename, "r") as h5:
+            readStacked(h5["data"][getPatternType(poissonize)], indices, out)
+    else:
+        readPatterns(filename, indices, poissonize, out, progress=False)
+    return out
+
+
+def readQuaternions(filename, index=None):
+    """Read the quaternions of the diffraction patterns in either layout."""
+    index = parseIndex(index)
+    with h5py.File(filename, "r") as h5:
+        if _isStacked(h5):
+            indices = np.arange(len(_getStackedDataset(h5)))[index]
+            quaternions = np.zeros((len(indices), 4))
+            if "angle" in h5["data"]:
+                readStacked(h5["data"]["angle"], indices, quaternions)
+            return quaternions
+        data_list = list(h5["data"])
+        data_list.sort()
+        indices = np.arange(len(data_list))[index]
+        quaternions = np.zeros((len(indices), 4))
+        for i, idx in enumerate(indices):
+            _readDirect(h5.id, "data/" + data_list[idx] + "/angle", quaternions[i])
+    return quaternions
+
+
+def readPatterns(filename, index, poissonize, out, quaternions=None, progress=True):
+    """Bulk read diffraction patterns of the per-group layout into preallocated arrays.
+
+    The sorted group list is resolved once and each dataset is read directly into
+    its slot of `out` with the low-level h5py API, which avoids the per-dataset
+    overhead of the high-level interface.
+
+    Args:
+        filename (str): The singfel file.
+        index (slice or list-like): The selection of the patterns.
+        poissonize (bool): Read the poissonized patterns instead of the ideal ones.
+        out (ndarray): Output array of shape (n_selected, py, px).
+        quaternions (ndarray, optional): Output array of shape (n_selected, 4).
+        progress (bool): Show the progress bar.
+    """
+    index = parseIndex(index)
+    pattern_type = getPatternType(poissonize)
+    with h5py.File(filename, "r") as h5:
+        data_list = list(h5["data"])
+        data_list.sort()
+        indices = np.arange(len(data_list))[index]
+        fid = h5.id
+        for i, idx in enumerate(tqdm(indices, disable=not progress)):
+            group_name = "data/" + data_list[idx] + "/"
+            _readDirect(fid, group_name + pattern_type, out[i])
+            if quaternions is not None:
+                _readDirect(fid, group_name + "angle", quaternions[i])
+    return out
+
+
+def _readDirect(fid, name, out):
+    """Read a whole dataset into the C-contiguous array `out`."""
+    dsid = h5py.h5d.open(fid, name.encode())
+    try:
+        dsid.read(h5py.h5s.ALL, h5py.h5s.ALL, out)
+    finally:
+        dsid.close()
+
+
 def getPatternType(poissonize: bool) -> str:
     """Get the pattern type for reading h5 files.
 
@@ -162,9 +285,58 @@ def getPatternType(poissonize: bool) -> str:
     return pattern_type
 
 
+def isStacked(filename) -> bool:
+    """If the diffraction patterns in the hdf5 file are written in the stacked layout,
+    i.e. `/data/diffr`, `/data/data` and `/data/angle` are datasets instead of
+    one group per pattern."""
+    with h5py.File(filename, "r") as h5:
+        return _isStacked(h5)
+
+
+def _isStacked(h5) -> bool:
+    data_grp = h5["data"]
+    for pattern_type in ["diffr", "data"]:
+        if isinstance(data_grp.get(pattern_type, None), h5py.Dataset):
+            return True
+    return False
+
+
+def _getStackedDataset(h5):
+    """Get the first available stacked pattern dataset"""
+    try:
+        return h5["data"]["diffr"]
+    except KeyError:
+        return h5["data"]["data"]
+
+
+def readStacked(dset, index, out, block_size: int = 1000):
+    """Read the `index` selection of a stacked dataset into `out` block by block.
+
+    Args:
+        dset (h5py.Dataset): The stacked dataset, the first axis is the pattern axis.
+        index (slice or list-like): The selection of the patterns.
+        out (ndarray): The preallocated output array, len(out) has to be the
+            number of selected patterns.
+        block_size (int): The number of patterns to read in one HDF5 call.
+    """
+    indices = np.arange(len(dset))[index]
+    for start in range(0, len(indices), block_size):
+        idx = indices[start : start + block_size]
+        if idx[-1] - idx[0] == len(idx) - 1 and np.all(np.diff(idx) == 1):
+            # Contiguous selection
+            out[start : start + len(idx)] = dset[idx[0] : idx[-1] + 1]
+        else:
+            # h5py only supports increasing indices without duplicates
+            unique, inverse = np.unique(idx, return_inverse=True)
+            out[start : start + len(idx)] = dset[unique][inverse]
+    return out
+
+
 def getPatternShape(filename):
     """Get the shape of diffraction patterns in the hdf5 file"""
     with h5py.File(filename, "r") as h5:
+        if _isStacked(h5):
+            return _getStackedDataset(h5).shape[1:]
         group_name = list(h5["data"])[0]
         try:
             return h5["data"][group_name]["diffr"].shape
@@ -172,10 +344,23 @@ def getPatternShape(filename):
             return h5["data"][group_name]["data"].shape
 
 
+def getPatternDtype(filename, poissonize=False):
+    """Get the dtype of diffraction patterns in the hdf5 file"""
+    pattern_type = getPatternType(poissonize)
+    with h5py.File(filename, "r") as h5:
+        if _isStacked(h5):
+            return h5["data"][pattern_type].dtype
+        group_name = list(h5["data"])[0]
+        return h5["data"][group_name][pattern_type].dtype
+
+
 def getPatternTotal(filename):
     """Get the total number of diffraction patterns in the hdf5 file"""
     with h5py.File(filename, "r") as h5:
-        npattern = len(h5["data"])
+        if _isStacked(h5):
+            npattern = len(_getStackedDataset(h5))
+        else:
+            npattern = len(h5["data"])
     return npattern
 
 
@@ -291,6 +476,8 @@ def write_singfelDiffr(
     quaternions=None,
     method_desciption="",
     pmi_file_list=None,
+    stacked=False,
+    compression=None,
 ):
     """
     Save pattern arrays as pysingfel diffraction data.
@@ -309,11 +496,23 @@ def write_singfelDiffr(
     :type beam: dict
     :param pmi_file_list: The list of the corresponding pmi output file of each diffraction pattern.
     :type pmi_file_list: list
+    :param stacked: Write the patterns in single chunked datasets instead of one group per pattern.
+    :type stacked: bool
+    :param compression: The h5py compression filter of the stacked datasets, e.g. "gzip".
+    :type compression: str
     """
     prepH5(filename)
     # Method Description
     with h5py.File(filename, "a") as f:
         f.create_dataset("info/method_description", data=np.bytes_(method_desciption))
+        if stacked:
+            writeStacked(f, "/data/diffr", arr_ideal, compression)
+            if arr_poisson is not None:
+                writeStacked(f, "/data/data", arr_poisson, compression)
+            if quaternions is not None:
+                writeStacked(f, "/data/angle", np.asarray(quaternions), compression)
+            writeParams(f, geom, beam)
+            return
         # Flush to print it before tqdm
         print("Writing singfelDiffr data: diffr...", flush=True)
         for i, pattern_counts in enumerate(tqdm(arr_ideal)):
@@ -334,15 +533,105 @@ def write_singfelDiffr(
                 group_name = "/data/" + "{0:07}".format(i + 1) + "/"
                 f.create_dataset(group_name + "angle", data=quaternion)
 
-        # Geometry
-        f.create_dataset("params/geom/detectorDist", data=geom["detectorDist"])
-        f.create_dataset("params/geom/pixelWidth", data=geom["pixelWidth"])
-        f.create_dataset("params/geom/pixelHeight", data=geom["pixelHeight"])
-        f.create_dataset("params/geom/mask", data=geom["mask"])
+        writeParams(f, geom, beam)
+
+
+def writeParams(f, geom, beam):
+    """Write the geometry and beam parameters into an opened singfel file."""
+    # Geometry
+    f.create_dataset("params/geom/detectorDist", data=geom["detectorDist"])
+    f.create_dataset("params/geom/pixelWidth", data=geom["pixelWidth"])
+    f.create_dataset("params/geom/pixelHeight", data=geom["pixelHeight"])
+    f.create_dataset("params/geom/mask", data=geom["mask"])
+
+    # Beam
+    f.create_dataset("params/beam/focusArea", data=beam["focusArea"])
+    f.create_dataset("params/beam/photonEnergy", data=beam["photonEnergy"])
+
+
+def writeStacked(f, name, arr, compression=None, block_size: int = 1000):
+    """Write an array of patterns into one dataset chunked by pattern.
+
+    Args:
+        f (h5py.File): The opened output file.
+        name (str): The name of the dataset.
+        arr (ndarray): The array to write, the first axis is the pattern axis.
+        compression (str): The h5py compression filter, e.g. "gzip" or "lzf".
+        block_size (int): The number of patterns to write in one HDF5 call.
+    """
+    dset = f.create_dataset(
+        name,
+        shape=arr.shape,
+        dtype=arr.dtype,
+        chunks=(1,) + tuple(arr.shape[1:]),
+        compression=compression,
+    )
+    print(f"Writing singfelDiffr data: {name}...", flush=True)
+    for start in tqdm(range(0, len(arr), block_size)):
+        dset[start : start + block_size] = arr[start : start + block_size]
+    return dset
+
+
+class StackedWriter:
+    """Write diffraction patterns chunk by chunk in the stacked singfel layout.
+
+    Args:
+        filename (str): Output filename.
+        n_patterns (int): The total number of patterns to write.
+        pattern_shape (tuple): The shape of one pattern.
+        dtype (numpy.dtype): The dtype of the patterns.
+        geom (dict): The dictionary of detector parameters.
+        beam (dict): The dictionary of beam parameters.
+        quaternions (ndarray): The quaternion of each pattern.
+        method_desciption (str): The method description.
+        compression (str): The h5py compression filter, e.g. "gzip" or "lzf".
+    """
+
+    def __init__(
+        self,
+        filename,
+        n_patterns,
+        pattern_shape,
+        dtype,
+        geom,
+        beam,
+        quaternions=None,
+        method_desciption="",
+        compression=None,
+    ):
+        prepH5(filename)
+        self._h5 = h5py.File(filename, "a")
+        self._h5.create_dataset(
+            "info/method_description", data=np.bytes_(method_desciption)
+        )
+        pattern_shape = tuple(pattern_shape)
+        self._dset = self._h5.create_dataset(
+            "/data/diffr",
+            shape=(n_patterns,) + pattern_shape,
+            dtype=dtype,
+            chunks=(1,) + pattern_shape,
+            compression=compression,
+        )
+        if quaternions is not None:
+            self._h5.create_dataset("/data/angle", data=np.asarray(quaternions))
+        writeParams(self._h5, geom, beam)
+        self.n_written = 0
+        # The keywords to read the file back
+        self.read_kwargs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, val, traceback):
+        self.close()
+
+    def write(self, arr):
+        """Append the patterns in `arr`"""
+        self._dset[self.n_written : self.n_written + len(arr)] = arr
+        self.n_written += len(arr)
 
-        # Beam
-        f.create_dataset("params/beam/focusArea", data=beam["focusArea"])
-        f.create_dataset("params/beam/photonEnergy", data=beam["photonEnergy"])
+    def close(self):
+        self._h5.close()
 
 
 def __write_pmi_file_list(pmi_file_list, group_name, f, i):
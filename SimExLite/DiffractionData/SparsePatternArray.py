@@ -0,0 +1,169 @@
+# Copyright (C) 2023 Juncheng E
+# Contact: Juncheng E <juncheng.e@xfel.eu>
+# This file is part of SimEx-Lite which is released under GNU General Public License v3.
+# See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
+"""Sparse photon diffraction pattern array"""
+
+import numpy as np
+from .EMCFormat import PatternsSOne, _get_ranges, scatterPatternsSOne
+
+
+class SparsePatternArray:
+    """A read-only array-like of photon diffraction patterns stored in the EMC sparse
+    form (:class:`PatternsSOne`). Low-photon patterns take a few percent of the memory
+    of the dense array, and the statistics (:meth:`sum`, :meth:`mean_pattern`,
+    :meth:`photon_counts`) are computed without densifying them.
+
+    Integer indexing returns a dense pattern. Slice, list, integer array and boolean
+    indexing return a new :class:`SparsePatternArray`, slices with step 1 as views.
+    Use :meth:`to_dense`, :meth:`iter_dense` or :func:`numpy.asarray` to get dense
+    arrays.
+
+    Args:
+        patterns (PatternsSOne): The sparse photon patterns.
+        frame_shape (tuple): The shape of one pattern.
+        dtype (numpy.dtype): The dtype of the dense patterns.
+    """
+
+    def __init__(self, patterns: PatternsSOne, frame_shape, dtype="i4"):
+        self.patterns = patterns
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        if int(np.prod(self.frame_shape)) != patterns.num_pix:
+            raise ValueError(
+                f"frame_shape {self.frame_shape} does not match the number of pixels "
+                f"{patterns.num_pix}."
+            )
+
+    def __len__(self):
+        return self.patterns.num_data
+
+    @property
+    def shape(self):
+        return (len(self),) + self.frame_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes of the sparse data"""
+        return sum(self.patterns.attrs(g).nbytes for g in PatternsSOne.ATTRS)
+
+    def __repr__(self):
+        return f"SparsePatternArray(shape={self.shape}, dtype={self.dtype})"
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            if len(key) == 0:
+                return self
+            frames = self[key[0]]
+            if isinstance(key[0], (int, np.integer)):
+                return frames[key[1:]]
+            return frames.to_dense()[(slice(None),) + key[1:]]
+        if key is Ellipsis:
+            return self
+        if isinstance(key, (int, np.integer)):
+            local = np.arange(len(self))[key]
+            return self.to_dense(slice(local, local + 1))[0]
+        return SparsePatternArray(self._select(key), self.frame_shape, self.dtype)
+
+    def __iter__(self):
+        for chunk in self.iter_dense():
+            for frame in chunk:
+                yield frame
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype=dtype)
+
+    def _select(self, key) -> PatternsSOne:
+        """Select the patterns of `key` along the pattern axis"""
+        ones_idx = self.patterns.attrs("ones_idx")
+        multi_idx = self.patterns.attrs("multi_idx")
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            stop = max(start, stop)
+            ones = slice(ones_idx[start], ones_idx[stop])
+            multi = slice(multi_idx[start], multi_idx[stop])
+            return PatternsSOne(
+                self.patterns.num_pix,
+                self.patterns.attrs("ones")[start:stop],
+                self.patterns.attrs("multi")[start:stop],
+                self.patterns.attrs("place_ones")[ones],
+                self.patterns.attrs("place_multi")[multi],
+                self.patterns.attrs("count_multi")[multi],
+            )
+        indices = np.arange(len(self))[key]
+        ones = self.patterns.attrs("ones")[indices]
+        multi = self.patterns.attrs("multi")[indices]
+        ones_sel = _get_ranges(ones_idx[indices], ones)
+        multi_sel = _get_ranges(multi_idx[indices], multi)
+        return PatternsSOne(
+            self.patterns.num_pix,
+            ones,
+            multi,
+            self.patterns.attrs("place_ones")[ones_sel],
+            self.patterns.attrs("place_multi")[multi_sel],
+            self.patterns.attrs("count_multi")[multi_sel],
+        )
+
+    def photon_counts(self) -> np.ndarray:
+        """The number of photons of each pattern"""
+        multi_idx = self.patterns.attrs("multi_idx")
+        count_sum = np.zeros(len(self.patterns.attrs("count_multi")) + 1, np.int64)
+        np.cumsum(self.patterns.attrs("count_multi"), out=count_sum[1:])
+        multi_counts = count_sum[multi_idx[1:]] - count_sum[multi_idx[:-1]]
+        return self.patterns.attrs("ones") + multi_counts
+
+    def sum_pattern(self) -> np.ndarray:
+        """The sum of all the patterns"""
+        num_pix = self.patterns.num_pix
+        total = np.bincount(self.patterns.attrs("place_ones"), minlength=num_pix)
+        total += np.bincount(
+            self.patterns.attrs("place_multi"),
+            weights=self.patterns.attrs("count_multi"),
+            minlength=num_pix,
+        ).astype(np.int64)
+        return total.reshape(self.frame_shape)
+
+    def mean_pattern(self) -> np.ndarray:
+        """The mean of all the patterns"""
+        return self.sum_pattern() / len(self)
+
+    def sum(self, axis=None):
+        """Sum of the photons like :meth:`numpy.ndarray.sum`, with `axis` None, 0 (the
+        sum pattern) or the pattern axes (the photon counts of each pattern)."""
+        if axis is None:
+            return int(self.photon_counts().sum())
+        if axis == 0:
+            return self.sum_pattern()
+        if isinstance(axis, tuple) and sorted(axis) == list(range(1, self.ndim)):
+            return self.photon_counts()
+        raise ValueError(f"Unsupported axis: {axis}")
+
+    def to_dense(self, index=None, dtype=None) -> np.ndarray:
+        """Get the patterns of `index` as a dense array.
+
+        Args:
+            index: The slice or indices of the patterns, defaults to all the patterns.
+            dtype (numpy.dtype): The dtype of the output, defaults to :attr:`dtype`.
+        """
+        if dtype is None:
+            dtype = self.dtype
+        if isinstance(index, (int, np.integer)):
+            return self.to_dense([index], dtype)[0]
+        selected = self if index is None else self[index]
+        patterns = selected.patterns
+        out = np.zeros((patterns.num_data,) + self.frame_shape, dtype=dtype)
+        scatterPatternsSOne(patterns, out.reshape(patterns.num_data, patterns.num_pix))
+        return out
+
+    def iter_dense(self, chunk_size: int = 1000):
+        """Iterate over the patterns in dense chunks of `chunk_size` patterns"""
+        for start in range(0, len(self), chunk_size):
+            yield self.to_dense(slice(start, start + chunk_size))
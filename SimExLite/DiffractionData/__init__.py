@@ -6,5 +6,19 @@
 
 from .DiffractionData import *
 from .SingFELFormat import SingFELFormat
-from .EMCFormat import EMCFormat, writeEMCGeom, write_emc_balcklist
-from .CustomizedFormat import CustomizedFormat
\ No newline at end of file
+from .EMCFormat import (
+    EMCFormat,
+    writeEMCGeom,
+    write_emc_balcklist,
+    convertEMC,
+    subsetEMC,
+    splitEMC,
+    concatenateEMC,
+)
+from .CustomizedFormat import CustomizedFormat
+from .BufferManager import BufferManager, get_buffer_manager, set_buffer_manager
+from .LazyPatternArray import LazyPatternArray
+from .DiffractionPipeline import DiffractionPipeline
+from .SparsePatternArray import SparsePatternArray
+from .RadialIntegrator import RadialIntegrator
+from .PixelMaps import get_solid_angle_map, get_q_map, get_polarization_map
@@ -2,8 +2,11 @@
 # This is a copy of writeemc.py in Dragonfly (https://github.com/duaneloh/Dragonfly)
 
 from __future__ import print_function
+from array import array
 from collections import OrderedDict
 import os
+import shutil
+import tempfile
 import numpy as np
 
 try:
@@ -22,13 +25,28 @@ class EMCWriter(object):
     __init__ arguments:
         out_fname (string) - Output filename
         num_pix (int) - Number of pixels in dense frame
+        hdf5 (bool, optional) - Write an HDF5 file instead of a binary .emc file
+        buffer_size (int, optional) - Number of frames buffered in memory before
+                                      they are appended to the file at once
+        flat (bool, optional) - Write the HDF5 file in the flat layout
+        seed (int, optional) - Seed of the random generator of `fraction` and
+                               `partition`
 
     The number of pixels is saved to the header and serves as a check since the
     sparse format is in reference to a detector file.
 
+    The HDF5 file has one variable-length row per frame in `place_ones`,
+    `place_multi` and `count_multi`, as read by Dragonfly. In the flat layout, these
+    three datasets are instead plain int32 arrays of all the frames concatenated, and
+    the number of entries of each frame is saved in `ones` and `multi`, like in the
+    binary format. The flat layout is faster to write and read, but only readable by
+    `EMCFormat`, not by Dragonfly.
+
     Methods:
         write_frame(frame, fraction=1.)
+        write_frames(frames, fraction=1.)
         write_sparse_frame(place_ones, place_multi, count_multi)
+        flush()
         finish_write()
 
     The typical usage is as follows:
@@ -38,9 +56,23 @@ class EMCWriter(object):
        with EMCWriter('photons.emc', num_pix) as emc:
            for i in range(num_frames):
                emc.write_frame(frame[i].ravel())
+
+    or, for whole batches of frames:
+
+    .. code-block:: python
+
+       with EMCWriter('photons.emc', num_pix) as emc:
+           emc.write_frames(frames)
     """
 
-    def __init__(self, out_fname, num_pix, hdf5=True):
+    DSET_NAMES = ["place_ones", "place_multi", "count_multi"]
+    # Chunk sizes in frames for the vlen datasets and in elements for the flat ones
+    VLEN_CHUNK = 1024
+    FLAT_CHUNK = 65536
+
+    def __init__(
+        self, out_fname, num_pix, hdf5=True, buffer_size=1000, flat=False, seed=None
+    ):
         out_folder = os.path.dirname(out_fname)
         self.h5_output = hdf5
         if hdf5 and not HDF5_MODE:
@@ -53,8 +85,14 @@ class EMCWriter(object):
         self.num_data = 0
         self.num_pix = num_pix
         self.mean_count = 0.0
-        self.ones = []
-        self.multi = []
+        # The number of entries of each frame, compactly as C ints
+        self.ones = array("i")
+        self.multi = array("i")
+        self.buffer_size = max(1, int(buffer_size))
+        self.flat = flat and self.h5_output
+        self._buffer = []
+        self._num_buffered = 0
+        self.rng = np.random.default_rng(seed)
         self._init_file(out_folder)
 
     def __enter__(self):
@@ -68,23 +106,29 @@ class EMCWriter(object):
             self._h5f = h5py.File(self.out_fname, "w")
             self._h5f["num_pix"] = [self.num_pix]
 
-            vlentype = h5py.special_dtype(vlen=np.int32)
-            self._h5f.create_dataset(
-                "place_ones", (0,), maxshape=(None,), chunks=(1,), dtype=vlentype
-            )
-            self._h5f.create_dataset(
-                "place_multi", (0,), maxshape=(None,), chunks=(1,), dtype=vlentype
-            )
-            self._h5f.create_dataset(
-                "count_multi", (0,), maxshape=(None,), chunks=(1,), dtype=vlentype
-            )
+            if self.flat:
+                dtype = np.int32
+                chunks = (self.FLAT_CHUNK,)
+                for name in ["ones", "multi"]:
+                    self._h5f.create_dataset(
+                        name, (0,), maxshape=(None,), chunks=chunks, dtype=dtype
+                    )
+            else:
+                dtype = h5py.special_dtype(vlen=np.int32)
+                chunks = (self.VLEN_CHUNK,)
+            for name in self.DSET_NAMES:
+                self._h5f.create_dataset(
+                    name, (0,), maxshape=(None,), chunks=chunks, dtype=dtype
+                )
             self._fptrs = []
         else:
-            temp_fnames = [
-                os.path.join(out_folder, fname) + str(os.getpid())
-                for fname in [".po.", ".pm.", ".cm."]
+            # One temporary section file per entry array, next to the output file
+            self._fptrs = [
+                tempfile.NamedTemporaryFile(
+                    "wb", prefix=prefix, dir=out_folder or ".", delete=False
+                )
+                for prefix in [".po.", ".pm.", ".cm."]
             ]
-            self._fptrs = [open(fname, "wb") for fname in temp_fnames]
 
     def finish_write(self):
         """Cleanup and close emc file
@@ -93,35 +137,37 @@ class EMCWriter(object):
         It then deletes those temp files. This function should be run before
         the script is exited.
         """
+        self.flush()
         for fptr in self._fptrs:
             fptr.close()
         if self.h5_output:
             self._h5f.close()
 
-        if self.num_data == 0:
-            print("No frames to write")
-            for fptr in self._fptrs:
-                os.system("rm " + fptr.name)
-            return
-
-        self.mean_count /= self.num_data
-        print("num_data = %d, mean_count = %.4e" % (self.num_data, self.mean_count))
+        try:
+            if self.num_data == 0:
+                print("No frames to write")
+                return
 
-        if not self.h5_output:
-            ones_arr = np.asarray(self.ones)
-            multi_arr = np.asarray(self.multi)
+            self.mean_count /= self.num_data
+            print(
+                "num_data = %d, mean_count = %.4e" % (self.num_data, self.mean_count)
+            )
 
-            fptr = open(self.out_fname, "wb")
-            header = np.zeros((256), dtype="i4")
-            header[0] = self.num_data
-            header[1] = self.num_pix
-            header.tofile(fptr)
-            ones_arr.astype("i4").tofile(fptr)
-            multi_arr.astype("i4").tofile(fptr)
-            fptr.close()
+            if not self.h5_output:
+                with open(self.out_fname, "wb") as fptr:
+                    header = np.zeros((256), dtype="i4")
+                    header[0] = self.num_data
+                    header[1] = self.num_pix
+                    header.tofile(fptr)
+                    np.asarray(self.ones, dtype="i4").tofile(fptr)
+                    np.asarray(self.multi, dtype="i4").tofile(fptr)
+                    for section in self._fptrs:
+                        with open(section.name, "rb") as fsection:
+                            shutil.copyfileobj(fsection, fptr, 16 * 1024 * 1024)
+        finally:
             for fptr in self._fptrs:
-                os.system("cat " + fptr.name + " >> " + self.out_fname)
-                os.system("rm " + fptr.name)
+                os.remove(fptr.name)
+            self._fptrs = []
 
     def write_frame(self, frame, fraction=1.0, partition=1):
         """Write given frame to the file
@@ -136,6 +182,9 @@ class EMCWriter(object):
         If fraction is less than 1, then each photon is written randomly with \
         the probability = fraction. by default, all photons are written. This \
         option is useful for performing tests with lower photons/frame.
+
+        If partition is more than 1, each photon is written randomly to one of \
+        the N sub-frames.
         """
         if len(frame.shape) != 1 or not np.issubdtype(frame.dtype, np.integer):
             raise ValueError(
@@ -144,41 +193,73 @@ class EMCWriter(object):
                 + " "
                 + str(frame.dtype)
             )
+        self.write_frames(frame[np.newaxis], fraction, partition)
+
+    def write_frames(self, frames, fraction=1.0, partition=1):
+        """Write a batch of frames to the file
+
+        The whole batch is sparsified in one vectorized pass and appended at once.
 
-        place_ones = np.where(frame == 1)[0]
-        place_multi = np.where(frame > 1)[0]
-        count_multi = frame[place_multi]
+        Arguments:
+            frames (int array) - Dense array with photon counts, shape=(num_frames,
+                                 num_pix) or (num_frames, py, px)
+            fraction (float, optional) - What fraction of photons to write
+            partition (int, optional) - Partition each frame into N sub-frames
+
+        See write_frame() for `fraction` and `partition`. The photon counts are
+        thinned binomially (fraction) or split multinomially (partition) with the
+        random generator of the writer, see `seed`. Pixels left with one photon are
+        written as single-photon pixels. With `partition`, the N sub-frames of a
+        frame are written one after the other.
+        """
+        frames = np.asarray(frames)
+        if frames.ndim < 2 or not np.issubdtype(frames.dtype, np.integer):
+            raise ValueError(
+                "write_frames needs an array of integer frames: "
+                + str(frames.shape)
+                + " "
+                + str(frames.dtype)
+            )
+        frames = frames.reshape(len(frames), -1)
+        num_frames = len(frames)
+
+        frame_ones, place_ones = np.nonzero(frames == 1)
+        frame_multi, place_multi = np.nonzero(frames > 1)
+        count_multi = frames[frame_multi, place_multi]
 
         if fraction < 1.0 and partition > 1:
             print("Can either split or reduce data frame")
             return
         elif partition > 1:
-            sel_ones = (np.random.random(len(place_ones)) * int(partition)).astype("i4")
-            sel_multi = (np.random.random(count_multi.sum()) * int(partition)).astype(
-                "i4"
+            partition = int(partition)
+            # Each photon goes to one of the sub-frames with equal probability
+            sub_ones = self.rng.integers(partition, size=len(place_ones))
+            sp_count_multi = self.rng.multinomial(
+                count_multi, np.full(partition, 1.0 / partition)
             )
-            sum_count_multi = count_multi.cumsum()
-            for i in range(int(partition)):
-                sp_count_multi = np.array(
-                    [a.sum() for a in np.split(sel_multi == i, sum_count_multi)]
-                )[:-1]
-                sp_place_multi = place_multi[sp_count_multi > 0]
-                sp_count_multi = sp_count_multi[sp_count_multi > 0]
-                self._update_file(
-                    place_ones[sel_ones == i], sp_place_multi, sp_count_multi
-                )
+            pixel, sub_multi = np.nonzero(sp_count_multi)
+            count_multi = sp_count_multi[pixel, sub_multi]
+            place_multi = place_multi[pixel]
+            frame_multi = frame_multi[pixel] * partition + sub_multi
+            frame_ones = frame_ones * partition + sub_ones
+            num_frames *= partition
         elif fraction < 1.0:
-            sel = np.random.random(len(place_ones)) < fraction
-            place_ones = place_ones[sel]
-            sel = np.random.random(count_multi.sum()) < fraction
-            count_multi = np.array(
-                [a.sum() for a in np.split(sel, count_multi.cumsum())]
-            )[:-1]
-            place_multi = place_multi[count_multi > 0]
-            count_multi = count_multi[count_multi > 0]
-            self._update_file(place_ones, place_multi, count_multi)
-        else:
-            self._update_file(place_ones, place_multi, count_multi)
+            # Each photon is kept with the probability = fraction
+            sel = self.rng.random(len(place_ones)) < fraction
+            frame_ones, place_ones = frame_ones[sel], place_ones[sel]
+            count_multi = self.rng.binomial(count_multi, fraction)
+        if partition > 1 or fraction < 1.0:
+            frame_ones, place_ones, frame_multi, place_multi, count_multi = _regroup(
+                frame_ones, place_ones, frame_multi, place_multi, count_multi
+            )
+
+        self._update_frames(
+            np.bincount(frame_ones, minlength=num_frames),
+            np.bincount(frame_multi, minlength=num_frames),
+            place_ones,
+            place_multi,
+            count_multi,
+        )
 
     def write_sparse_frame(self, place_ones, place_multi, count_multi):
         """Write sparse frame to file
@@ -201,23 +282,109 @@ class EMCWriter(object):
 
         self._update_file(place_ones, place_multi, count_multi)
 
+    def write_sparse_frames(self, ones, multi, place_ones, place_multi, count_multi):
+        """Write a batch of sparse frames to file
+
+        Arguments:
+            ones (int array) - Number of pixels with 1 photon in each frame
+            multi (int array) - Number of pixels with more than 1 photon in each frame
+            place_ones (int array) - Concatenated place_ones of all the frames
+            place_multi (int array) - Concatenated place_multi of all the frames
+            count_multi (int array) - Concatenated count_multi of all the frames
+        """
+        if len(ones) != len(multi):
+            raise ValueError("ones and multi should have equal lengths")
+        if np.sum(ones) != len(place_ones) or np.sum(multi) != len(place_multi):
+            raise ValueError("ones and multi do not match the sparse arrays")
+        if len(place_multi) != len(count_multi):
+            raise ValueError("place_multi and count_multi should have equal lengths")
+
+        self._update_frames(ones, multi, place_ones, place_multi, count_multi)
+
     def _update_file(self, place_ones, place_multi, count_multi):
-        self.num_data += 1
+        self._update_frames(
+            [len(place_ones)], [len(place_multi)], place_ones, place_multi, count_multi
+        )
+
+    def _update_frames(self, ones, multi, place_ones, place_multi, count_multi):
+        """Buffer a batch of sparse frames given as the number of entries of each frame
+        and the concatenated entries of all the frames"""
+        self.num_data += len(ones)
         self.mean_count += len(place_ones) + count_multi.sum()
-        self.ones.append(len(place_ones))
-        self.multi.append(len(place_multi))
-
+        self.ones.frombytes(np.asarray(ones, dtype=np.intc).tobytes())
+        self.multi.frombytes(np.asarray(multi, dtype=np.intc).tobytes())
+
+        self._buffer.append(
+            tuple(arr.astype(np.int32) for arr in [place_ones, place_multi, count_multi])
+        )
+        self._num_buffered += len(ones)
+        if self._num_buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered frames to the file"""
+        if self._num_buffered == 0:
+            return
+        start = self.num_data - self._num_buffered
+        ones = np.asarray(self.ones[start:], dtype=np.int32)
+        multi = np.asarray(self.multi[start:], dtype=np.int32)
+        entries = [np.concatenate(arrs) for arrs in zip(*self._buffer)]
         if self.h5_output:
-            self._h5f["place_ones"].resize((self.num_data,))
-            self._h5f["place_ones"][-1] = place_ones.astype(np.int32)
-            self._h5f["place_multi"].resize((self.num_data,))
-            self._h5f["place_multi"][-1] = place_multi.astype(np.int32)
-            self._h5f["count_multi"].resize((self.num_data,))
-            self._h5f["count_multi"][-1] = count_multi.astype(np.int32)
+            if self.flat:
+                _append(self._h5f["ones"], ones)
+                _append(self._h5f["multi"], multi)
+                for name, arr in zip(self.DSET_NAMES, entries):
+                    _append(self._h5f[name], arr)
+            else:
+                for name, arr, counts in zip(
+                    self.DSET_NAMES, entries, [ones, multi, multi]
+                ):
+                    rows = np.empty(len(counts), dtype=object)
+                    for i, row in enumerate(np.split(arr, np.cumsum(counts)[:-1])):
+                        rows[i] = row
+                    _append_rows(self._h5f[name], rows)
         else:
-            place_ones.astype(np.int32).tofile(self._fptrs[0])
-            place_multi.astype(np.int32).tofile(self._fptrs[1])
-            count_multi.astype(np.int32).tofile(self._fptrs[2])
+            for fptr, arr in zip(self._fptrs, entries):
+                arr.tofile(fptr)
+        self._buffer = []
+        self._num_buffered = 0
+
+
+def _regroup(frame_ones, place_ones, frame_multi, place_multi, count_multi):
+    """Move the multi-photon entries left with one photon to the single-photon entries,
+    drop the empty ones, and sort all the entries by frame and pixel"""
+    single = count_multi == 1
+    frame_ones = np.concatenate([frame_ones, frame_multi[single]])
+    place_ones = np.concatenate([place_ones, place_multi[single]])
+    order = np.lexsort((place_ones, frame_ones))
+    frame_ones, place_ones = frame_ones[order], place_ones[order]
+    multi = count_multi > 1
+    frame_multi, place_multi = frame_multi[multi], place_multi[multi]
+    count_multi = count_multi[multi]
+    order = np.lexsort((place_multi, frame_multi))
+    return (
+        frame_ones,
+        place_ones,
+        frame_multi[order],
+        place_multi[order],
+        count_multi[order],
+    )
+
+
+def _append(dset, arr):
+    """Append `arr` to a resizable 1D dataset with one resize and one slice write"""
+    size = dset.shape[0]
+    dset.resize((size + len(arr),))
+    dset[size:] = arr
+
+
+def _append_rows(dset, rows):
+    """Append the 1D object array of `rows` to a resizable vlen dataset. The rows are
+    written directly, since a slice assignment would broadcast rows of equal lengths
+    as a 2D array"""
+    size, num_rows = dset.shape[0], len(rows)
+    dset.resize((size + num_rows,))
+    dset.write_direct(rows, np.s_[0:num_rows], np.s_[size : size + num_rows])
 
 
 # For geometry
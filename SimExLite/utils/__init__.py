@@ -4,21 +4,149 @@
 # See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
 """Basic utility module"""
 
+from functools import reduce
 import numpy as np
 
+# The ufuncs reducing the bins, (default, NaN-aware)
+_REBIN_UFUNCS = {
+    "sum": (np.add, np.add),
+    "mean": (np.add, np.add),
+    "max": (np.maximum, np.fmax),
+}
 
-def rebin_sum(arr:np.ndarray, new_shape):
-    n_dim = [arr.shape[0] // new_shape[0], arr.shape[1] // new_shape[1]]
-    shape = (new_shape[0], n_dim[0], new_shape[1], n_dim[1])
-    # extra_rows = arr[new_shape[0] * n_dim[0]:, :]
-    # extra_cols = arr[:, new_shape[1] * n_dim[1]:]
-    # if len(extra_rows) > 0:
-    #     arr[new_shape[0] * n_dim[0] - 1, :] += extra_rows.sum(axis=0)
-    # if len(extra_cols) > 0:
-    #     arr[:, new_shape[1] * n_dim[1] - 1] += extra_cols.sum(axis=1)
-    return (
-        arr[: new_shape[0] * n_dim[0], : new_shape[1] * n_dim[1]]
-        .reshape(shape)
-        .sum(-1)
-        .sum(-2)
-    )
+
+def rebin_sum(arr: np.ndarray, new_shape):
+    """Sum up the 2D `arr` into the bins of `new_shape`, the remainder rows and
+    columns are dropped. See :func:`rebin`."""
+    return rebin(arr, new_shape, reducer="sum")
+
+
+def rebin(
+    arr,
+    new_shape=None,
+    factor=None,
+    reducer: str = "sum",
+    remainder: str = "crop",
+    nan_aware: bool = False,
+    chunk_size: int = None,
+    out=None,
+):
+    """Rebin the last axes of an array, e.g. the (ss, fs) axes of a stack of
+    patterns (frames, ss, fs), without Python loops over the bins.
+
+    Args:
+        arr (array-like): The array to rebin. With `chunk_size`, any array-like
+            supporting slicing along the first axis, e.g. an h5py dataset, a memmap or a
+            :class:`LazyPatternArray`, is read chunk by chunk.
+        new_shape (tuple): The binned shape of the last `len(new_shape)` axes.
+        factor (int or tuple): The bin size of the last axes, an int for the last two
+            axes. Either `new_shape` or `factor` is required.
+        reducer (str): How to reduce a bin, 'sum', 'mean' or 'max'.
+        remainder (str): What to do with the remainder pixels that don't fill up a bin:
+            'crop' drops them, 'merge' adds them to the last bin and 'pad' reduces them
+            into an extra, partial bin (only with `factor`).
+        nan_aware (bool): Whether to ignore NaN. A bin is NaN only if all its pixels
+            are NaN. By default NaN propagates to its bin.
+        chunk_size (int): The number of entries of the first axis rebinned at once. The
+            first axis must not be rebinned.
+        out (array-like): The output array, e.g. an h5py dataset or a memmap, allocated
+            if it's `None`.
+
+    Returns:
+        ndarray: The rebinned array, or `out`.
+    """
+    if reducer not in _REBIN_UFUNCS:
+        raise ValueError(f"Unknown reducer {reducer}, please use sum, mean or max.")
+    shape = np.shape(arr)
+    bins = _get_rebin_bins(shape, new_shape, factor, remainder)
+    ndim = len(shape)
+    if chunk_size is None:
+        result = _rebin(np.asarray(arr), bins, reducer, nan_aware)
+        if out is None:
+            return result
+        out[...] = result
+        return out
+    if len(bins) >= ndim:
+        raise ValueError("The first axis can't be rebinned chunk by chunk.")
+    for start in range(0, shape[0], chunk_size):
+        chunk = np.asarray(arr[start : start + chunk_size])
+        result = _rebin(chunk, bins, reducer, nan_aware)
+        if out is None:
+            out = np.empty(shape[:1] + result.shape[1:], result.dtype)
+        out[start : start + len(result)] = result
+    return out
+
+
+def _get_rebin_bins(shape, new_shape, factor, remainder):
+    """Get the (start indices, stop) of the bins of each of the last axes."""
+    if (new_shape is None) == (factor is None):
+        raise ValueError("Please set either new_shape or factor.")
+    if remainder not in ("crop", "merge", "pad"):
+        raise ValueError(f"Unknown remainder {remainder}, please use crop, merge or pad.")
+    if factor is not None:
+        factor = (factor, factor) if np.ndim(factor) == 0 else tuple(factor)
+        if len(factor) > len(shape):
+            raise ValueError(f"Can't rebin an array of shape {shape} by {factor}.")
+        sizes = shape[len(shape) - len(factor) :]
+        if remainder == "pad":
+            new_shape = [-(-n // int(f)) if f > 0 else 0 for n, f in zip(sizes, factor)]
+        else:
+            new_shape = [n // int(f) if f > 0 else 0 for n, f in zip(sizes, factor)]
+    elif remainder == "pad":
+        raise ValueError("remainder='pad' requires factor instead of new_shape.")
+    else:
+        if len(new_shape) > len(shape):
+            raise ValueError(f"Can't rebin an array of shape {shape} into {new_shape}.")
+        sizes = shape[len(shape) - len(new_shape) :]
+        factor = [n // int(m) if m > 0 else 0 for n, m in zip(sizes, new_shape)]
+    bins = []
+    for n, m, f in zip(sizes, new_shape, factor):
+        m, f = int(m), int(f)
+        if f < 1 or m < 1:
+            raise ValueError(f"Can't rebin an array of shape {shape} into {new_shape}.")
+        stop = m * f if remainder == "crop" else n
+        bins.append((np.arange(m) * f, stop, f))
+    return bins
+
+
+def _rebin(arr, bins, reducer, nan_aware):
+    """Rebin the last axes of `arr` in memory."""
+    # Drop the cropped remainder
+    data = arr[(Ellipsis,) + tuple(slice(stop) for _, stop, _ in bins)]
+    if reducer != "max":
+        if data.dtype.kind == "b":
+            data = data.astype(np.int_)
+        elif data.dtype.kind in "iu" and data.dtype.itemsize < np.dtype(np.int_).itemsize:
+            data = data.astype(np.int_ if data.dtype.kind == "i" else np.uint)
+    nan_mask = None
+    if nan_aware and reducer != "max" and data.dtype.kind in "fc":
+        nan_mask = np.isnan(data)
+        data = np.where(nan_mask, 0, data)
+    data = _reduce_bins(_REBIN_UFUNCS[reducer][nan_aware], data, bins)
+    if nan_mask is not None:
+        # The number of the non-NaN pixels of the bins
+        counts = _reduce_bins(np.add, (~nan_mask).astype(np.int_), bins)
+    elif reducer == "mean":
+        sizes = [np.diff(np.append(starts, stop)) for starts, stop, _ in bins]
+        counts = reduce(np.multiply, np.ix_(*sizes))
+    if reducer == "mean":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return data / counts
+    if nan_mask is not None:
+        data[counts == 0] = np.nan
+    return data
+
+
+def _reduce_bins(ufunc, data, bins):
+    """Reduce the bins of the last axes with `ufunc`. Evenly sized bins are reduced
+    at once through a reshape, otherwise each axis is reduced with `reduceat`."""
+    first_axis = data.ndim - len(bins)
+    if all(stop == len(starts) * f for starts, stop, f in bins):
+        shape = data.shape[:first_axis]
+        for starts, _, f in bins:
+            shape += (len(starts), f)
+        axes = tuple(range(first_axis + 1, first_axis + 2 * len(bins), 2))
+        return ufunc.reduce(data.reshape(shape), axis=axes)
+    for i, (starts, _, _) in enumerate(bins):
+        data = ufunc.reduceat(data, starts, axis=first_axis + i)
+    return data
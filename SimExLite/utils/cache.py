@@ -0,0 +1,71 @@
+# Copyright (C) 2023 Juncheng E
+# Contact: Juncheng E <juncheng.e@xfel.eu>
+# This file is part of SimEx-Lite which is released under GNU General Public License v3.
+# See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
+"""On-disk cache of derived files, e.g. parsed detector files. The cache is off by
+default, it's turned on by the `cache` arguments of the cached functions or by setting
+`$SIMEXLITE_CACHE=1`."""
+
+import hashlib
+import os
+from pathlib import Path
+
+
+def use_cache(cache: bool = None) -> bool:
+    """Whether to use the on-disk cache: `cache` if it's given, otherwise whether
+    `$SIMEXLITE_CACHE` is set to 1, true or yes."""
+    if cache is not None:
+        return bool(cache)
+    return os.environ.get("SIMEXLITE_CACHE", "").lower() in ("1", "true", "yes")
+
+
+def get_cache_dir() -> Path:
+    """Get the cache directory, `$SIMEXLITE_CACHE_DIR` or `~/.cache/SimExLite`."""
+    cache_dir = os.environ.get("SIMEXLITE_CACHE_DIR")
+    if not cache_dir:
+        cache_dir = Path.home() / ".cache" / "SimExLite"
+    return Path(cache_dir)
+
+
+def get_file_hash(filename: str, block_size: int = 1 << 24) -> str:
+    """Get the SHA1 hex digest of the content of a file, read block by block."""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as fptr:
+        for block in iter(lambda: fptr.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_params_hash(*params) -> str:
+    """Get the SHA1 hex digest of the representation of some parameters."""
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+
+def get_cache_path(category: str, key: str, suffix: str = "") -> Path:
+    """Get the path of the cache file of `key` in the `category` subdirectory."""
+    return get_cache_dir() / category / (key + suffix)
+
+
+def write_cache_file(path: Path, write_func) -> bool:
+    """Write a cache file atomically: `write_func` writes a temporary file which is
+    renamed to `path`, so concurrent readers never see a partial cache file.
+
+    Args:
+        path (Path): The cache file path.
+        write_func (callable): A function writing the file of the name it's given.
+
+    Returns:
+        bool: Whether the cache file was written. A cache which can't be written, e.g.
+        in a read-only file system, is not an error.
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp{path.suffix}")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_func(str(tmp_path))
+        os.replace(tmp_path, path)
+        return True
+    except OSError as err:
+        print(f"Could not write the cache file {path}: {err}")
+        if tmp_path.exists():
+            tmp_path.unlink()
+        return False
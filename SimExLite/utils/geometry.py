@@ -3,6 +3,7 @@
 # This file is part of SimEx-Lite which is released under GNU General Public License v3.
 # See file LICENSE or go to <http://www.gnu.org/licenses> for full license details.
 
+import hashlib
 from extra_geom import GenericGeometry
 import numpy as np
 
@@ -68,3 +69,24 @@ def writeSimpleGeometry(
     geom.write_crystfel_geom(
         fn, clen=clen, adu_per_ev=adu_per_ev, photon_energy=photon_energy
     )
+
+
+def get_geom_fingerprint(geom) -> str:
+    """Get a fingerprint of an extra_geom geometry. Geometries with the same module
+    layout have the same fingerprint, so it can be used as a cache key.
+
+    :param geom: extra_geom geometry instance
+    :type geom: `extra_geom.base.DetectorGeometryBase`
+
+    :return: The hexadecimal SHA1 digest of the geometry
+    :rtype: str
+    """
+    sha = hashlib.sha1(type(geom).__name__.encode())
+    sha.update(np.asarray(geom.pixel_size, dtype=np.float64).tobytes())
+    sha.update(np.asarray(geom.expected_data_shape, dtype=np.int64).tobytes())
+    for module in geom.modules:
+        for tile in module:
+            for vec in (tile.corner_pos, tile.ss_vec, tile.fs_vec):
+                sha.update(np.asarray(vec, dtype=np.float64).tobytes())
+            sha.update(np.array([tile.ss_pixels, tile.fs_pixels], dtype=np.int64))
+    return sha.hexdigest()
@@ -1,6 +1,59 @@
 """Test DiffractionData"""
 
-from SimExLite.DiffractionData import DiffractionData, SingFELFormat, EMCFormat
+import importlib
+import os
+import pytest
+import h5py
+import numpy as np
+from SimExLite.DiffractionData import (
+    DiffractionData,
+    SingFELFormat,
+    EMCFormat,
+    CustomizedFormat,
+)
+from SimExLite.DiffractionData import (
+    LazyPatternArray,
+    BufferManager,
+    get_buffer_manager,
+    set_buffer_manager,
+)
+from SimExLite.DiffractionData.DiffractionData import (
+    R_d,
+    addBeamStop,
+    get_beam_center,
+    get_beam_stop_mask,
+    get_geom_gaps,
+    get_rfactor,
+    map_chunks,
+    write_multiple_file_to_emc,
+)
+from SimExLite.utils.geometry import getSimpleGeometry
+from extra_geom import GenericGeometry
+
+
+def get_synthetic_dict(n=6, shape=(9, 11), lam=0.5, seed=0):
+    """Get a small synthetic photon data dict"""
+    rng = np.random.default_rng(seed)
+    data_dict = {
+        "img_array": rng.poisson(lam, (n,) + shape).astype(np.float64),
+        "distance": 0.13,
+        "quaternions": None,
+        "geom": getSimpleGeometry(1e-3, shape[1], shape[0]),
+    }
+    return data_dict
+
+
+def write_synthetic_customized(fn, n=5, shape=(9, 11), dtype="f4"):
+    """Write a small synthetic file in the customized format"""
+    arr = np.random.default_rng(0).random((n,) + shape).astype(dtype)
+    with h5py.File(fn, "w") as h5:
+        h5["patterns"] = arr
+        h5["detectorDistance"] = 0.13
+        h5["pixelSize"] = 1e-3
+        h5["binning"] = 1
+        h5["fluence"] = 1.0
+        h5["photonEnergy"] = 4960.0
+    return arr
 
 
 def test_print_format_keys():
@@ -63,3 +116,356 @@ def test_readEMC(tmp_path):
     )
     data_dict = EMCData.get_data()
     assert data_dict["img_array"].shape == (13, 81, 81)
+
+
+def test_read_dtype(tmp_path):
+    data_dict = get_synthetic_dict()
+    dd = DiffractionData.from_dict(data_dict, "synthetic")
+    emc_fn = str(tmp_path / "EMC.h5")
+    dd.write(emc_fn, EMCFormat)
+    emc_dict = EMCFormat.read(emc_fn, pattern_shape=(9, 11))
+    assert emc_dict["img_array"].dtype == np.int32
+    assert np.array_equal(emc_dict["img_array"], data_dict["img_array"])
+    emc_dict = EMCFormat.read(emc_fn, pattern_shape=(9, 11), dtype="f8")
+    assert emc_dict["img_array"].dtype == np.float64
+
+    customized_fn = str(tmp_path / "customized.h5")
+    arr = write_synthetic_customized(customized_fn)
+    customized_dict = CustomizedFormat.read(customized_fn)
+    assert customized_dict["img_array"].dtype == np.float32
+    assert np.array_equal(customized_dict["img_array"], arr)
+    customized_dict = CustomizedFormat.read(customized_fn, index="1:3", dtype="f8")
+    assert customized_dict["img_array"].dtype == np.float64
+
+
+def test_buffer_manager(tmp_path):
+    manager = BufferManager(scratch_dir=str(tmp_path / "scratch"), max_bytes=100)
+    small = manager.allocate((2, 3), "i4")
+    assert not isinstance(small, np.memmap)
+    arr_a = manager.allocate((10, 9, 11), "i4")
+    arr_b = manager.allocate((10, 9, 11), "f4")
+    assert isinstance(arr_a, np.memmap)
+    assert arr_a.dtype == np.int32 and arr_b.dtype == np.float32
+    assert arr_a.filename != arr_b.filename
+    assert len(manager.filenames) == 2
+    manager.release(arr_a)
+    assert len(manager.filenames) == 1
+    manager.close()
+    assert list((tmp_path / "scratch").iterdir()) == []
+
+
+def test_buffer_manager_scratch_dir(tmp_path, monkeypatch):
+    # Not in the system temporary directory, which is often in RAM
+    monkeypatch.setenv("SIMEXLITE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("SIMEXLITE_SCRATCH_DIR", raising=False)
+    with BufferManager(max_bytes=0) as manager:
+        arr = manager.allocate((2, 3))
+        assert os.path.dirname(arr.filename) == str(tmp_path / "cache" / "scratch")
+        monkeypatch.setenv("SIMEXLITE_SCRATCH_DIR", str(tmp_path / "env"))
+        arr = manager.allocate((2, 3))
+        assert os.path.dirname(arr.filename) == str(tmp_path / "env")
+        # Next to an output file
+        arr = manager.allocate((2, 3), scratch_dir=str(tmp_path / "out"))
+        assert os.path.dirname(arr.filename) == str(tmp_path / "out")
+        del arr
+    for name in ["cache/scratch", "env", "out"]:
+        assert list((tmp_path / name).iterdir()) == []
+
+
+def test_read_out_of_core(tmp_path):
+    customized_fn = str(tmp_path / "customized.h5")
+    arr = write_synthetic_customized(customized_fn)
+    default_manager = get_buffer_manager()
+    with BufferManager(scratch_dir=str(tmp_path / "scratch"), max_bytes=0) as manager:
+        set_buffer_manager(manager)
+        try:
+            img_array = CustomizedFormat.read(customized_fn)["img_array"]
+        finally:
+            set_buffer_manager(default_manager)
+        assert isinstance(img_array, np.memmap)
+        assert img_array.dtype == np.float32
+        assert np.array_equal(img_array, arr)
+        del img_array
+    assert list((tmp_path / "scratch").iterdir()) == []
+
+
+def test_lazy_read(tmp_path):
+    data_dict = get_synthetic_dict(n=20)
+    arr = data_dict["img_array"]
+    emc_fn = str(tmp_path / "EMC.h5")
+    DiffractionData.from_dict(data_dict, "synthetic").write(emc_fn, EMCFormat)
+    customized_fn = str(tmp_path / "customized.h5")
+    write_synthetic_customized(customized_fn, n=20)
+    lazy_emc = EMCFormat.read(emc_fn, pattern_shape=(9, 11), lazy=True)["img_array"]
+    lazy_customized = CustomizedFormat.read(customized_fn, lazy=True)["img_array"]
+    for lazy, eager in [
+        (lazy_emc, arr),
+        (lazy_customized, CustomizedFormat.read(customized_fn)["img_array"]),
+    ]:
+        assert isinstance(lazy, LazyPatternArray)
+        assert len(lazy) == 20 and lazy.shape == (20, 9, 11)
+        assert np.array_equal(lazy[3], eager[3])
+        assert np.array_equal(lazy[-1], eager[-1])
+        assert np.array_equal(lazy[2:15:3], eager[2:15:3])
+        assert np.array_equal(lazy[[7, 2, 7]], eager[[7, 2, 7]])
+        assert np.array_equal(lazy[5:9, 1:3, 4], eager[5:9, 1:3, 4])
+        assert np.array_equal(np.asarray(lazy), eager)
+        assert np.array_equal(np.array([frame for frame in lazy]), eager)
+
+    lazy_sub = EMCFormat.read(emc_fn, index="10:", pattern_shape=(9, 11), lazy=True)
+    assert np.array_equal(lazy_sub["img_array"][::-1], arr[10:][::-1])
+
+
+def test_lazy_cache():
+    reads = []
+
+    def read_frames(indices):
+        reads.append(list(indices))
+        return np.array([np.full((2, 2), i) for i in indices])
+
+    lazy = LazyPatternArray(read_frames, np.arange(10, 20), (2, 2), "i4", cache_size=3)
+    assert lazy[0][0, 0] == 10
+    assert lazy[[1, 0]][1][0, 0] == 10
+    assert reads == [[10], [11]]
+    lazy[2:6]
+    assert reads[-1] == [12, 13, 14, 15]
+    # Only the 3 most recently used patterns are cached
+    lazy[0]
+    assert reads[-1] == [10]
+
+
+def test_lazy_operation_check(tmp_path):
+    customized_fn = str(tmp_path / "customized.h5")
+    write_synthetic_customized(customized_fn)
+    data_dict = CustomizedFormat.read(customized_fn, lazy=True)
+    dd = DiffractionData.from_dict(data_dict, "lazy")
+    with pytest.raises(TypeError):
+        dd.multiply(2)
+
+
+def test_pipeline_in_memory():
+    data_dict = get_synthetic_dict(n=10)
+    arr = data_dict["img_array"].copy()
+    dd = DiffractionData.from_dict(data_dict, "synthetic")
+    scales = np.arange(10)
+    out = (
+        dd.pipeline()
+        .scale(scales)
+        .add(1.0)
+        .beam_stop(2)
+        .astype(np.float32)
+        .run(chunk_size=3)
+    )
+    expected = arr * scales[:, None, None] + 1.0
+    expected[:, addBeamStop(np.ones((9, 11)), 2) == 0] = 0
+    out_arr = out.get_data()["img_array"]
+    assert out_arr.dtype == np.float32
+    assert np.allclose(out_arr, expected)
+    # The input is untouched
+    assert np.array_equal(data_dict["img_array"], arr)
+
+
+def test_pipeline_seed():
+    dd = DiffractionData.from_dict(get_synthetic_dict(n=10), "synthetic")
+    first = dd.pipeline().scale(10).poissonize(seed=1).run(chunk_size=4)
+    second = dd.pipeline().scale(10).poissonize(seed=1).run(chunk_size=4)
+    assert np.array_equal(first.get_data()["img_array"], second.get_data()["img_array"])
+
+
+def test_pipeline_stream_write(tmp_path):
+    customized_fn = str(tmp_path / "customized.h5")
+    arr = write_synthetic_customized(customized_fn, n=7, dtype="f8")
+    dd = DiffractionData.from_file(customized_fn, CustomizedFormat, "customized")
+    # From a file mapping to the EMC format, without loading all the patterns
+    emc_fn = str(tmp_path / "photons.h5")
+    emc = dd.pipeline().scale(10).poissonize(seed=0).run(
+        chunk_size=3, filename=emc_fn, format_class=EMCFormat
+    )
+    in_memory = dd.pipeline().scale(10).poissonize(seed=0).run(chunk_size=3)
+    assert np.array_equal(
+        emc.get_data()["img_array"], in_memory.get_data()["img_array"]
+    )
+    # To the stacked singfel layout
+    singfel_fn = str(tmp_path / "singfel.h5")
+    singfel = dd.pipeline().scale(2).run(
+        chunk_size=3, filename=singfel_fn, format_class=SingFELFormat
+    )
+    assert np.allclose(singfel.get_data()["img_array"], arr * 2)
+    # And back to the customized format
+    out_fn = str(tmp_path / "customized_out.h5")
+    singfel.pipeline().add(1).run(
+        chunk_size=5, filename=out_fn, format_class=CustomizedFormat
+    )
+    with h5py.File(out_fn, "r") as h5:
+        assert np.allclose(h5["patterns"][()], arr * 2 + 1)
+
+
+def test_beam_stop_mask():
+    shape = (9, 11)
+    mask = get_beam_stop_mask(shape, 2)
+    assert mask.dtype == bool
+    assert mask.flags.writeable is False
+    assert get_beam_stop_mask(shape, 2.0, (4, 5)) is mask
+    # The legacy per-image implementation
+    y = np.indices(shape)[0] - 4
+    x = np.indices(shape)[1] - 5
+    assert np.array_equal(mask, np.sqrt(x * x + y * y) <= 2)
+    img = np.random.default_rng(0).random(shape)
+    assert np.array_equal(addBeamStop(img, 2), img * ~mask)
+    off_centre = get_beam_stop_mask(shape, 1, (1, 2))
+    assert off_centre[1, 2] and off_centre[0, 2] and not off_centre[4, 5]
+
+
+def test_add_beam_stop():
+    data_dict = get_synthetic_dict(n=5)
+    arr = data_dict["img_array"].copy()
+    dd = DiffractionData.from_dict(data_dict, "synthetic")
+    dd.add_beam_stop(2, chunk_size=2)
+    assert np.array_equal(data_dict["img_array"], [addBeamStop(img, 2) for img in arr])
+    # An off-centre beam taken from the geometry
+    shift = 2e-3
+    geom = data_dict["geom"]
+    data_dict["geom"] = GenericGeometry.from_simple_description(
+        pixel_size=1e-3,
+        slow_pixels=9,
+        fast_pixels=11,
+        corner_coordinates=[np.array([-5e-3 + shift, -4e-3, 0.0])],
+        ss_vec=np.array([0, 1, 0]),
+        fs_vec=np.array([1, 0, 0]),
+    )
+    center = get_beam_center(data_dict["geom"], (9, 11))
+    assert center != get_beam_center(geom, (9, 11))
+    data_dict["img_array"] = np.ones_like(arr)
+    dd.add_beam_stop(1, geom_center=True)
+    assert np.array_equal(
+        data_dict["img_array"][0] == 0, get_beam_stop_mask((9, 11), 1, center)
+    )
+
+
+def test_apply_geom_mask(tmp_path):
+    dd_module = importlib.import_module("SimExLite.DiffractionData.DiffractionData")
+    geom = GenericGeometry.from_simple_description(
+        pixel_size=1e-3,
+        slow_pixels=4,
+        fast_pixels=11,
+        corner_coordinates=[
+            np.array([-5.5e-3, 1.5e-3, 0.0]),
+            np.array([-5.5e-3, -5.5e-3, 0.0]),
+        ],
+        ss_vec=np.array([0, 1, 0]),
+        fs_vec=np.array([1, 0, 0]),
+    )
+    data_dict = get_synthetic_dict(n=5, shape=(11, 11))
+    arr = data_dict["img_array"].copy()
+    dd = DiffractionData.from_dict(data_dict, "synthetic")
+    mask_file = str(tmp_path / "mask.h5")
+    mask = dd.apply_geom_mask(geom, mask_file=mask_file, chunk_size=2)
+    gaps = np.isnan(mask)
+    assert gaps.any() and not gaps.all()
+    assert np.all(data_dict["img_array"][:, gaps] == -1)
+    assert np.array_equal(data_dict["img_array"][:, ~gaps], arr[:, ~gaps])
+    # The gaps are cached in memory and persisted in the mask file
+    assert get_geom_gaps(geom, (11, 11)) is get_geom_gaps(geom, (11, 11))
+    dd_module._geom_gaps.clear()
+    with h5py.File(mask_file, "r") as h5:
+        assert len(h5["geom_mask"]) == 1
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(geom, "position_modules", None)
+        assert np.array_equal(get_geom_gaps(geom, (11, 11), mask_file), gaps)
+
+
+def test_seeded_noise():
+    data_dict = get_synthetic_dict(n=10, lam=20)
+    arr = data_dict["img_array"].copy()
+    results = []
+    for n_workers in [1, 3]:
+        data_dict["img_array"] = arr.copy()
+        dd = DiffractionData.from_dict(data_dict, "synthetic")
+        dd.poissonize(seed=3, n_workers=n_workers, chunk_size=4)
+        dd.add_Gaussian_noise(10, [0.1, 1.0], seed=4, n_workers=n_workers, chunk_size=4)
+        results.append(data_dict["img_array"])
+    # Reproducible no matter how many workers are used
+    assert np.array_equal(results[0], results[1])
+    assert not np.array_equal(results[0], arr)
+    # Consistent with the pipeline
+    dd = DiffractionData.from_dict(dict(data_dict, img_array=arr), "synthetic")
+    piped = dd.pipeline().poissonize(seed=3).gaussian_noise(10, [0.1, 1.0], seed=4)
+    assert np.allclose(piped.run(chunk_size=4).get_data()["img_array"], results[0])
+
+
+def test_write_multiple_file_to_emc(tmp_path):
+    in_files = []
+    for i in range(3):
+        fn = str(tmp_path / f"customized_{i}.h5")
+        write_synthetic_customized(fn, n=4 + i, dtype="f8")
+        in_files.append(fn)
+    geom = getSimpleGeometry(1e-3, 11, 9)
+    outputs = []
+    for n_workers in [1, 2]:
+        out_fn = str(tmp_path / f"photons_{n_workers}.h5")
+        write_multiple_file_to_emc(
+            in_files,
+            CustomizedFormat,
+            out_fn,
+            poissonize=True,
+            stop_rad=1,
+            multiply=5,
+            fluct_sample_interval=3,
+            geom=geom,
+            n_workers=n_workers,
+            seed=7,
+        )
+        outputs.append(EMCFormat.read(out_fn, pattern_shape=(9, 11))["img_array"])
+        with h5py.File(out_fn, "r") as h5:
+            assert len(h5["fluct_I"]) == 15
+    assert outputs[0].shape == (15, 9, 11)
+    assert outputs[0].sum() > 0
+    assert np.array_equal(outputs[0], outputs[1])
+    assert np.all(outputs[0][:, get_beam_stop_mask((9, 11), 1)] == 0)
+
+
+def test_get_rfactor():
+    rng = np.random.default_rng(0)
+    img = rng.poisson(3.0, (9, 16, 20)).astype(float)
+    img_ref = rng.random((9, 16, 20)) * 3
+    sa_array = rng.random((16, 20)) + 0.5
+    center = np.array([8.0, 10.0])[:, np.newaxis, np.newaxis]
+    radial_map = np.linalg.norm(np.indices((16, 20)) - center, axis=0)
+    pixel_map = np.abs(np.indices((16, 20))[1] - 10.0)
+    for kwargs in [{}, {"pixel_map": pixel_map, "bin_range": [2, 7], "bin_size": 0.5}]:
+        bins, R_factors = get_rfactor(img, img_ref, sa_array, chunk_size=4, **kwargs)
+        pmap = kwargs.get("pixel_map", radial_map)
+        expected = [R_d(pmap <= b, img, img_ref, sa_array) for b in bins]
+        assert R_factors.shape == (len(bins), 9)
+        assert np.allclose(R_factors, expected, rtol=1e-12)
+
+
+def test_pipeline_rebin():
+    data_dict = get_synthetic_dict(n=5)
+    dd = DiffractionData.from_dict(data_dict, "synthetic")
+    out = dd.pipeline().rebin(factor=2, reducer="max", remainder="pad").run(chunk_size=2)
+    out_arr = out.get_data()["img_array"]
+    assert out_arr.shape == (5, 5, 6)
+    assert np.array_equal(out_arr[:, -1, -1], data_dict["img_array"][:, -1, -1])
+
+
+def test_float_operation_on_int_patterns(tmp_path):
+    data_dict = get_synthetic_dict(lam=5)
+    emc_fn = str(tmp_path / "EMC.h5")
+    DiffractionData.from_dict(data_dict, "synthetic").write(emc_fn, EMCFormat)
+    emc_dict = EMCFormat.read(emc_fn, pattern_shape=(9, 11))
+    assert emc_dict["img_array"].dtype == np.int32
+    dd = DiffractionData.from_dict(emc_dict, "emc")
+    # The int32 patterns are upcast instead of truncated
+    dd.multiply(0.5)
+    assert emc_dict["img_array"].dtype == np.float64
+    assert np.allclose(emc_dict["img_array"], data_dict["img_array"] * 0.5)
+    dd.add_Gaussian_noise(10, [0.1, 1.0], seed=0)
+    assert not np.allclose(emc_dict["img_array"], data_dict["img_array"] * 0.5)
+    # Integer operations keep the dtype
+    emc_dict = EMCFormat.read(emc_fn, pattern_shape=(9, 11))
+    DiffractionData.from_dict(emc_dict, "emc").multiply(2)
+    assert emc_dict["img_array"].dtype == np.int32
+    assert np.array_equal(emc_dict["img_array"], data_dict["img_array"] * 2)
+    with pytest.raises(TypeError):
+        map_chunks(emc_dict["img_array"], lambda chunk, rng: chunk * 0.5)
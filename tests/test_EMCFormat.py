@@ -0,0 +1,367 @@
+"""Test EMC format"""
+
+import h5py
+import numpy as np
+import pytest
+from SimExLite.DiffractionData import DiffractionData, EMCFormat, SparsePatternArray
+from SimExLite.DiffractionData import DetectorEMC, writeEMCGeom, writeemc
+from SimExLite.DiffractionData.EMCFormat import (
+    EMCBinaryReader,
+    EMCH5Reader,
+    PatternsSOneWriter,
+    concatenateEMC,
+    convertEMC,
+    dense_to_PatternsSOne,
+    getPatternDtype,
+    getPatternTotal,
+    openEMCReader,
+    parse_bin_PatternsSOne,
+    splitEMC,
+    subsetEMC,
+)
+
+
+def get_photons(n=25, shape=(9, 11), lam=0.8, seed=0):
+    """Get synthetic photon count patterns"""
+    rng = np.random.default_rng(seed)
+    return rng.poisson(lam, (n,) + shape).astype(np.int32)
+
+
+def write_photons(fn, arr, **kwargs):
+    """Write the patterns frame by frame with EMCWriter"""
+    with writeemc.EMCWriter(fn, arr[0].size, **kwargs) as emcwriter:
+        for photons in arr:
+            emcwriter.write_frame(photons.ravel())
+
+
+def test_buffered_writer(tmp_path):
+    arr = get_photons()
+    for flat in [False, True]:
+        fn = str(tmp_path / f"photons_{flat}.h5")
+        write_photons(fn, arr, buffer_size=7, flat=flat)
+        with h5py.File(fn, "r") as h5:
+            is_vlen = h5py.check_vlen_dtype(h5["place_ones"].dtype) is not None
+            assert is_vlen is not flat
+            assert len(h5["count_multi"]) > 0
+        assert getPatternTotal(fn) == 25
+        assert getPatternDtype(fn) == np.int32
+        data_dict = EMCFormat.read(fn, pattern_shape=(9, 11))
+        assert np.array_equal(data_dict["img_array"], arr)
+
+
+def test_writer_equal_row_lengths(tmp_path):
+    # The vlen rows of a flushed batch all have the same length
+    single = get_photons(n=1)
+    ones_only = np.zeros((4, 9, 11), dtype=np.int32)
+    ones_only[:, 2, 3] = 1
+    ones_only[:, 5, 7] = 1
+    # A remainder of one frame after the first 1000
+    many = get_photons(n=1001, lam=0.1)
+    for name, arr in [("single", single), ("ones_only", ones_only), ("many", many)]:
+        fn = str(tmp_path / f"{name}.h5")
+        write_photons(fn, arr)
+        assert getPatternTotal(fn) == len(arr)
+        data_dict = EMCFormat.read(fn, pattern_shape=(9, 11))
+        assert np.array_equal(data_dict["img_array"], arr)
+    fn = str(tmp_path / "ones_only_frames.h5")
+    with writeemc.EMCWriter(fn, 99) as emcwriter:
+        emcwriter.write_frames(ones_only)
+    data_dict = EMCFormat.read(fn, pattern_shape=(9, 11))
+    assert np.array_equal(data_dict["img_array"], ones_only)
+
+
+def test_buffered_writer_binary(tmp_path):
+    arr = get_photons()
+    fn = str(tmp_path / "photons.emc")
+    write_photons(fn, arr, hdf5=False, buffer_size=4)
+    data_dict = EMCFormat.read(fn, pattern_shape=(9, 11))
+    assert np.array_equal(data_dict["img_array"], arr)
+
+
+def test_write_flat(tmp_path):
+    arr = get_photons(n=5)
+    dd = DiffractionData.from_dict(
+        {"img_array": arr, "distance": None, "quaternions": None, "geom": None},
+        "photons",
+    )
+    fn = str(tmp_path / "flat.h5")
+    emc = dd.write(fn, EMCFormat, flat=True)
+    with h5py.File(fn, "r") as h5:
+        assert len(h5["ones"]) == 5
+    assert np.array_equal(emc.get_data()["img_array"], arr)
+
+
+def test_write_frames(tmp_path):
+    arr = get_photons(n=12, lam=1.5)
+    frame_fn = str(tmp_path / "frame.h5")
+    write_photons(frame_fn, arr)
+    frames_fn = str(tmp_path / "frames.h5")
+    with writeemc.EMCWriter(frames_fn, arr[0].size, buffer_size=5) as emcwriter:
+        emcwriter.write_frames(arr[:7])
+        emcwriter.write_frames(arr[7:].reshape(5, -1))
+    for name in ["place_ones", "place_multi", "count_multi"]:
+        with h5py.File(frame_fn, "r") as h5, h5py.File(frames_fn, "r") as h5_batch:
+            for row, row_batch in zip(h5[name], h5_batch[name]):
+                assert np.array_equal(row, row_batch)
+
+
+def test_write_frames_fraction_partition(tmp_path):
+    arr = get_photons(n=6, lam=3.0)
+    fn = str(tmp_path / "partition.h5")
+    with writeemc.EMCWriter(fn, arr[0].size, seed=0) as emcwriter:
+        emcwriter.write_frames(arr, partition=3)
+    parts = EMCFormat.read(fn, pattern_shape=(9, 11))["img_array"]
+    assert parts.shape == (18, 9, 11)
+    # The photons are split among the sub-frames of each frame
+    assert np.array_equal(parts.reshape(6, 3, 9, 11).sum(axis=1), arr)
+
+    fn = str(tmp_path / "fraction.h5")
+    with writeemc.EMCWriter(fn, arr[0].size, seed=0) as emcwriter:
+        emcwriter.write_frames(arr, fraction=0.5)
+    reduced = EMCFormat.read(fn, pattern_shape=(9, 11))["img_array"]
+    assert np.all(reduced <= arr)
+    assert 0.3 < reduced.sum() / arr.sum() < 0.7
+
+    # Reproducible with a seed
+    outputs = []
+    for i in range(2):
+        fn = str(tmp_path / f"seeded_{i}.h5")
+        with writeemc.EMCWriter(fn, arr[0].size, seed=5) as emcwriter:
+            emcwriter.write_frames(arr, partition=2)
+        outputs.append(EMCFormat.read(fn, pattern_shape=(9, 11))["img_array"])
+    assert np.array_equal(outputs[0], outputs[1])
+    # Pixels left with one photon are single-photon pixels
+    with h5py.File(fn, "r") as h5:
+        assert all(np.all(row > 1) for row in h5["count_multi"])
+
+
+def test_binary_reader(tmp_path):
+    arr = get_photons(n=20, lam=1.2)
+    fn = str(tmp_path / "photons.emc")
+    write_photons(fn, arr, hdf5=False)
+    flat = arr.reshape(20, -1)
+    with EMCBinaryReader(fn) as reader:
+        assert len(reader) == 20
+        assert reader.num_pix == 99
+        # Zero-copy views into the file
+        patterns = reader[3:9]
+        assert isinstance(patterns.attrs("place_ones"), np.memmap)
+        assert np.array_equal(patterns.todense(), flat[3:9])
+        assert reader[5].num_data == 1
+        assert np.array_equal(reader.read_dense(5), flat[5])
+        assert np.array_equal(reader[[7, 2, 3, 4, 19]].todense(), flat[[7, 2, 3, 4, 19]])
+        assert np.array_equal(reader.read_dense(-1, (9, 11)), arr[-1])
+        dense = reader.read_dense("::3", (9, 11), dtype="f4")
+        assert dense.dtype == np.float32
+        assert np.array_equal(dense, arr[::3])
+    data_dict = EMCFormat.read(fn, index=[4, 1], pattern_shape=(9, 11))
+    assert np.array_equal(data_dict["img_array"], arr[[4, 1]])
+
+
+def test_h5_reader(tmp_path):
+    arr = get_photons(n=20, lam=1.2)
+    flat_arr = arr.reshape(20, -1)
+    for flat in [False, True]:
+        fn = str(tmp_path / f"photons_{flat}.h5")
+        write_photons(fn, arr, flat=flat)
+        with EMCH5Reader(fn) as reader:
+            assert reader.flat is flat
+            assert len(reader) == 20
+            assert reader.dtype == np.int32
+            assert np.array_equal(reader.read_dense(slice(2, 11)), flat_arr[2:11])
+            assert np.array_equal(reader.read_dense([9, 0, 1]), flat_arr[[9, 0, 1]])
+            assert np.array_equal(reader.read_dense(-2, (9, 11)), arr[-2])
+            assert reader[4:4].num_data == 0
+        lazy = EMCFormat.read(fn, pattern_shape=(9, 11), lazy=True)["img_array"]
+        assert np.array_equal(lazy[[3, 17]], arr[[3, 17]])
+
+
+def test_sparse_read(tmp_path):
+    arr = get_photons(n=20, lam=0.3)
+    for fn, kwargs in [("photons.h5", {}), ("photons.emc", {"hdf5": False})]:
+        fn = str(tmp_path / fn)
+        write_photons(fn, arr, **kwargs)
+        data_dict = EMCFormat.read(fn, pattern_shape=(9, 11), sparse=True)
+        sparse = data_dict["img_array"]
+        assert isinstance(sparse, SparsePatternArray)
+        assert sparse.shape == (20, 9, 11)
+        assert sparse.nbytes < arr.nbytes
+        assert np.array_equal(np.asarray(sparse), arr)
+        assert sparse.sum() == arr.sum()
+        assert np.array_equal(sparse.sum(axis=0), arr.sum(axis=0))
+        assert np.array_equal(sparse.sum(axis=(1, 2)), arr.sum(axis=(1, 2)))
+        assert np.allclose(sparse.mean_pattern(), arr.mean(axis=0))
+        assert np.array_equal(sparse[3], arr[3])
+        assert np.array_equal(sparse[2:7].to_dense(), arr[2:7])
+        assert np.array_equal(sparse[[8, 1, 1]].to_dense(), arr[[8, 1, 1]])
+        assert np.array_equal(sparse[::4].photon_counts(), arr[::4].sum(axis=(1, 2)))
+        assert np.array_equal(sparse[5:5].to_dense(), arr[5:5])
+        assert np.array_equal(
+            np.concatenate(list(sparse.iter_dense(chunk_size=6))), arr
+        )
+        assert np.array_equal(sparse.to_dense(dtype="f4"), arr.astype("f4"))
+    # The pipeline works on sparse data too
+    dd = DiffractionData.from_dict(data_dict, "sparse")
+    doubled = dd.pipeline().scale(2).run(chunk_size=7)
+    assert np.array_equal(doubled.get_data()["img_array"], arr * 2)
+
+
+def test_patterns_sone_stream(tmp_path):
+    arr = get_photons(n=30)
+    flat = arr.reshape(len(arr), -1)
+    fn = str(tmp_path / "photons.emc")
+    with PatternsSOneWriter(fn, flat.shape[1], buffer_size=4) as writer:
+        for start in range(0, len(flat), 7):
+            writer.write(dense_to_PatternsSOne(flat[start : start + 7]))
+        assert writer.num_data == 30
+    assert list(tmp_path.iterdir()) == [tmp_path / "photons.emc"]
+    assert np.array_equal(EMCBinaryReader(fn).read_dense(), flat)
+
+    assert np.array_equal(np.asarray(parse_bin_PatternsSOne(fn).todense()), flat)
+    for start, end in [(5, 17), (None, 3), (28, None), (10, 10), (-4, -1)]:
+        patterns = parse_bin_PatternsSOne(fn, start, end)
+        expected = flat[start:end]
+        assert patterns.num_data == len(expected)
+        with EMCBinaryReader(fn) as reader:
+            ref = reader[start:end]
+        for g in ["ones", "multi", "place_ones", "place_multi", "count_multi"]:
+            assert np.array_equal(patterns.attrs(g), ref.attrs(g))
+
+
+def test_convert(tmp_path):
+    arr = get_photons(n=40)
+    flat_arr = arr.reshape(len(arr), -1)
+    emc_fn = str(tmp_path / "photons.emc")
+    write_photons(emc_fn, arr, hdf5=False)
+
+    stats = convertEMC(emc_fn, str(tmp_path / "photons.h5"), chunk_size=16)
+    assert stats["num_data"] == 40
+    with EMCH5Reader(str(tmp_path / "photons.h5")) as reader:
+        assert not reader.flat
+        assert np.array_equal(reader.read_dense(), flat_arr)
+
+    convertEMC(str(tmp_path / "photons.h5"), str(tmp_path / "flat.h5"), flat=True)
+    with EMCH5Reader(str(tmp_path / "flat.h5")) as reader:
+        assert reader.flat
+        assert np.array_equal(reader.read_dense(), flat_arr)
+
+    convertEMC(str(tmp_path / "flat.h5"), str(tmp_path / "back.emc"), index="3:31")
+    back = EMCBinaryReader(str(tmp_path / "back.emc")).read_dense()
+    assert np.array_equal(back, flat_arr[3:31])
+
+    # DiffractionData.write converts directly between EMC files
+    dd = DiffractionData.from_file(emc_fn, EMCFormat, "emc", pattern_shape=(9, 11))
+    dd_h5 = dd.write(str(tmp_path / "converted.h5"), EMCFormat, flat=True)
+    assert np.array_equal(dd_h5.get_data()["img_array"], arr)
+
+
+def test_subset_split_concatenate(tmp_path):
+    arr = get_photons(n=30).reshape(30, -1)
+    emc_fn = str(tmp_path / "photons.emc")
+    h5_fn = str(tmp_path / "photons.h5")
+    write_photons(emc_fn, arr, hdf5=False)
+    write_photons(h5_fn, arr)
+
+    sel = [17, 3, 4, 5, 29, 0, 3]
+    for in_fn in [emc_fn, h5_fn]:
+        with openEMCReader(in_fn) as reader:
+            assert np.array_equal(reader.read_dense(sel), arr[sel])
+        out_fn = str(tmp_path / "subset.emc")
+        subsetEMC(in_fn, out_fn, sel, chunk_size=4)
+        assert np.array_equal(EMCBinaryReader(out_fn).read_dense(), arr[sel])
+    subsetEMC(emc_fn, str(tmp_path / "subset.h5"), arr.sum(axis=1) > 80)
+    with EMCH5Reader(str(tmp_path / "subset.h5")) as reader:
+        assert np.array_equal(reader.read_dense(), arr[arr.sum(axis=1) > 80])
+
+    parts = [str(tmp_path / f"part{i}.emc") for i in range(3)]
+    stats = splitEMC(h5_fn, parts)
+    assert [s["num_data"] for s in stats] == [10, 10, 10]
+    splitEMC(emc_fn, parts[:2], ranges=[(0, 12), (12, None)])
+    assert np.array_equal(EMCBinaryReader(parts[0]).read_dense(), arr[:12])
+    assert np.array_equal(EMCBinaryReader(parts[1]).read_dense(), arr[12:])
+
+    out_fn = str(tmp_path / "merged.h5")
+    concatenateEMC([parts[1], h5_fn, parts[0]], out_fn, chunk_size=7)
+    with EMCH5Reader(out_fn) as reader:
+        expected = np.concatenate([arr[12:], arr, arr[:12]])
+        assert np.array_equal(reader.read_dense(), expected)
+    with pytest.raises(ValueError):
+        concatenateEMC([emc_fn], emc_fn)
+
+
+def test_detector_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("SIMEXLITE_CACHE_DIR", str(tmp_path / "cache"))
+    dat_fn = str(tmp_path / "det.dat")
+    h5_fn = str(tmp_path / "det.h5")
+    writeEMCGeom(dat_fn, 100.0, 21, 17, 0.2, 2.0, 3, cache=True)
+    writeEMCGeom(h5_fn, 100.0, 21, 17, 0.2, 2.0, 3)
+
+    det = DetectorEMC.Detector()
+    with h5py.File(h5_fn, "r") as h5:
+        det.qx, det.qy, det.qz = h5["qx"][()], h5["qy"][()], h5["qz"][()]
+        det.corr, det.raw_mask = h5["corr"][()], h5["mask"][()]
+        det.detd, det.ewald_rad = h5["detd"][()], h5["ewald_rad"][()]
+    # The ASCII lines are the same as formatted one by one
+    with open(dat_fn) as fptr:
+        lines = fptr.read().splitlines()
+    assert len(lines) == 21 * 17 + 1
+    for i, row in enumerate(zip(det.qx, det.qy, det.qz, det.corr, det.raw_mask)):
+        assert lines[i + 1] == "%21.15e %21.15e %21.15e %21.15e %d" % row
+
+    # Without pandas the columns are read with np.loadtxt
+    monkeypatch.setattr(DetectorEMC, "PANDAS_MODE", False)
+    parsed = DetectorEMC.Detector(dat_fn, mask_flag=True)
+    for key in ["qx", "qy", "qz", "corr"]:
+        assert np.allclose(getattr(parsed, key), getattr(det, key), rtol=1e-15)
+    assert np.array_equal(parsed.raw_mask, det.raw_mask)
+    monkeypatch.undo()
+    monkeypatch.setenv("SIMEXLITE_CACHE_DIR", str(tmp_path / "cache"))
+
+    # The cache is off by default
+    for cache in [None, True, True, False]:
+        parsed = DetectorEMC.Detector()
+        parsed.parse(dat_fn, mask_flag=True, cache=cache)
+        if cache is None:
+            assert not (tmp_path / "cache" / "detector").exists()
+        for key in ["qx", "qy", "qz", "corr"]:
+            assert np.allclose(getattr(parsed, key), getattr(det, key), rtol=1e-15)
+        assert np.array_equal(parsed.raw_mask, det.raw_mask)
+    assert len(list((tmp_path / "cache" / "detector").iterdir())) == 1
+
+    # The second call copies the cached file
+    monkeypatch.setenv("SIMEXLITE_CACHE", "1")
+    writeEMCGeom(str(tmp_path / "det2.dat"), 100.0, 21, 17, 0.2, 2.0, 3)
+    assert (tmp_path / "det2.dat").read_bytes() == (tmp_path / "det.dat").read_bytes()
+
+
+def test_assemble_frames(tmp_path):
+    det_fn = str(tmp_path / "det.h5")
+    writeEMCGeom(det_fn, 100.0, 21, 17, 0.2, 2.0, 3)
+    det = DetectorEMC.Detector(det_fn, mask_flag=True)
+    data = get_photons(n=6, shape=(det.qx.size,), lam=3.0).astype("f8")
+    masked = data * det.unassembled_mask
+
+    imgs = det.assemble_frames(data)
+    assert imgs.shape == (6,) + det.frame_shape
+    for img, frame in zip(imgs, masked):
+        expected = np.zeros(det.frame_shape)
+        np.add.at(expected, (det.x, det.y), frame)
+        assert np.allclose(img.data, expected)
+        assert np.array_equal(img.mask, 1 - det.mask)
+
+    imgs = det.assemble_frames(data, zoomed=True, sym=True)
+    b = det._sym_zoom_bounds
+    for img, frame in zip(imgs, masked):
+        expected = np.zeros(det._sym_shape)
+        np.add.at(expected, (det._sym_x, det._sym_y), frame)
+        np.add.at(expected, (det._sym_fx, det._sym_fy), frame)
+        expected[det._sym_bothgood] /= 2.0
+        assert np.allclose(img.data, expected[b[0] : b[1], b[2] : b[3]])
+    assert np.allclose(det.assemble_frame(data[2], sym=True, zoomed=True), imgs[2])
+
+    # An empty batch
+    imgs = det.assemble_frames(data[:0])
+    assert isinstance(imgs, np.ma.MaskedArray)
+    assert imgs.shape == (0,) + det.frame_shape
+    imgs = det.assemble_frames(np.empty((0, det.qx.size)), zoomed=True, sym=True)
+    assert imgs.shape == (0, b[1] - b[0], b[3] - b[2])
@@ -0,0 +1,68 @@
+"""Test PixelMaps"""
+
+import h5py
+import numpy as np
+from SimExLite.DiffractionCalculators.SingFELDiffractionCalculator import (
+    get_qmap,
+    get_solid_angle,
+    write_singfel_geom_file,
+)
+from SimExLite.DiffractionData import (
+    get_polarization_map,
+    get_q_map,
+    get_solid_angle_map,
+)
+from SimExLite.utils.geometry import getSimpleGeometry, writeSimpleGeometry
+
+
+def test_pysingfel_geom(tmp_path, monkeypatch):
+    monkeypatch.setenv("SIMEXLITE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("SIMEXLITE_CACHE", "1")
+    geom_fn = str(tmp_path / "singfel.geom")
+    config = {"pixel_size": 2e-4, "slow_pixels": 5, "fast_pixels": 10}
+    write_singfel_geom_file(geom_fn, config, 0.13)
+    pmi_fn = str(tmp_path / "pmi_out.h5")
+    with h5py.File(pmi_fn, "w") as h5:
+        h5["history/parent/detail/params/photonEnergy"] = 4960.0
+
+    # The pixel by pixel reference of pysingfel
+    solid_angle = np.zeros((5, 10))
+    qmap = np.zeros((5, 10))
+    for ind_x in range(10):
+        for ind_y in range(5):
+            rx = (ind_x - 4.5) * 2e-4
+            ry = (ind_y - 2) * 2e-4
+            r = np.sqrt(rx**2 + ry**2)
+            pixDist = np.sqrt(r**2 + 0.13**2)
+            ss = 2e-4**2 / (4 * pixDist**2 + 2e-4**2)
+            solid_angle[ind_y, ind_x] = 4 * np.arcsin(ss)
+            qmap[ind_y, ind_x] = 2 * np.sin(np.arctan2(r, 0.13) / 2) / (12.398 / 4.96)
+
+    assert np.allclose(get_solid_angle(geom_fn), solid_angle)
+    assert np.allclose(get_qmap(geom_fn, pmi_fn), qmap)
+    assert len(list((tmp_path / "cache" / "pixel_maps").iterdir())) == 2
+    # From the cache
+    assert np.allclose(get_solid_angle(geom_fn), solid_angle)
+    assert np.allclose(get_qmap(geom_fn, pmi_fn, cache=False), qmap)
+    assert len(list((tmp_path / "cache" / "pixel_maps").iterdir())) == 2
+
+
+def test_crystfel_geom(tmp_path, monkeypatch):
+    monkeypatch.setenv("SIMEXLITE_CACHE_DIR", str(tmp_path / "cache"))
+    geom_fn = str(tmp_path / "simple.geom")
+    writeSimpleGeometry(geom_fn, 1e-3, npx=24, npy=20, clen=0.1)
+    # The cache is off by default
+    get_q_map(geom_fn, 9300)
+    assert not (tmp_path / "cache").exists()
+    monkeypatch.setenv("SIMEXLITE_CACHE", "1")
+    geom = getSimpleGeometry(1e-3, npx=24, npy=20)
+    assert np.allclose(get_solid_angle_map(geom_fn), get_solid_angle_map(geom, 0.1))
+    assert np.allclose(get_q_map(geom_fn, 9300), get_q_map(geom, 9300, 0.1))
+    assert np.allclose(
+        get_polarization_map(geom_fn, "y", 0.05),
+        get_polarization_map(geom, "y", 0.05),
+    )
+    # The distance and photon energy are part of the cache key
+    assert not np.allclose(get_q_map(geom, 9300, 0.1), get_q_map(geom, 9300, 0.2))
+    assert not np.allclose(get_q_map(geom, 9300, 0.1), get_q_map(geom, 6000, 0.1))
+    assert len(list((tmp_path / "cache" / "pixel_maps").iterdir())) == 8
@@ -0,0 +1,96 @@
+"""Test RadialIntegrator"""
+
+import numpy as np
+import pytest
+from extra_geom import GenericGeometry
+from SimExLite.DiffractionData import DiffractionData, RadialIntegrator
+from SimExLite.DiffractionData.DiffractionData import get_q
+from SimExLite.PhotonBeamData import SimpleBeam
+from SimExLite.utils.geometry import getSimpleGeometry
+
+
+def get_two_module_geom():
+    """Two 6x16 modules with a gap of 4 rows between them"""
+    return GenericGeometry.from_simple_description(
+        pixel_size=1e-3,
+        slow_pixels=6,
+        fast_pixels=16,
+        corner_coordinates=[
+            np.array([-8e-3, 2e-3, 0.0]),
+            np.array([-8e-3, -8e-3, 0.0]),
+        ],
+        ss_vec=np.array([0, 1, 0]),
+        fs_vec=np.array([1, 0, 0]),
+    )
+
+
+def test_single_panel():
+    geom = getSimpleGeometry(pixel_size=1e-3, npx=24, npy=20)
+    integrator = RadialIntegrator(
+        geom, 0.1, wavelength=2.0, bins=10, polarization=None, correct_solid_angle=False
+    )
+    assert integrator.img_size == (20, 24)
+    assert integrator.counts.sum() == 20 * 24
+    # The pixel centers of the simple geometry are shifted by half a pixel
+    y, x = np.indices((20, 24))
+    radius = np.hypot((x - 11) * 1e-3, (y - 9) * 1e-3)
+    assert np.allclose(integrator.radial_map, get_q(radius, 0.1, 2.0))
+
+    rng = np.random.default_rng(0)
+    patterns = rng.random((7, 20, 24))
+    profiles = integrator.integrate(patterns, chunk_size=3)
+    assert profiles.shape == (7, 10)
+    pixel_bin = np.digitize(integrator.radial_map, integrator.bin_edges) - 1
+    pixel_bin[pixel_bin == 10] = 9
+    for i in range(10):
+        assert np.allclose(profiles[:, i], patterns[:, pixel_bin == i].mean(axis=1))
+    assert np.allclose(integrator.integrate(patterns[4]), profiles[4])
+    with pytest.raises(ValueError):
+        integrator.integrate(patterns[:, :10])
+
+
+def test_corrections():
+    geom = getSimpleGeometry(pixel_size=1e-3, npx=24, npy=20)
+    integrator = RadialIntegrator(geom, 0.02, bins=8)
+    # A pattern following the solid angle and polarization is flat once corrected
+    y, x = np.indices((20, 24))
+    x = (x - 11) * 1e-3
+    y = (y - 9) * 1e-3
+    norm = np.sqrt(x**2 + y**2 + 0.02**2)
+    pattern = integrator.solid_angle * (1 - x**2 / norm**2)
+    profile = integrator.integrate(pattern)
+    assert np.allclose(profile, profile[0])
+
+
+def test_multi_module():
+    geom = get_two_module_geom()
+    integrator = RadialIntegrator(geom, 0.1, bins=5, img_size=(8, 8))
+    assert integrator.img_size == (8, 8)
+    full = RadialIntegrator(geom, 0.1, bins=5)
+    n_gap_rows = full.img_size[0] - 12
+    assert n_gap_rows > 0
+    assert full.counts.sum() == 12 * 16
+    # The binned rows overlapping the gap are excluded
+    assert 0 < integrator.counts.sum() < 64
+
+
+def test_from_diffraction_data():
+    geom = getSimpleGeometry(pixel_size=1e-3, npx=24, npy=20)
+    rng = np.random.default_rng(0)
+    data_dict = {
+        "img_array": rng.poisson(2.0, (9, 20, 24)),
+        "geom": geom,
+        "distance": 0.1,
+        "quaternions": None,
+        "beam": SimpleBeam(photon_energy=6000, focus_area=1e-12, pulse_energy=1e-3),
+        "pixel_mask": np.ones((20, 24)),
+    }
+    data_dict["pixel_mask"][:2] = 0
+    dd = DiffractionData.from_dict(data_dict, "synthetic")
+    integrator = RadialIntegrator.from_diffraction_data(dd, bins=6)
+    assert integrator.counts.sum() == 18 * 24
+    wavelength = data_dict["beam"].get_wavelength("angstrom").magnitude
+    reference = RadialIntegrator(geom, 0.1, wavelength=wavelength, bins=6)
+    assert np.allclose(integrator.radial_map, reference.radial_map)
+    profiles = integrator.integrate_data(dd, chunk_size=4)
+    assert np.allclose(profiles, integrator.integrate(data_dict["img_array"]))
@@ -6,6 +6,8 @@ from SimExLite.DiffractionData.SingFELFormat import (
     getPatternShape,
     ireadPattern,
     getParameters,
+    isStacked,
+    write_singfelDiffr,
 )
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -157,6 +159,89 @@ def test_iterator():
     assert pattern.shape == (81, 81)
 
 
+def write_synthetic(fn, n=7, shape=(9, 11), stacked=False):
+    """Write a small synthetic singfel file"""
+    rng = np.random.default_rng(0)
+    arr = rng.random((n,) + shape)
+    quaternions = rng.random((n, 4))
+    geom = {
+        "detectorDist": 0.13,
+        "pixelWidth": 1e-3,
+        "pixelHeight": 1e-3,
+        "mask": np.ones(shape),
+    }
+    beam = {"focusArea": 1e-14, "photonEnergy": 4960.0}
+    write_singfelDiffr(
+        fn,
+        arr,
+        geom,
+        beam,
+        arr_poisson=rng.poisson(arr),
+        quaternions=quaternions,
+        stacked=stacked,
+        compression="gzip" if stacked else None,
+    )
+    return arr, quaternions
+
+
+def test_stacked_layout(tmp_path):
+    legacy_fn = str(tmp_path / "legacy.h5")
+    stacked_fn = str(tmp_path / "stacked.h5")
+    arr, quaternions = write_synthetic(legacy_fn)
+    write_synthetic(stacked_fn, stacked=True)
+    assert isStacked(stacked_fn) is True
+    assert isStacked(legacy_fn) is False
+    assert getPatternTotal(stacked_fn) == 7
+    assert tuple(getPatternShape(stacked_fn)) == (9, 11)
+    for index in [None, "2:5", 3, "::2", [5, 1, 1]]:
+        legacy = SingFELFormat.read(legacy_fn, index=index)
+        stacked = SingFELFormat.read(stacked_fn, index=index)
+        assert np.array_equal(legacy["img_array"], stacked["img_array"])
+        assert np.array_equal(legacy["quaternions"], stacked["quaternions"])
+    assert np.array_equal(stacked["img_array"], arr[[5, 1, 1]])
+    legacy = SingFELFormat.read(legacy_fn, poissonize=True)
+    stacked = SingFELFormat.read(stacked_fn, poissonize=True)
+    assert np.array_equal(legacy["img_array"], stacked["img_array"])
+    patterns = [pattern for pattern, _ in ireadPattern(stacked_fn, "1:3", False)]
+    assert np.array_equal(patterns, arr[1:3])
+
+
+def test_read_dtype(tmp_path):
+    for stacked in [False, True]:
+        fn = str(tmp_path / f"stacked_{stacked}.h5")
+        write_synthetic(fn, stacked=stacked)
+        assert SingFELFormat.read(fn)["img_array"].dtype == np.float64
+        poisson = SingFELFormat.read(fn, poissonize=True)["img_array"]
+        assert np.issubdtype(poisson.dtype, np.integer)
+        assert SingFELFormat.read(fn, dtype="f4")["img_array"].dtype == np.float32
+
+
+def test_read_lazy(tmp_path):
+    for stacked in [False, True]:
+        fn = str(tmp_path / f"stacked_{stacked}.h5")
+        arr, quaternions = write_synthetic(fn, stacked=stacked)
+        data_dict = SingFELFormat.read(fn, index="1:", lazy=True)
+        lazy = data_dict["img_array"]
+        assert lazy.shape == (6, 9, 11)
+        assert np.array_equal(lazy[[4, 0]], arr[1:][[4, 0]])
+        assert np.array_equal(np.asarray(lazy), arr[1:])
+        assert np.array_equal(data_dict["quaternions"], quaternions[1:])
+
+
+def test_write_stacked(tmp_path):
+    fn = str(tmp_path / "legacy.h5")
+    write_synthetic(fn)
+    diffrData = DiffractionData.from_file(
+        fn, format_class=SingFELFormat, key="test_singfel"
+    )
+    out_fn = str(tmp_path / "stacked.h5")
+    diffrData.write(out_fn, SingFELFormat, stacked=True)
+    assert isStacked(out_fn) is True
+    assert np.array_equal(
+        SingFELFormat.read(out_fn)["img_array"], SingFELFormat.read(fn)["img_array"]
+    )
+
+
 # def test_SolidAngles():
 #     diffr_patterns = singfelDiffr(h5_file)
 #     diffr_patterns.solid_angles
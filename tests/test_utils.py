@@ -1,6 +1,9 @@
 import pytest
 # from .logger_module import info_log
 from pathlib import Path
+import h5py
+import numpy as np
+from SimExLite.utils import rebin, rebin_sum
 from SimExLite.utils.geometry import writeSimpleGeometry
 
 
@@ -19,5 +22,38 @@ def test_write_simple_geometry(tmpdir):
     writeSimpleGeometry(str(tmpdir / "test.geom"))
 
 
+def test_rebin(tmp_path):
+    rng = np.random.default_rng(0)
+    arr = rng.random((7, 10, 13))
+    # The remainder is cropped by default
+    expected = arr[0, :9, :12].reshape(3, 3, 4, 3).sum((1, 3))
+    assert np.allclose(rebin_sum(arr[0], (3, 4)), expected)
+    assert np.allclose(rebin(arr, (3, 4)), rebin(arr, factor=3)[:, :, :4])
+    merged = rebin(arr, (3, 4), reducer="max", remainder="merge")
+    assert np.allclose(merged[:, 2, 3], arr[:, 6:, 9:].max((1, 2)))
+    padded = rebin(arr, factor=(4, 5), reducer="mean", remainder="pad")
+    assert padded.shape == (7, 3, 3)
+    assert np.allclose(padded[:, 2, 2], arr[:, 8:, 10:].mean((1, 2)))
+    with pytest.raises(ValueError):
+        rebin(arr, (3, 4), remainder="pad")
+
+    # NaN propagates, unless the reduction is NaN-aware
+    arr[0, 0, :3] = np.nan
+    assert np.isnan(rebin(arr, factor=3)[0, 0, 0])
+    nan_aware = rebin(arr, factor=3, reducer="mean", nan_aware=True)
+    assert np.isclose(nan_aware[0, 0, 0], np.nanmean(arr[0, :3, :3]))
+    arr[0, :3, :3] = np.nan
+    assert np.isnan(rebin(arr, factor=3, nan_aware=True)[0, 0, 0])
+
+    # Chunk by chunk from a file into a file
+    fn = str(tmp_path / "stack.h5")
+    with h5py.File(fn, "w") as h5:
+        h5["data"] = arr
+        out = h5.create_dataset("binned", (7, 5, 6))
+        rebin(h5["data"], factor=2, reducer="mean", chunk_size=3, out=out)
+        expected = rebin(arr, factor=2, reducer="mean")
+        assert np.allclose(out[()], expected, equal_nan=True)
+
+
 if __name__ == "__main__":
     test_write_simple_geometry(Path("./"))